@@ -0,0 +1,202 @@
+"""
+FedAvg的流式聚合：每个客户端训练完就把它的参数展平成一个向量，加权累加到running sum上，
+不再把所有客户端的state_dict都存下来最后再按key逐个相加，所以内存只和一个模型的大小有关
+"""
+import copy
+import time
+import torch
+
+from algorithm.fedavg.compression import CompressedDelta
+from algorithm.fedavg.sparse_rows import RowSparseDelta
+
+
+def state_buffer_keys(model):
+    """
+    模型state_dict中的buffer（如BatchNorm的running_mean、running_var、num_batches_tracked）：
+    它们不是训练出来的参数而是统计量，客户端上传delta时也要上传它们的原值，聚合时按原值加权平均
+    """
+    state_keys = set(model.state_dict().keys())
+    return [name for name, _ in model.named_buffers() if name in state_keys]
+
+
+class FlatParams(dict):
+    """
+    客户端训练完返回的参数快照：所有浮点参数一次性拷贝成一个连续的float32向量flat，
+    字典里的每个浮点参数都是flat上的view（非浮点buffer单独拷贝），
+    用起来和普通的state_dict一样，StreamingAggregator.add拿到它时直接累加flat，不用再拼一次
+    """
+
+    def __init__(self, state_dict, out=None):
+        """out: 预先分配好的CPU向量（如共享内存里的槽位，见shared_params.py），直接拼到out里"""
+        super().__init__()
+        self.float_keys = [key for key, value in state_dict.items() if value.is_floating_point()]
+        values = [state_dict[key].detach().reshape(-1).float() for key in self.float_keys]
+        if out is not None:
+            self.flat = torch.cat([value.cpu() for value in values], out=out)
+        else:
+            # 先在模型所在的设备上拼好，再一次性拷回CPU
+            self.flat = torch.cat(values).cpu() if len(values) > 0 else torch.zeros(0)
+        offset = 0
+        for key, value in state_dict.items():
+            if value.is_floating_point():
+                self[key] = self.flat[offset:offset + value.numel()].view(value.shape).to(value.dtype)
+                offset += value.numel()
+            else:
+                self[key] = value.detach().cpu().clone()
+
+
+class StreamingAggregator:
+    def __init__(self, template, row_keys=None, buffer_keys=None):
+        """
+        Args:
+            template: 全局模型的state_dict，用来确定每个key在展平向量中的位置、形状和dtype
+            row_keys: 按行稀疏上传的embedding参数（见sparse_rows.py），每一行只在更新过它的客户端之间平均
+            buffer_keys: 模型的buffer（见state_buffer_keys），上传delta时也按原值加权平均；
+                         异步模式下过时的delta加到新的全局模型上，BatchNorm的running_var会变成负数
+        """
+        self.keys = list(template.keys())
+        self.shapes = {key: template[key].shape for key in self.keys}
+        self.dtypes = {key: template[key].dtype for key in self.keys}
+
+        # 浮点参数和非浮点buffer（如BatchNorm的num_batches_tracked）分开放
+        # 非浮点buffer用float64累加，最后四舍五入再转回原来的dtype
+        # 浮点buffer（running_mean/running_var）在两边都有：float_keys里的位置保证展平向量的布局和FlatParams一样，
+        # 但结果取other里按原值累加的平均
+        self.float_keys = [key for key in self.keys if template[key].is_floating_point()]
+        self.buffer_keys = [key for key in (buffer_keys or []) if template[key].is_floating_point()]
+        self.other_keys = [key for key in self.keys if not template[key].is_floating_point()] + self.buffer_keys
+        self.offsets = {}
+        self.other_offsets = {}
+        for keys, offsets in ((self.float_keys, self.offsets), (self.other_keys, self.other_offsets)):
+            offset = 0
+            for key in keys:
+                offsets[key] = (offset, offset + template[key].numel())
+                offset += template[key].numel()
+
+        self.float_buffer = torch.zeros(self._numel(self.float_keys), dtype=torch.float32)
+        self.float_sum = torch.zeros_like(self.float_buffer)
+        self.other_buffer = torch.zeros(self._numel(self.other_keys), dtype=torch.float64)
+        self.other_sum = torch.zeros_like(self.other_buffer)
+        self.total_num = 0
+        self.base = None
+        self.row_keys = [] if row_keys is None else list(row_keys)
+        # 每个embedding表每一行的权重和（更新过这一行的客户端的样本数之和）
+        self.row_weight = {key: torch.zeros(self.shapes[key][0], dtype=torch.float32) for key in self.row_keys}
+
+    def _numel(self, keys):
+        return sum(self.shapes[key].numel() for key in keys)
+
+    def reset(self, base=None):
+        """
+        Args:
+            base: 客户端上传的是delta（见compression.py）时，传入本轮全局模型展平的浮点参数，
+                  result()返回 base + delta的加权平均
+        """
+        self.float_sum.zero_()
+        self.other_sum.zero_()
+        self.total_num = 0
+        self.base = base
+        for weight in self.row_weight.values():
+            weight.zero_()
+        return self
+
+    def _segment(self, key):
+        start, end = self.offsets[key]
+        return self.float_sum[start:end]
+
+    def _add_row_sparse(self, params, n_k):
+        for key, (index, values) in params.rows.items():
+            self._segment(key).view(self.shapes[key]).index_add_(0, index, values.float(), alpha=n_k)
+            self.row_weight[key].index_add_(0, index, torch.full((len(index),), float(n_k)))
+        for key, value in params.dense.items():
+            self._segment(key).add_(value.reshape(-1).float(), alpha=n_k)
+        self.other_sum.add_(self._flatten(params.other, self.other_keys, self.other_buffer), alpha=n_k)
+        self.total_num += n_k
+        return self
+
+    @staticmethod
+    def _flatten(params, keys, out):
+        if len(keys) > 0:
+            torch.cat([params[key].detach().reshape(-1).to(out.dtype) for key in keys], out=out)
+        return out
+
+    def add(self, params, n_k):
+        """把一个客户端的参数（state_dict、FlatParams、压缩后的CompressedDelta或RowSparseDelta）按样本数n_k加权累加进来"""
+        if isinstance(params, RowSparseDelta):
+            return self._add_row_sparse(params, n_k)
+        if isinstance(params, CompressedDelta):
+            # 直接在压缩格式上累加，如topk只需要一次index_add_
+            params.add_to(self.float_sum, alpha=n_k)
+            self.other_sum.add_(self._flatten(params.other, self.other_keys, self.other_buffer), alpha=n_k)
+            self.total_num += n_k
+            return self
+        if isinstance(params, FlatParams) and params.float_keys == self.float_keys:
+            flat = params.flat
+        else:
+            flat = self._flatten(params, self.float_keys, self.float_buffer)
+        self.float_sum.add_(flat, alpha=n_k)
+        self.other_sum.add_(self._flatten(params, self.other_keys, self.other_buffer), alpha=n_k)
+        self.total_num += n_k
+        return self
+
+    def result(self):
+        """返回加权平均后的state_dict"""
+        float_avg = self.float_sum / self.total_num
+        for key in self.row_keys:
+            # embedding的每一行除以更新过它的客户端的样本数之和，没被更新过的行delta为0
+            start, end = self.offsets[key]
+            rows = self.float_sum[start:end].view(self.shapes[key])
+            float_avg[start:end] = (rows / self.row_weight[key].clamp_min(1)[:, None]).reshape(-1)
+        if self.base is not None:
+            float_avg += self.base
+        other_avg = self.other_sum / self.total_num
+        new_params = {}
+        for key in self.keys:
+            if key in self.buffer_keys:
+                start, end = self.other_offsets[key]
+                new_params[key] = other_avg[start:end].view(self.shapes[key]).to(self.dtypes[key])
+            elif self.dtypes[key].is_floating_point:
+                start, end = self.offsets[key]
+                new_params[key] = float_avg[start:end].view(self.shapes[key]).to(self.dtypes[key])
+            else:
+                start, end = self.other_offsets[key]
+                new_params[key] = torch.round(other_avg[start:end]).view(self.shapes[key]).to(self.dtypes[key])
+        return new_params
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from models.fedavg.mnist.cnn import CNN
+    from models.fedavg.movielens.widedeep import WideDeep
+    from benchmarks.reference import naive_aggregate
+
+    num_clients = 40
+    for model in [CNN(), WideDeep()]:
+        params = model.state_dict()
+        updates = []
+        for i in range(num_clients):
+            client_params = copy.deepcopy(params)
+            for value in client_params.values():
+                if value.is_floating_point():
+                    value.add_(torch.randn_like(value))
+            updates.append((client_params, i + 1))
+
+        start = time.perf_counter()
+        aggregator = StreamingAggregator(params)
+        for client_params, n_k in updates:
+            aggregator.add(client_params, n_k)
+        streaming = aggregator.result()
+        streaming_cost = time.perf_counter() - start
+
+        updates = copy.deepcopy(updates)  # naive_aggregate会原地修改updates[0][0]
+        start = time.perf_counter()
+        naive = naive_aggregate(updates)
+        naive_cost = time.perf_counter() - start
+
+        diff = max((streaming[key].float() - naive[key].float()).abs().max().item() for key in params)
+        size = sum(value.numel() * value.element_size() for value in params.values()) / 2 ** 20
+        print(f"{model.__class__.__name__} ({size:.1f} MB, {num_clients} clients): "
+              f"streaming {streaming_cost * 1000:.1f} ms, naive {naive_cost * 1000:.1f} ms, max diff {diff:.2e}")
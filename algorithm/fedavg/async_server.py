@@ -0,0 +1,180 @@
+"""
+异步（FedBuff）模式：
+    - 始终有concurrency个客户端在训练，每个客户端拿到的是它开始训练时的全局模型（可能已经过时了）
+    - 客户端训练完上传delta，放进buffer，同时马上选一个新客户端用当前的全局模型开始训练
+    - buffer里攒够buffer_size个delta就聚合一次，全局模型版本+1；
+      一个delta的权重是 样本数 / (1 + staleness) ** staleness_exponent，staleness是它开始训练之后全局模型更新了几次
+单机上没有真的并发和设备差异，客户端的完成时间由LatencyModel模拟（离散事件模拟）：
+客户端在被选中时就在当前的全局模型上训练完，结果到它的模拟完成时间才交给服务器
+num_rounds、eval_interval、early_stop都按全局模型的版本（聚合次数）算
+"""
+import heapq
+import numpy as np
+import wandb
+
+from algorithm.fedavg.server import Server
+from algorithm.fedavg.executor import train_agent
+from algorithm.fedavg.compression import Compressor
+from algorithm.fedavg.latency import LatencyModel
+
+
+class AsyncServer(Server):
+    def __init__(self, args):
+        super().__init__(args)
+        self.buffer_size = args.buffer_size
+        self.concurrency = args.client_num_per_round
+        self.staleness_exponent = args.staleness_exponent
+        # 异步模式下客户端必须上传delta（相对于它开始训练时的全局模型），聚合时加在最新的全局模型上
+        if self.compressor is None and not self.sparse_embedding:
+            self.compressor = Compressor('delta')
+        self.dispatch_count = 0
+        self.event_count = 0
+        self.events = []  # 训练完、还没到模拟完成时间的结果：(完成时间, 序号, client_id, 开始训练时的版本, result)
+        self.in_flight = set()  # 正在训练的客户端
+
+    def _setup(self):
+        super()._setup()
+        if self.negative_resampler is not None:
+            # 异步模式没有"轮"，训练中的客户端也还在用旧的负样本
+            raise ValueError("--resample_negatives is not supported with --mode async")
+        if self.latency is None:
+            # 不指定分布时所有客户端一样快（只有每次的随机波动）
+            self.latency = LatencyModel(self.client_num_in_total, 'constant', mean=self.latency_mean, seed=self.seed)
+        return self
+
+    def _checkpoint_state(self, next_round, min_loss, early_stop_cnt):
+        # 在版本之间保存，这时buffer是空的，还在训练中的客户端的结果都在events里
+        state = super()._checkpoint_state(next_round, min_loss, early_stop_cnt)
+        state.update({'dispatch_count': self.dispatch_count,
+                      'event_count': self.event_count, 'events': list(self.events), 'in_flight': set(self.in_flight)})
+        return state
+
+    def _load_checkpoint_state(self, state):
+        super()._load_checkpoint_state(state)
+        self.dispatch_count, self.event_count = state['dispatch_count'], state['event_count']
+        self.events, self.in_flight = state['events'], state['in_flight']
+        return state
+
+    def staleness_weight(self, staleness):
+        return (1 + staleness) ** -self.staleness_exponent
+
+    def _dispatch(self, version, num_clients):
+        """
+        从不在训练中的客户端里选num_clients个，用当前的全局模型训练，结果按模拟完成时间放进events
+        每次dispatch用dispatch_count当选择的"轮数"，选出来的客户端只由seed和dispatch_count决定
+        """
+        clients_index = self.selector.select(self.dispatch_count, num_clients, exclude=self.in_flight)
+        tasks = self._make_tasks(clients_index, version, seed_round=self.dispatch_count)
+        self.dispatch_count += 1
+        results = self.executor.run(train_agent, tasks)
+        for client_id, result in zip(clients_index, results):
+            self._collect_client_state(result)
+            finish_time = self.sim_time + self.latency.sample(client_id)
+            # (完成时间, 序号, ...) 序号保证完成时间相同时的顺序固定
+            heapq.heappush(self.events, (finish_time, self.event_count, int(client_id), version, result))
+            self.event_count += 1
+            self.in_flight.add(int(client_id))
+
+    def federate(self):
+        print("Begin Federating (buffered asynchronous)!")
+        print(f"Training among {self.client_num_in_total} clients, {self.concurrency} concurrently, "
+              f"aggregate every {self.buffer_size} updates!")
+        # 并发、完成顺序和staleness都是LatencyModel模拟的，实际上客户端是一次dispatch接一次dispatch训练的
+        print("Note: concurrency is simulated, clients are actually trained one dispatch at a time; "
+              "time-to-accuracy is reported on the simulated clock, not wall-clock time. \n")
+
+        self._setup()
+
+        version, min_loss, early_stop_cnt = self._resume_or_start()
+        staleness_list = []
+
+        self.profiler.start_round(version)
+        aggregator = self.aggregator.reset(base=self._delta_base())
+        if not self.resume:
+            self._dispatch(version, self.concurrency)
+        while version < self.num_rounds and len(self.events) > 0:
+            finish_time, _, client_id, start_version, result = heapq.heappop(self.events)
+            self.sim_time = finish_time
+            self.in_flight.discard(client_id)
+
+            staleness = version - start_version
+            staleness_list.append(staleness)
+            local_params, train_data_num = result[0], result[1]
+            with self.profiler.phase('aggregate'):
+                aggregator.add(params=local_params, n_k=train_data_num * self.staleness_weight(staleness))
+
+            if len(staleness_list) == self.buffer_size:
+                with self.profiler.phase('aggregate'):
+                    self._aggregate_and_update_global_params(aggregator)
+                print("-" * 50)
+                print(f"Version {version}: {self.buffer_size} updates, mean staleness {np.mean(staleness_list):.2f}")
+                wandb.log({"Async/staleness": float(np.mean(staleness_list)), "round": version})
+                if version % self.eval_interval == 0:
+                    test_loss = self._evaluate(version)
+                    if min_loss > test_loss:
+                        min_loss = test_loss
+                        early_stop_cnt = 0
+                    else:
+                        early_stop_cnt += self.eval_interval
+                self.profiler.end_round()
+
+                version += 1
+                staleness_list = []
+                if early_stop_cnt >= self.early_stop:
+                    break
+                self.profiler.start_round(version)
+                aggregator = self.aggregator.reset(base=self._delta_base())
+
+            # 马上选一个新客户端补上，用的是（可能刚更新过的）当前全局模型
+            with self.profiler.phase('train'):
+                self._dispatch(version, 1)
+
+            # 刚更新完一个版本：这时的状态和从checkpoint续训时进入循环前的状态一样
+            if len(staleness_list) == 0 and self.checkpointer.due(version - 1):
+                with self.profiler.phase('checkpoint'):
+                    self.checkpointer.save(self._checkpoint_state(version, min_loss, early_stop_cnt))
+
+        self.checkpointer.wait()
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    # 回归检查：带BatchNorm的MLP异步训练几个版本，测试loss不能发散
+    # （BatchNorm的running_mean/running_var是统计量，要按绝对值平均，不能当成过时的delta加到新的全局模型上）
+    # 在仓库根目录运行：PYTHONPATH=algorithm/fedavg python -m algorithm.fedavg.async_server
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from fedavg_main import parse_args, setup_seed
+    from benchmarks.synthetic import movielens_like
+    from data_preprocessing.client_dataset import range_partition
+    from models.fedavg.movielens.mlp import MLP
+
+    wandb.init(mode='disabled')
+    sys.argv = [sys.argv[0], '--model', 'mlp', '--dataset', 'movielens', '--mode', 'async', '--device', 'cpu',
+                '--partition_method', 'homo', '--client_num_in_total', '40', '--client_num_per_round', '20',
+                '--buffer_size', '5', '--num_rounds', '4', '--eval_interval', '1', '--batch_size', '64',
+                '--epoch', '2', '--lr', '0.003', '--latency', 'lognormal']
+    args = parse_args()
+    setup_seed(args.seed)
+    user_num, movie_num = 500, 300
+    inputs, _ = movielens_like(40 * 1000, user_num, movie_num)
+    test_inputs, _ = movielens_like(4000, user_num, movie_num, seed=1)
+    # label只和user有关，测试集上也学得会
+    labels, test_labels = (inputs[:, 0] % 3 == 0).long(), (test_inputs[:, 0] % 3 == 0).long()
+
+    server = AsyncServer(args)
+    server._select_model = lambda model_name, sparse=False: MLP(user_num, movie_num, sparse=sparse)
+    server.get_dataloader = lambda: {
+        'train': range_partition(inputs, labels, 40, args.batch_size, shuffle=True),
+        'test': range_partition(test_inputs, test_labels, 40, args.batch_size, shuffle=False)}
+    losses = []
+    evaluate = server._evaluate
+    server._evaluate = lambda version: losses.append(evaluate(version)) or losses[-1]
+    server.federate()
+
+    running_var = {key: float(value.min()) for key, value in server.global_params.items() if 'running_var' in key}
+    print(f"test loss per version: {[round(loss, 4) for loss in losses]}, min running_var: {running_var}")
+    assert len(losses) == args.num_rounds and max(losses) < 0.75, losses
+    assert min(running_var.values()) > 0.01, running_var
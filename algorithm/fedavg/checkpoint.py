@@ -0,0 +1,100 @@
+"""
+长时间训练的checkpoint和断点续训
+每隔checkpoint_interval轮保存一次：全局参数、下一轮的轮数、early stop的计数、python/numpy/torch的随机数状态、
+模拟耗时，以及客户端各自的状态（stateful_optimizer的优化器状态、error feedback的residual）
+    - 在主线程里只做一次快照（参数拷贝一份，其余是引用，这些对象之后只会被替换、不会被原地修改），
+      torch.save和写盘放在后台线程里，不阻塞下一轮的训练
+    - 先写到同目录下的临时文件，写完再os.replace成checkpoint.pt，中途崩溃也不会留下写了一半的checkpoint
+--resume从checkpoint继续：数据和模型照常按seed重新创建，然后用checkpoint里的状态覆盖，
+之后每一轮都和没有中断时完全一样
+"""
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+CHECKPOINT_NAME = 'checkpoint.pt'
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot_params(params):
+    """全局参数拷贝一份到CPU上，之后服务器再怎么更新都不会影响正在后台写的checkpoint"""
+    return {key: value.detach().cpu().clone() for key, value in params.items()}
+
+
+def checkpoint_path(path):
+    """path可以是checkpoint文件，也可以是保存checkpoint的文件夹"""
+    return os.path.join(path, CHECKPOINT_NAME) if os.path.isdir(path) else path
+
+
+def load_checkpoint(path):
+    return torch.load(checkpoint_path(path), map_location='cpu', weights_only=False)
+
+
+class Checkpointer:
+    def __init__(self, checkpoint_dir='', interval=10):
+        """
+        Args:
+            checkpoint_dir: checkpoint保存的文件夹，为空时不保存
+            interval: 每隔多少轮保存一次
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.interval = interval
+        self.enabled = bool(checkpoint_dir) and interval > 0
+        self.thread = None
+        self.error = None
+        if self.enabled:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def due(self, round_th):
+        """第round_th轮结束后要不要保存"""
+        return self.enabled and (round_th + 1) % self.interval == 0
+
+    def save(self, state):
+        """state: 已经做好快照的dict，在后台线程里写盘；上一次还没写完时先等它写完"""
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state,), daemon=True)
+        self.thread.start()
+
+    def _write(self, state):
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_NAME)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.error = e
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def wait(self):
+        """等后台的写入完成，写入失败时在主线程里抛出"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"failed to write checkpoint to {self.checkpoint_dir}") from error
@@ -3,13 +3,20 @@ import torch.optim as optim
 import torch.nn as nn
 from tqdm import tqdm
 import copy
+import time
 import wandb
 from base import Metrics
+from algorithm.fedavg.aggregator import FlatParams, state_buffer_keys
+from algorithm.fedavg.optimizer_state import reset_optimizer_state, export_optimizer_state, load_optimizer_state, \
+    OptimizerGroup
+from algorithm.fedavg.sparse_rows import RowSparseUploader
+from data_preprocessing.client_dataset import to_device
 
 
 class Client:
     def __init__(self, user_id, train_dataloader=None, test_dataloader=None,
-                 model=None, epoch=10, lr=0.01, lr_decay=0.998, decay_step=20, optimizer='sgd', device='cuda'):
+                 model=None, epoch=10, lr=0.01, lr_decay=0.998, decay_step=20, optimizer='sgd', device='cuda',
+                 stateful_optimizer=False, compressor=None, error_feedback=False, row_inputs=None):
         self.user_id = user_id
         self.train_dataloader = train_dataloader
         self.test_dataloader = test_dataloader
@@ -20,6 +27,35 @@ class Client:
         self.decay_step = decay_step
         self.optimizer = optimizer
         self.device = device
+        self.stats = {}  # 最近一次train的耗时统计，见profiler.py
+        # 为True时每个客户端保留自己的优化器状态（见optimizer_state.py），
+        # 训练前服务器把这个客户端上次的状态放到optimizer_state里，训练完的状态放在stats['optimizer_state']里带回去
+        self.stateful_optimizer = stateful_optimizer
+        self.optimizer_state = None
+        # 不为None时上传压缩后的delta而不是完整参数（见compression.py），
+        # error_feedback时服务器把这个客户端上次的residual放到residual里，新的residual放在stats['residual']里带回去
+        self.compressor = compressor
+        self.error_feedback = error_feedback
+        self.residual = None
+        self.compression_error = None
+        self._global_flat = None  # 本轮收到的全局模型的浮点参数（展平），用来算delta
+        self._buffers = None  # 浮点buffer在展平向量中的位置，见_buffer_segments
+        # 不为None时embedding使用稀疏梯度，只上传用到的行（见sparse_rows.py），row_inputs就是模型的row_inputs
+        self.row_inputs = row_inputs
+        self.row_sparse = None if row_inputs is None else RowSparseUploader(row_inputs, state_buffer_keys(model))
+        # agent槽位的模型一直放在self.device上，优化器也只创建一次，每一轮只原地更新（见_prepare）
+        self._state = None
+        self._optimizer = None
+        # 不为None时完整参数直接拼到这个预先分配的向量里（进程池的共享内存槽位，见executor.ProcessExecutor）
+        self.params_out = None
+
+    def __getstate__(self):
+        # 进程池会pickle整个agent，缓存的state_dict和优化器到了worker里重新创建
+        state = self.__dict__.copy()
+        state['_state'] = None
+        state['_optimizer'] = None
+        state['_global_flat'] = None
+        return state
 
     def update_local_dataset(self, client):
         # 传进来一个被选择的模型client，用他的属性更新当前槽位surrogate的属性
@@ -27,44 +63,123 @@ class Client:
         self.test_dataloader = client.test_dataloader
         # print("update local dataset")
 
+    def _prepare(self):
+        """第一次用到时把模型放到device上，缓存它的state_dict（和模型参数共用存储）"""
+        if self._state is None:
+            self.model.to(device=self.device)
+            self._state = self.model.state_dict()
+        return self._state
+
     def set_params(self, model_params):
-        # load_state_dict is deepcopy
-        self.model.load_state_dict(model_params)
+        # 原地拷贝到已经在device上的参数里，不重新分配，也不用把模型搬来搬去
+        state = self._prepare()
+        with torch.no_grad():
+            for key, value in state.items():
+                value.copy_(model_params[key])
+        if self.compressor is not None:
+            self._global_flat = self._flatten_float(out=self._global_flat)
+        if self.row_sparse is not None:
+            self.row_sparse.begin(state, self.train_dataloader)
+
+    def _buffer_segments(self):
+        """浮点buffer在_flatten_float展平向量中的位置 {key: (start, end)}"""
+        if self._buffers is None:
+            buffer_keys = set(state_buffer_keys(self.model))
+            self._buffers, offset = {}, 0
+            for key, value in self._state.items():
+                if value.is_floating_point():
+                    if key in buffer_keys:
+                        self._buffers[key] = (offset, offset + value.numel())
+                    offset += value.numel()
+        return self._buffers
+
+    def _flatten_float(self, out=None):
+        values = [value.detach().reshape(-1).float() for value in self._state.values() if value.is_floating_point()]
+        return torch.cat(values, out=out) if out is not None else torch.cat(values)
 
     def get_params(self):
-        # params = model.state_dict() is shadow copy
-        return copy.deepcopy(self.model.cpu().state_dict())
+        if self.row_sparse is not None:
+            return self.row_sparse.end(self._state)
+        if self.compressor is None:
+            # 参数快照：一次拷贝成CPU上的一个连续向量，模型本身还留在device上
+            return FlatParams(self._prepare(), out=self.params_out)
+
+        # 压缩上传：在device上算delta并压缩，只把压缩后的结果拷回CPU
+        # buffer（BatchNorm的running_mean/running_var等）不算delta，上传原值，聚合时按原值平均（见StreamingAggregator）
+        buffers = self._buffer_segments()
+        delta = self._flatten_float() - self._global_flat
+        for start, end in buffers.values():
+            delta[start:end] = 0
+        other = {key: value.detach().cpu().clone() for key, value in self._state.items()
+                 if not value.is_floating_point() or key in buffers}
+        compressed, residual, self.compression_error = self.compressor.compress_with_feedback(
+            delta, self.residual if self.error_feedback else None, other)
+        self.residual = residual.cpu() if self.error_feedback else None
+        return compressed.cpu()
+
+    def _get_optimizer(self, round_th):
+        """
+        优化器只创建一次，之后每一轮只更新学习率、清零（或还原这个客户端的）状态，
+        和每轮新建一个优化器的结果一样，但不会每轮重新分配momentum/Adam的buffer
+        """
+        model = self.model
+        if self._optimizer is None and self.row_inputs is not None:
+            # 稀疏梯度的embedding要用支持稀疏梯度的优化器（SGD不能有weight_decay，Adam换成SparseAdam）
+            embeddings = [p for name, p in model.named_parameters() if name in self.row_inputs]
+            others = [p for name, p in model.named_parameters() if name not in self.row_inputs]
+            if self.optimizer == "sgd":
+                self._optimizer = OptimizerGroup([
+                    optim.SGD(embeddings, lr=self.lr, momentum=0.9),
+                    optim.SGD(others, lr=self.lr, momentum=0.9, weight_decay=3e-4)])
+            elif self.optimizer == "adam":
+                self._optimizer = OptimizerGroup([
+                    optim.SparseAdam(embeddings, lr=self.lr, betas=(0.9, 0.999)),
+                    optim.Adam(others, lr=self.lr, betas=(0.9, 0.999), weight_decay=0)])
+        elif self._optimizer is None:
+            if self.optimizer == "sgd":
+                self._optimizer = optim.SGD(model.parameters(), lr=self.lr, momentum=0.9, weight_decay=3e-4)
+                # optimizer.param_groups[0]["lr"]查看学习率大小
+                # sgd要写学习率衰减，但是adam中不用
+                # weight_decay就是正则化里的lambda
+                # 权重衰减（L2正则化）的作用
+            elif self.optimizer == "adam":
+                self._optimizer = optim.Adam(model.parameters(), lr=self.lr, betas=(0.9, 0.999), weight_decay=0)
+        optimizer = self._optimizer
+
+        if self.optimizer == "sgd":
+            for group in optimizer.param_groups:
+                group['lr'] = self.lr * self.lr_decay ** (round_th / self.decay_step)
+
+        if self.stateful_optimizer and self.optimizer_state is not None:
+            layout, flat = self.optimizer_state
+            load_optimizer_state(optimizer, layout, flat)
+        else:
+            reset_optimizer_state(optimizer)
+        return optimizer
 
     def train(self, round_th):
         """本地模型训练"""
         model = self.model
-        model.to(device=self.device)
+        self._prepare()
         model.train()  # 使用Dropout, BatchNorm
 
         # 把criterion放到model内比较好
         # criterion = nn.CrossEntropyLoss(reduction='mean').to(self.device)
 
-        if self.optimizer == "sgd":
-            optimizer = optim.SGD(model.parameters(),
-                                  lr=self.lr * self.lr_decay ** (round_th / self.decay_step),
-                                  momentum=0.9,
-                                  weight_decay=3e-4)
-            # optimizer.param_groups[0]["lr"]查看学习率大小
-            # sgd要写学习率衰减，但是adam中不用
-            # weight_decay就是正则化里的lambda
-            # 权重衰减（L2正则化）的作用
-        elif self.optimizer == "adam":
-            optimizer = optim.Adam(model.parameters(), lr=self.lr, betas=(0.9, 0.999), weight_decay=0)
+        optimizer = self._get_optimizer(round_th)
 
         batch_loss = []
+        # uint8图片等原始batch在device上再归一化（见client_dataset.to_device）
+        transform = getattr(self.train_dataloader, 'transform', None)
+        start = time.perf_counter()
         for epoch in range(self.epoch):
             for inputs, labels in self.train_dataloader:
-                inputs = inputs.to(self.device)
+                inputs = to_device(inputs, self.device, transform)
                 labels = labels.to(self.device)
                 optimizer.zero_grad()
                 outputs = model(inputs)
                 loss = model.cal_loss(outputs, labels)  # model内包含特定loss，如交叉熵，RMSE等
-                batch_loss.append(loss)
+                batch_loss.append(loss.detach())  # 不保留计算图，训练完的loss也可以被pickle回主进程
                 loss.backward()
                 optimizer.step()
                 # print(model.cpu().state_dict()['fc1.weight'].sum())
@@ -75,10 +190,26 @@ class Client:
 
         # 这个客户端上一个样本的平均loss
         sample_loss = sum(batch_loss) / len(batch_loss)
+        train_time = time.perf_counter() - start
 
         num_samples = self.train_dataloader.sampler.num_samples
 
-        return self.get_params(), num_samples, sample_loss
+        start = time.perf_counter()
+        params = self.get_params()
+        self.stats = {
+            'num_samples': num_samples,
+            'train_time': train_time,
+            'get_params_time': time.perf_counter() - start,
+            'samples_per_sec': num_samples * self.epoch / train_time,
+        }
+        if self.stateful_optimizer:
+            self.stats['optimizer_state'] = export_optimizer_state(optimizer)
+        if self.compressor is not None:
+            self.stats['compression_error'] = self.compression_error
+            if self.error_feedback:
+                self.stats['residual'] = self.residual
+
+        return params, num_samples, sample_loss
 
     def test(self, dataset: str):
         """在本地模型上对train和test数据集进行测试,返回准确率 + loss"""
@@ -96,26 +227,15 @@ class Client:
             exit()
 
         client_metrics = Metrics()
-
-        sample_nums_per_batch_list = []
-        total_loss_per_batch_list = []
+        transform = getattr(dataloader, 'transform', None)
 
         with torch.no_grad():
             for data in dataloader:
                 images, labels = data
-                images = images.to(self.device)
+                images = to_device(images, self.device, transform)
                 labels = labels.to(self.device)
                 output = model(images)
                 loss = model.cal_loss(output, labels)  # average loss per sample for this batch
-                _, predicted = torch.max(output.data, 1)
-
-                sample_nums_per_batch_list.append(labels.size(0))
-                total_loss_per_batch_list.append(loss * labels.size(0))
-
-                client_metrics.labels_list += (list(labels.cpu().numpy()))
-                client_metrics.predicted_list += (list(predicted.cpu().numpy()))
-                client_metrics.prob_list += list(output[:, 1].cpu().numpy())
+                client_metrics.update(output, labels, loss)
 
-        client_metrics.num = sum(sample_nums_per_batch_list)
-        client_metrics.loss = sum(total_loss_per_batch_list) / sum(sample_nums_per_batch_list)
         return client_metrics
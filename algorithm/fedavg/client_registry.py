@@ -0,0 +1,85 @@
+"""
+所有客户端的注册表（Server.clients）
+原来一开始就给client_num_in_total个客户端每个创建一个Client和它的dataloader，但每轮只有client_num_per_round个在训练，
+客户端数到10万以上时光这些对象就占很多内存。这里每个客户端只有ClientPartition里的紧凑元数据（下标区间/下标数组、样本数），
+被选中时才创建它的Client和dataloader，最近用过的cache_size个放在LRU缓存里，内存和活跃的客户端数成正比
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from algorithm.fedavg.client import Client
+
+
+class ClientRegistry:
+    def __init__(self, train, test, cache_size=128):
+        """
+        Args:
+            train, test: 每个客户端的训练/测试dataloader，ClientPartition或者dataloader列表（如DummyData）
+            cache_size: LRU缓存的客户端个数
+        """
+        if len(train) != len(test):
+            raise ValueError(f"{len(train)} train partitions but {len(test)} test partitions")
+        self.partitions = {'train': train, 'test': test}
+        self.cache_size = max(cache_size, 1)
+        self.cache = OrderedDict()  # client_id -> Client
+
+    def __len__(self):
+        return len(self.partitions['train'])
+
+    def __getitem__(self, client_id):
+        client_id = int(client_id)
+        client = self.cache.get(client_id)
+        if client is not None:
+            self.cache.move_to_end(client_id)
+            return client
+        client = Client(user_id=client_id,
+                        train_dataloader=self.partitions['train'][client_id],
+                        test_dataloader=self.partitions['test'][client_id])
+        self.cache[client_id] = client
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return client
+
+    def __iter__(self):
+        for client_id in range(len(self)):
+            yield self[client_id]
+
+    def num_samples(self, dataset='train'):
+        """每个客户端的样本数，不用创建dataloader"""
+        partition = self.partitions[dataset]
+        if hasattr(partition, 'sizes'):
+            return partition.sizes
+        return np.array([len(dataloader.dataset) for dataloader in partition], dtype=np.int64)
+
+
+if __name__ == '__main__':
+    # 100万个样本、10万个non-iid客户端：原来每个客户端一个Client + dataloader vs 注册表（每轮选100个客户端）
+    import os
+    import time
+    import torch
+    from data_preprocessing.client_dataset import index_datasets, index_partition, make_dataloader
+
+    def rss_mb():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+
+    num_samples, num_clients, per_round = 1000000, 100000, 100
+    rng = np.random.RandomState(0)
+    inputs = torch.as_tensor(rng.randint(6040, size=(num_samples, 2)))
+    labels = torch.as_tensor(rng.randint(2, size=num_samples))
+    client_indices = np.array_split(rng.permutation(num_samples), num_clients)
+
+    before, start = rss_mb(), time.perf_counter()
+    registry = ClientRegistry(index_partition(inputs, labels, client_indices, 64, shuffle=True),
+                              index_partition(inputs, labels, client_indices, 64, shuffle=False))
+    for round_th in range(10):
+        for client_id in rng.choice(num_clients, per_round, replace=False):
+            registry[client_id].train_dataloader.dataset.tensors()
+    print(f"registry: {time.perf_counter() - start:.2f}s, {rss_mb() - before:.1f} MB")
+
+    before, start = rss_mb(), time.perf_counter()
+    train = [make_dataloader(dataset, 64, shuffle=True) for dataset in index_datasets(inputs, labels, client_indices)]
+    test = [make_dataloader(dataset, 64, shuffle=False) for dataset in index_datasets(inputs, labels, client_indices)]
+    clients = [Client(user_id=i, train_dataloader=train[i], test_dataloader=test[i]) for i in range(num_clients)]
+    print(f"eager clients: {time.perf_counter() - start:.2f}s, {rss_mb() - before:.1f} MB")
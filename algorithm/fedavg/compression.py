@@ -0,0 +1,191 @@
+"""
+客户端上传的压缩：客户端不再上传完整的参数，而是上传本轮训练前后浮点参数的差（delta），可以再压缩成
+    delta: 不压缩的delta（float32）
+    topk:  只保留绝对值最大的k个元素（下标int32 + 值float32）
+    int8:  每chunk_size个元素一个float32的scale，元素量化成int8
+    sign:  只上传哪些元素非0（每个元素1 bit）、非0元素的符号（每个非0元素1 bit）和一个scale（非0元素|delta|的均值），
+           为0的元素（客户端没用到的embedding行、buffer的位置）解压后还是0，不会每轮都被推动±scale
+服务器不用先解压成完整的参数，直接把压缩后的delta加权累加到StreamingAggregator上（见aggregator.py）
+
+error feedback：有损压缩丢掉的部分（residual）留在客户端，下次被选中时加到delta上再压缩，
+这样被丢掉的更新不会真的丢失，sign和topk这种压缩率很高的方法一般都要配合使用
+sign不开error feedback也不会让参数漂移：没更新的元素解压后是0，更新了的元素方向对、
+所有非0元素的|delta|之和不变，只是每个元素的大小都变成了平均值
+"""
+import torch
+
+
+class CompressedDelta:
+    """
+    压缩后的delta，子类实现decompress、add_to和nbytes
+    other是非浮点buffer（如BatchNorm的num_batches_tracked），不压缩，按原来的方式聚合
+    """
+
+    def __init__(self, numel, other=None):
+        self.numel = numel
+        self.other = {} if other is None else other
+
+    def decompress(self):
+        raise NotImplementedError
+
+    def add_to(self, out, alpha=1.):
+        """out += alpha * delta，不需要得到完整的delta时子类可以直接累加"""
+        out.add_(self.decompress(), alpha=alpha)
+        return out
+
+    def payload_nbytes(self):
+        raise NotImplementedError
+
+    def nbytes(self):
+        return self.payload_nbytes() + sum(value.numel() * value.element_size() for value in self.other.values())
+
+    def cpu(self):
+        for key, value in self.__dict__.items():
+            if isinstance(value, torch.Tensor):
+                setattr(self, key, value.cpu())
+        self.other = {key: value.cpu() for key, value in self.other.items()}
+        return self
+
+
+class DenseDelta(CompressedDelta):
+    def __init__(self, values, other=None):
+        super().__init__(values.numel(), other)
+        self.values = values
+
+    def decompress(self):
+        return self.values
+
+    def payload_nbytes(self):
+        return self.values.numel() * self.values.element_size()
+
+
+class TopKDelta(CompressedDelta):
+    def __init__(self, numel, indices, values, other=None):
+        super().__init__(numel, other)
+        self.indices = indices
+        self.values = values
+
+    def decompress(self):
+        out = torch.zeros(self.numel, dtype=self.values.dtype, device=self.values.device)
+        out[self.indices.long()] = self.values
+        return out
+
+    def add_to(self, out, alpha=1.):
+        out.index_add_(0, self.indices.long(), self.values, alpha=alpha)
+        return out
+
+    def payload_nbytes(self):
+        return self.indices.numel() * self.indices.element_size() + self.values.numel() * self.values.element_size()
+
+
+class Int8Delta(CompressedDelta):
+    def __init__(self, numel, quantized, scales, other=None):
+        """quantized: (num_chunks, chunk_size)的int8，scales: (num_chunks,)"""
+        super().__init__(numel, other)
+        self.quantized = quantized
+        self.scales = scales
+
+    def decompress(self):
+        return (self.quantized.float() * self.scales[:, None]).reshape(-1)[:self.numel]
+
+    def payload_nbytes(self):
+        return self.quantized.numel() + self.scales.numel() * self.scales.element_size()
+
+
+_BIT_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+
+def pack_bits(bits):
+    """bool向量 -> 每8个一个uint8"""
+    padded = torch.zeros((bits.numel() + 7) // 8 * 8, dtype=torch.bool, device=bits.device)
+    padded[:bits.numel()] = bits
+    return (padded.view(-1, 8).to(torch.uint8) * _BIT_WEIGHTS.to(bits.device)).sum(dim=1).to(torch.uint8)
+
+
+def unpack_bits(packed, numel):
+    return ((packed[:, None] & _BIT_WEIGHTS.to(packed.device)) > 0).reshape(-1)[:numel]
+
+
+class SignDelta(CompressedDelta):
+    def __init__(self, numel, nonzero, positive, scale, other=None):
+        """
+        nonzero: 每个元素是否非0，打包成uint8；positive: 非0元素（按顺序）是否>0，打包成uint8；scale: 一个float32
+        """
+        super().__init__(numel, other)
+        self.nonzero = nonzero
+        self.positive = positive
+        self.scale = scale
+
+    def decompress(self):
+        nonzero = unpack_bits(self.nonzero, self.numel)
+        out = torch.zeros(self.numel, dtype=self.scale.dtype, device=self.scale.device)
+        positive = unpack_bits(self.positive, int(nonzero.sum()))
+        out[nonzero] = (positive.to(out.dtype) * 2 - 1) * self.scale
+        return out
+
+    def payload_nbytes(self):
+        return self.nonzero.numel() + self.positive.numel() + self.scale.element_size()
+
+
+class Compressor:
+    def __init__(self, method='delta', topk_ratio=0.01, chunk_size=2048):
+        """
+        Args:
+            method: delta/topk/int8/sign
+            topk_ratio: topk时保留的元素比例
+            chunk_size: int8量化时每多少个元素共用一个scale
+        """
+        if method not in ('delta', 'topk', 'int8', 'sign'):
+            raise ValueError(f"unknown compression method: {method}")
+        self.method = method
+        self.topk_ratio = topk_ratio
+        self.chunk_size = chunk_size
+
+    def compress(self, delta, other=None):
+        """delta: 展平的float32向量（可以在GPU上），返回的CompressedDelta和delta在同一个设备上"""
+        numel = delta.numel()
+        if self.method == 'delta':
+            return DenseDelta(delta.clone(), other)
+
+        if self.method == 'topk':
+            k = min(numel, max(1, int(numel * self.topk_ratio)))
+            _, indices = torch.topk(delta.abs(), k, sorted=False)
+            indices = indices.sort().values
+            index_dtype = torch.int32 if numel < 2 ** 31 else torch.int64
+            return TopKDelta(numel, indices.to(index_dtype), delta[indices], other)
+
+        if self.method == 'int8':
+            padded = torch.zeros((numel + self.chunk_size - 1) // self.chunk_size * self.chunk_size,
+                                 dtype=delta.dtype, device=delta.device)
+            padded[:numel] = delta
+            chunks = padded.view(-1, self.chunk_size)
+            scales = chunks.abs().amax(dim=1) / 127
+            scales[scales == 0] = 1.
+            quantized = torch.round(chunks / scales[:, None]).to(torch.int8)
+            return Int8Delta(numel, quantized, scales, other)
+
+        # sign：0单独标出来，scale只按非0元素算
+        nonzero = delta != 0
+        values = delta[nonzero]
+        scale = values.abs().mean() if values.numel() > 0 else torch.zeros((), dtype=delta.dtype, device=delta.device)
+        return SignDelta(numel, pack_bits(nonzero), pack_bits(values > 0), scale, other)
+
+    def compress_with_feedback(self, delta, residual=None, other=None):
+        """
+        error feedback：先把上次没传上去的residual加回来，再压缩，压缩丢掉的部分作为新的residual
+        Returns: (compressed, new_residual, relative_error)，relative_error = ||丢掉的部分|| / ||delta||
+        """
+        corrected = delta if residual is None else delta + residual.to(delta.device)
+        compressed = self.compress(corrected, other)
+        new_residual = corrected - compressed.decompress()
+        relative_error = (new_residual.norm() / corrected.norm().clamp_min(1e-12)).item()
+        return compressed, new_residual, relative_error
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    delta = torch.randn(6040 * 128 + 3883 * 128) * 1e-3
+    for method in ['delta', 'topk', 'int8', 'sign']:
+        compressed, residual, error = Compressor(method).compress_with_feedback(delta)
+        ratio = delta.numel() * 4 / compressed.nbytes()
+        print(f"{method:5s} ratio {ratio:7.1f}x, relative error {error:.3f}")
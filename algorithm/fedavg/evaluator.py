@@ -0,0 +1,100 @@
+"""
+全局模型在所有客户端上的评估
+评估的只是一个全局模型，所以没必要像训练那样一个客户端一个客户端地换数据、换参数：
+全局参数只加载一次，把所有客户端的数据拼起来按大batch前向，每个batch的结果直接累加进Metrics（见base.py），
+不保存每个样本的预测，也不用每个batch都同步一次loss
+拼起来的数据按客户端顺序排列，client_offsets[k]:client_offsets[k+1]是第k个客户端的样本，
+per_client=True时按它给每个样本标上client_id，Metrics里就有每个客户端的混淆矩阵
+"""
+import copy
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset, Subset
+
+from base import Metrics
+from data_preprocessing.client_dataset import IndexedDataset, ClientPartition, to_device
+
+
+def collect_tensors(dataloader, batch_size=4096):
+    """把一个客户端dataloader里的数据一次性取出来，返回(inputs, labels)两个tensor"""
+    dataset = dataloader.dataset
+    if isinstance(dataset, TensorDataset):
+        return dataset.tensors[0], dataset.tensors[1]
+    if isinstance(dataset, IndexedDataset):
+        return dataset.tensors()
+    if isinstance(dataset, Subset) and isinstance(dataset.dataset, TensorDataset):
+        index = torch.as_tensor(dataset.indices)
+        return dataset.dataset.tensors[0][index], dataset.dataset.tensors[1][index]
+    # MyDataset、non-iid时的[(sample, label), ...]等：顺序读一遍，不shuffle，不影响全局随机数
+    inputs, labels = [], []
+    for x, y in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+        inputs.append(torch.as_tensor(x))
+        labels.append(torch.as_tensor(y))
+    if len(inputs) == 0:
+        return None, None
+    return torch.cat(inputs), torch.cat(labels)
+
+
+class Evaluator:
+    def __init__(self, model, device='cuda', batch_size=4096):
+        """
+        Args:
+            model: 用来评估的模型（会deepcopy一份，不影响训练用的agent）
+            batch_size: 评估时的大batch
+        """
+        self.model = copy.deepcopy(model)
+        self.device = device
+        self.batch_size = batch_size
+        # dataset('train'/'test') -> (inputs, labels, transform, client_offsets)，客户端的数据不会变，只需要拼一次
+        # ClientPartition的数据不做transform（如uint8图片），每个batch放到device上之后再做
+        self.cache = {}
+
+    def _prepare(self, clients, dataset):
+        if dataset not in self.cache:
+            # ClientRegistry：直接从划分的元数据取出所有客户端的数据，不用一个一个客户端地创建dataloader
+            partition = getattr(clients, 'partitions', {}).get(dataset)
+            if isinstance(partition, ClientPartition):
+                client_offsets = partition.bounds - partition.bounds[0]
+                self.cache[dataset] = partition.tensors(raw=True) + (partition.transform, client_offsets)
+                return self.cache[dataset]
+            if partition is None:
+                partition = [client.train_dataloader if dataset == 'train' else client.test_dataloader
+                             for client in clients]
+            inputs_list, labels_list, nums = [], [], []
+            for dataloader in partition:
+                inputs, labels = collect_tensors(dataloader)
+                nums.append(0 if labels is None else len(labels))
+                if labels is not None:
+                    inputs_list.append(inputs)
+                    labels_list.append(labels)
+            client_offsets = np.concatenate(([0], np.cumsum(nums))).astype(np.int64)
+            self.cache[dataset] = (torch.cat(inputs_list), torch.cat(labels_list), None, client_offsets)
+        return self.cache[dataset]
+
+    def evaluate(self, global_params, clients, dataset='test', per_client=False):
+        """
+        per_client: 为True时返回的Metrics里还有每个客户端的混淆矩阵（client_nums、client_accuracy等）
+        """
+        inputs, labels, transform, client_offsets = self._prepare(clients, dataset)
+        total_num = len(labels)
+        client_offsets = torch.as_tensor(client_offsets)
+
+        model = self.model
+        model.load_state_dict(global_params)
+        model.to(self.device)
+        model.eval()
+
+        metrics = Metrics(num_clients=len(client_offsets) - 1 if per_client else None)
+        with torch.no_grad():
+            for start in range(0, total_num, self.batch_size):
+                end = min(start + self.batch_size, total_num)
+                x = to_device(inputs[start:end], self.device, transform)
+                y = labels[start:end].to(self.device)
+                output = model(x)
+                loss = model.cal_loss(output, y)  # average loss per sample for this batch
+                client_ids = None
+                if per_client:
+                    # 第i个样本属于满足 client_offsets[k] <= i < client_offsets[k+1] 的客户端k
+                    client_ids = torch.searchsorted(client_offsets, torch.arange(start, end), right=True) - 1
+                metrics.update(output, y, loss, client_ids=client_ids)
+        return metrics
@@ -0,0 +1,399 @@
+"""
+本地训练的执行器：serial（串行）、thread（线程池）、process（进程池）、socket（worker进程，通过socket通信，见transport.py）
+每个被选中的客户端放在自己的agent槽位上训练，槽位之间互不依赖，所以可以并行
+无论用哪种执行器，返回的updates顺序都和selected_clients_index一致，保证相同seed下结果可复现
+"""
+import os
+import copy
+import time
+import queue
+import functools
+import multiprocessing as mp
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import torch
+from tqdm import tqdm
+
+from data_preprocessing.client_dataset import TensorBatchLoader, IndexedDataset
+from algorithm.fedavg import transport
+from algorithm.fedavg.shared_params import SharedParams
+
+
+def local_shuffle_seed(seed, round_th, client_id):
+    """每一轮每个客户端一个固定的shuffle种子，和客户端在哪个线程/进程上训练无关"""
+    return (seed * 1000003 + round_th * 10007 + int(client_id)) % (2 ** 63)
+
+
+def train_agent(agent, global_params, round_th, shuffle_seed, client_id=None):
+    """
+    在一个agent槽位上完成一次本地训练，线程池和进程池都调用这个函数（进程池要求它能被pickle，所以放在模块顶层）
+    Returns: (local_params, train_data_num, sample_loss, stats)，stats是这次训练的耗时统计（见profiler.py）
+    """
+    sampler = getattr(agent.train_dataloader, 'sampler', None)
+    if isinstance(sampler, (torch.utils.data.RandomSampler, TensorBatchLoader)):
+        # 不用全局的torch RNG打乱数据，否则并行时各客户端抢同一个RNG，结果就不可复现了
+        sampler.generator = torch.Generator().manual_seed(shuffle_seed)
+    start = time.perf_counter()
+    agent.set_params(global_params)
+    set_params_time = time.perf_counter() - start
+    local_params, train_data_num, sample_loss = agent.train(round_th)
+    stats = dict(agent.stats, client_id=int(client_id) if client_id is not None else agent.user_id,
+                 set_params_time=set_params_time, sample_loss=float(sample_loss))
+    return local_params, train_data_num, sample_loss, stats
+
+
+# 每个任务里随客户端变化的agent属性；模型、优化器等留在worker里的agent上（见agent_template），不随任务发送
+CLIENT_FIELDS = ('user_id', 'train_dataloader', 'test_dataloader', 'optimizer_state', 'residual')
+
+
+def client_payload(agent):
+    """一个任务要发给worker的客户端部分：dataloader（数据集tensor只在第一次发送，之后只有这个客户端的下标）和状态"""
+    return tuple(getattr(agent, name) for name in CLIENT_FIELDS)
+
+
+def agent_template(agent):
+    """
+    发给每个worker一次的agent：模型、优化器和压缩的配置，不带客户端的数据和状态
+    所有槽位的agent除了CLIENT_FIELDS以外都一样（模型参数每个任务都会被set_params覆盖），所以worker上一个就够了
+    """
+    template = copy.copy(agent)
+    for name in CLIENT_FIELDS:
+        setattr(template, name, None)
+    return template
+
+
+def load_payload(agent, payload):
+    for name, value in zip(CLIENT_FIELDS, payload):
+        setattr(agent, name, value)
+    return agent
+
+
+class SerialExecutor:
+    """和原来一样，一个客户端接一个客户端地训练"""
+
+    num_workers = 1
+
+    def run(self, fn, tasks, callback=None):
+        results = []
+        for task in tqdm(tasks):
+            result = fn(*task)
+            if callback is None:
+                results.append(result)
+            else:
+                callback(result)
+        return results
+
+    def shutdown(self):
+        pass
+
+
+class ThreadExecutor:
+    """
+    线程池：torch的算子会释放GIL，所以CPU上多个小模型可以同时训练
+    torch.set_num_threads是进程级别的，run的时候把CPU核数平均分给每个worker，run完恢复原来的线程数，
+    不影响服务器在两轮之间的评估等
+    """
+
+    num_threads = None  # run时torch的线程数，None表示不改（进程池、socket的训练不在这个进程里）
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def run(self, fn, tasks, callback=None):
+        """
+        callback不为None时，每个结果按任务顺序交给callback处理后就丢掉（如流式聚合），不再保存所有结果
+        先完成的任务要等它前面的任务都完成后才会交给callback，这样累加顺序固定，结果可复现
+        """
+        if self.num_threads is None:
+            return self._run(fn, tasks, callback)
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            return self._run(fn, tasks, callback)
+        finally:
+            torch.set_num_threads(num_threads)
+
+    def _run(self, fn, tasks, callback):
+        futures = {self.pool.submit(fn, *task): i for i, task in enumerate(tasks)}
+        results = [None] * len(tasks)
+        next_index = 0
+        for future in tqdm(as_completed(futures), total=len(tasks)):
+            results[futures[future]] = future.result()
+            while callback is not None and next_index < len(tasks) and results[next_index] is not None:
+                callback(results[next_index])
+                results[next_index] = None
+                next_index += 1
+        return results if callback is None else []
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(ThreadExecutor):
+    """
+    进程池：每个worker进程只用 cpu_count // num_workers 个线程，避免多个进程互相抢核
+    全局模型和上传的参数都经过共享内存（见shared_params.py）：
+        - 每次run把global_params写进共享内存一次，任务里只带版本号，worker直接在共享内存上set_params，
+          广播的开销和worker数量无关
+        - 第k个任务训练完的参数拼进第k个共享槽位，返回的是槽位上的view，服务器在callback里直接从槽位累加
+    槽位按任务（agent槽位）而不是按worker分配，这样服务器仍然按任务顺序累加，结果和串行时一致
+    每个worker进程启动时收到一个agent_template，一直用它训练，任务里只有(fn, 槽位, 版本号, 客户端的dataloader和状态)，
+    不再pickle模型；dataloader里的数据集tensor在共享内存里，pickle的只是句柄和这个客户端的下标
+    """
+
+    def __init__(self, num_workers, device='cpu'):
+        self.num_workers = num_workers
+        self.device = device
+        self.shared = None
+        self.pool = None
+        self.global_params, self.version = None, None
+
+    def _start(self, template, num_slots, agent):
+        """第一次run时才知道模型的结构和每轮的任务数，这时再创建共享内存和进程池"""
+        self.shutdown()
+        self.shared = SharedParams(template, num_slots)
+        self.global_params = None
+        # cuda不能在fork出来的子进程里初始化
+        context = mp.get_context('spawn' if self.device == 'cuda' else None)
+        self.pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context,
+                                        initializer=_init_process_worker,
+                                        initargs=(self.shared, max(1, (os.cpu_count() or 1) // self.num_workers),
+                                                  agent_template(agent)))
+
+    def worker_tasks(self, fn, tasks, callback=None):
+        """把Server的任务换成发给worker进程的任务，需要时先启动进程池、发布新的全局参数"""
+        global_params = tasks[0][1]
+        if self.shared is None or self.shared.num_slots < len(tasks):
+            self._start(global_params, len(tasks), tasks[0][0])
+        # Server每次聚合都生成新的global_params，同一个对象不用再写一遍共享内存（异步模式每次只派发一个任务）
+        if global_params is not self.global_params:
+            self.global_params, self.version = global_params, self.shared.publish(global_params)
+        # 不用callback的结果会被调用者保留到之后（异步模式），不能放在下次run会覆盖的槽位里
+        return [(fn, k if callback is not None else None, self.version, client_payload(task[0])) + tuple(task[2:])
+                for k, task in enumerate(tasks)]
+
+    def run(self, fn, tasks, callback=None):
+        if len(tasks) == 0:
+            return []
+        return super().run(_run_shared, self.worker_tasks(fn, tasks, callback), callback)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+_process_shared = None
+_process_agent = None
+
+
+def _init_process_worker(shared, num_threads, agent):
+    global _process_shared, _process_agent
+    _process_shared = shared
+    _process_agent = agent
+    torch.set_num_threads(num_threads)
+
+
+def _run_shared(fn, slot, version, payload, *args):
+    """在worker进程里执行：用进程里的agent训练这个客户端，全局参数从共享内存读，训练完的参数写到共享槽位里"""
+    agent = load_payload(_process_agent, payload)
+    agent.params_out = None if slot is None else _process_shared.slots[slot]
+    return fn(agent, _process_shared.params(version), *args)
+
+
+def _dataset_tensors(dataloader):
+    """客户端数据集的底层tensor（所有客户端共用，训练中不会改变）"""
+    dataset = getattr(dataloader, 'dataset', None)
+    if isinstance(dataset, IndexedDataset):
+        return [dataset.inputs, dataset.labels]
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        return list(dataset.tensors)
+    return []
+
+
+# socket worker（每个连接一个线程）上的agent和最近收到的全局参数，loopback的worker是同一进程里的线程，所以用threading.local
+_socket_worker = threading.local()
+
+
+def _install_agent(agent):
+    _socket_worker.agent = agent
+    _socket_worker.params = None
+
+
+def _run_installed(fn, payload, version, global_params, *args):
+    """在socket worker里执行：global_params为None表示这个连接已经收到过这个版本的全局参数"""
+    if global_params is not None:
+        _socket_worker.params = (version, global_params)
+    elif _socket_worker.params is None or _socket_worker.params[0] != version:
+        raise RuntimeError(f"worker does not have global params version {version}")
+    return fn(load_payload(_socket_worker.agent, payload), _socket_worker.params[1], *args)
+
+
+class SocketExecutor(ThreadExecutor):
+    """
+    worker进程通过TCP或Unix socket连到服务器，服务器把任务发过去，worker训练完把结果发回来
+    每个worker连接由一个服务器线程负责收发，任务和结果的顺序处理和ThreadExecutor一样
+        - 每个连接第一次用时发一个agent_template（模型副本），worker一直用它训练，之后的任务不再带模型
+        - 全局参数每个版本每个连接只发一次，任务里只有版本号、客户端的dataloader（数据集tensor只发一次）和状态
+    address为loopback时worker是同一个进程里的线程，连接不经过socket（测试用）
+    worker也可以在别的机器上用 algorithm/fedavg/worker.py --address tcp://host:port 启动（设置spawn_workers=False）
+    连接建立后先用authkey双向认证（见transport.authenticate）；spawn的worker用随机生成的authkey，
+    外部worker要用和服务器相同的authkey启动。认证不加密，跨机器时只在可信的网络里用
+    """
+
+    def __init__(self, num_workers, address='tcp://127.0.0.1:0', device='cpu', spawn_workers=True, authkey=None):
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.free = queue.Queue()
+        self.processes, self.listener = [], None
+        self.versions = {}  # connection -> 这个连接上的worker最近收到的全局参数版本，不在里面表示还没装agent
+        self.version, self.global_params = 0, None
+        if address == 'loopback':
+            for _ in range(num_workers):
+                server_side, worker_side = transport.LoopbackConnection.pair()
+                threading.Thread(target=transport.serve, args=(worker_side,), daemon=True).start()
+                self.free.put(server_side)
+            return
+
+        if not authkey:
+            if not spawn_workers:
+                raise ValueError("external socket workers need an authkey (--worker_authkey or FEDPRO_AUTHKEY)")
+            authkey = os.urandom(32)
+        self.listener, self.address = transport.listen(address)
+        if spawn_workers:
+            context = mp.get_context('spawn' if device == 'cuda' else None)
+            num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+            for _ in range(num_workers):
+                process = context.Process(target=transport.run_worker, args=(self.address, num_threads, authkey),
+                                          daemon=True)
+                process.start()
+                self.processes.append(process)
+        else:
+            print(f"waiting for {num_workers} workers on {self.address}")
+        while self.free.qsize() < num_workers:
+            connection = transport.SocketConnection(self.listener.accept()[0])
+            try:
+                self.free.put(transport.authenticate(connection, authkey, server_side=True))
+            except (ConnectionError, OSError) as e:
+                print(f"rejected a worker connection: {e}")
+                connection.close()
+
+    def _request(self, connection, fn, args):
+        connection.send(transport.TASK, (fn, args))
+        msg_type, result = connection.recv()
+        if msg_type == transport.ERROR:
+            raise RuntimeError(f"worker failed:\n{result}")
+        return result
+
+    def _call(self, fn, version, global_params, agent, *args):
+        connection = self.free.get()
+        try:
+            if connection not in self.versions:
+                self._request(connection, _install_agent, (agent_template(agent),))
+                self.versions[connection] = None
+            # 客户端的数据集每轮都一样，每个连接只需要发一次
+            for dataloader in (agent.train_dataloader, agent.test_dataloader):
+                for tensor in _dataset_tensors(dataloader):
+                    connection.encoder.mark_static(tensor)
+            params = None if self.versions[connection] == version else global_params
+            result = self._request(connection, _run_installed, (fn, client_payload(agent), version, params) + args)
+            self.versions[connection] = version
+        finally:
+            self.free.put(connection)
+        return result
+
+    def run(self, fn, tasks, callback=None):
+        if len(tasks) == 0:
+            return []
+        # Server每次聚合都生成新的global_params，同一个对象就是同一个版本（异步模式每次只派发一个任务）
+        if tasks[0][1] is not self.global_params:
+            self.global_params, self.version = tasks[0][1], self.version + 1
+        tasks = [(self.version, task[1], task[0]) + tuple(task[2:]) for task in tasks]
+        return super().run(functools.partial(self._call, fn), tasks, callback)
+
+    def bytes_moved(self):
+        """所有连接上发送和接收的总字节数"""
+        connections = list(self.versions)
+        return sum(c.bytes_sent for c in connections), sum(c.bytes_received for c in connections)
+
+    def shutdown(self):
+        while not self.free.empty():
+            connection = self.free.get()
+            connection.send(transport.SHUTDOWN, None)
+            connection.close()
+        self.pool.shutdown()
+        for process in self.processes:
+            process.join()
+        if self.listener is not None:
+            self.listener.close()
+
+
+def get_executor(name='serial', num_workers=1, device='cpu', address='tcp://127.0.0.1:0', spawn_workers=True,
+                 authkey=None):
+    if name == 'serial' or (num_workers <= 1 and name != 'socket'):
+        return SerialExecutor()
+    elif name == 'thread':
+        return ThreadExecutor(num_workers)
+    elif name == 'process':
+        return ProcessExecutor(num_workers, device=device)
+    elif name == 'socket':
+        return SocketExecutor(num_workers, address=address, device=device, spawn_workers=spawn_workers,
+                              authkey=authkey)
+    raise ValueError(f"unknown executor: {name}")
+
+
+if __name__ == '__main__':
+    # ProcessExecutor真正训练客户端：每个任务pickle的字节数（发agent vs 只发客户端部分）和每轮耗时（对比串行）
+    import sys
+    from multiprocessing.reduction import ForkingPickler
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from algorithm.fedavg.client import Client
+    # worker进程的全局状态在包里的这个模块上（不是__main__），benchmark都用包里的类
+    from algorithm.fedavg.executor import SerialExecutor, ProcessExecutor, train_agent
+    from models.fedavg.movielens.mlp import MLP
+    from benchmarks.reference import run_agent_tasks
+    from benchmarks.synthetic import movielens_like, client_dataloaders
+
+    def benchmark(make_model, num_clients, num_rounds=3):
+        torch.manual_seed(0)
+        inputs, labels = movielens_like(num_clients * 200)
+        loaders = client_dataloaders(inputs, labels, num_clients, batch_size=64)
+        model = make_model()
+        size = sum(value.numel() * value.element_size() for value in model.state_dict().values()) / 2 ** 20
+        agents = [Client(user_id=None, model=make_model(), epoch=1, lr=1e-3, optimizer='adam', device='cpu')
+                  for _ in range(num_clients)]
+
+        def round_tasks(round_th):
+            global_params = {key: value.clone() for key, value in model.state_dict().items()}
+            for agent, loader in zip(agents, loaders):
+                agent.train_dataloader = agent.test_dataloader = loader
+            return [(agent, global_params, round_th, client_id, client_id) for client_id, agent in enumerate(agents)]
+
+        print(f"MLP {size:.1f} MB, {num_clients} clients/round:")
+        for name, executor, run in [('serial', SerialExecutor(), None), ('process x 2', ProcessExecutor(2), None),
+                                    ('process x 2 (agent per task)', ProcessExecutor(2), run_agent_tasks)]:
+            run = run or (lambda executor, *args: executor.run(*args))
+            run(executor, train_agent, round_tasks(0), lambda result: None)  # 预热：启动进程池
+            checksum, start = 0., time.perf_counter()
+            for round_th in range(1, num_rounds + 1):
+                run_tasks = round_tasks(round_th)
+                results = []
+                run(executor, train_agent, run_tasks, lambda result: results.append(float(result[0].flat.sum())))
+                checksum += sum(results)
+            cost = (time.perf_counter() - start) / num_rounds
+            message = f"    {name:28s}: {cost * 1000:6.0f} ms/round, checksum {checksum:.4f}"
+            if name == 'process x 2':
+                sent = [len(ForkingPickler.dumps(task)) for task in executor.worker_tasks(train_agent, run_tasks, 0)]
+                old = [len(ForkingPickler.dumps((train_agent, k, 0, task[0]) + task[2:]))
+                       for k, task in enumerate(run_tasks)]
+                message += f", pickled per task {sum(sent) / len(sent) / 1024:.1f} KB " \
+                           f"(sending the agent: {sum(old) / len(old) / 1024:.1f} KB)"
+            executor.shutdown()
+            print(message)
+
+    benchmark(MLP, num_clients=20)
+    benchmark(lambda: MLP(100000, 20000), num_clients=8)
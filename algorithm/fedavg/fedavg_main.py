@@ -9,6 +9,7 @@ import random
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
 from algorithm.fedavg.server import Server
+from algorithm.fedavg.async_server import AsyncServer
 
 
 def parse_args():
@@ -18,6 +19,9 @@ def parse_args():
         "dataset": 'movielens',
         "client_num_in_total": 200,
         "client_num_per_round": 40,
+        "client_cache_size": 1024,
+        "client_selection": 'uniform',
+        "selection_candidates": 0,
         "num_rounds": 500,
         "partition_method": 'homo',
         "client_optimizer": "adam",
@@ -30,6 +34,29 @@ def parse_args():
         "lr_decay": 0.996,
         "decay_step": 20,
         "early_stop": 50,
+        "executor": 'serial',
+        "num_workers": 1,
+        "eval_batch_size": 4096,
+        "worker_address": 'tcp://127.0.0.1:0',
+        "external_workers": False,
+        "worker_authkey": '',
+        "stateful_optimizer": False,
+        "compression": 'full',
+        "topk_ratio": 0.01,
+        "error_feedback": False,
+        "sparse_embedding": False,
+        "mode": 'sync',
+        "buffer_size": 10,
+        "staleness_exponent": 0.5,
+        "latency": 'none',
+        "latency_mean": 1.0,
+        "latency_sigma": 1.0,
+        "trace_file": '',
+        "trace_wandb": False,
+        "torch_profile_round": -1,
+        "checkpoint_dir": '',
+        "checkpoint_interval": 10,
+        "resume": '',
         "wandb_mode": 'run',
         "notes": 'neg2pos_1_test',
     }
@@ -69,6 +96,18 @@ def parse_args():
     parser.add_argument('--client_num_per_round', type=int, default=10, metavar='NN',
                         help='number of clients selected per round')
 
+    parser.add_argument('--client_cache_size', type=int, default=1024,
+                        help='number of recently selected clients whose dataloaders are kept, '
+                             'the others are created again when selected')
+
+    parser.add_argument('--client_selection', type=str, default='uniform',
+                        choices=['uniform', 'size', 'loss', 'power_of_choice'],
+                        help='uniform; size: weighted by number of samples; loss: weighted by samples x last '
+                             'training loss; power_of_choice: sample candidates by size, keep the highest loss')
+
+    parser.add_argument('--selection_candidates', type=int, default=0,
+                        help='power_of_choice: number of candidates (0: 2 x client_num_per_round)')
+
     parser.add_argument('--num_rounds', type=int, default=100, metavar='NR',
                         help='how many round of communications we should use')
 
@@ -113,6 +152,86 @@ def parse_args():
     parser.add_argument('--early_stop', help='stop training if your model stops improving for early_stop rounds',
                         type=int, default=50)
 
+    parser.add_argument('--executor', type=str, default='serial', choices=['serial', 'thread', 'process', 'socket'],
+                        help='how to run local training of the selected clients in one round')
+
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of threads/processes used to train clients concurrently')
+
+    parser.add_argument('--eval_batch_size', type=int, default=4096,
+                        help='batch size used when evaluating the global model on all clients')
+
+    parser.add_argument('--worker_address', type=str, default='tcp://127.0.0.1:0',
+                        help='socket executor: address the server listens on, tcp://host:port or unix:///path.sock')
+
+    parser.add_argument('--external_workers', action='store_true',
+                        help='socket executor: do not spawn workers, wait for num_workers started with '
+                             'algorithm/fedavg/worker.py --address ...')
+
+    parser.add_argument('--worker_authkey', type=str, default='',
+                        help='socket executor: shared secret workers must prove before any message is unpickled '
+                             '(default: env FEDPRO_AUTHKEY; random for spawned workers, required with '
+                             '--external_workers). Authentication only, traffic is not encrypted')
+
+    parser.add_argument('--stateful_optimizer', action='store_true',
+                        help='keep each client\'s local optimizer state (momentum / Adam moments) across rounds')
+
+    parser.add_argument('--compression', type=str, default='full',
+                        choices=['full', 'delta', 'topk', 'int8', 'sign'],
+                        help='what clients upload: full params, or the (compressed) delta from the global params')
+
+    parser.add_argument('--topk_ratio', type=float, default=0.01,
+                        help='fraction of delta entries kept by --compression topk')
+
+    parser.add_argument('--error_feedback', action='store_true',
+                        help='keep what compression dropped on each client and add it to the next upload')
+
+    parser.add_argument('--sparse_embedding', action='store_true',
+                        help='train id embeddings with sparse gradients, upload only the rows a client used '
+                             'and average each row over the clients that updated it (mlp/widedeep/fm)')
+
+    parser.add_argument('--mode', type=str, default='sync', choices=['sync', 'async'],
+                        help='sync: FedAvg rounds; async: buffered asynchronous (FedBuff) aggregation, '
+                             'client_num_per_round clients train concurrently in simulated time (they are '
+                             'actually trained one dispatch after another, the order and staleness come '
+                             'from the simulated latency)')
+
+    parser.add_argument('--buffer_size', type=int, default=10,
+                        help='async mode: aggregate every buffer_size client updates')
+
+    parser.add_argument('--staleness_exponent', type=float, default=0.5,
+                        help='async mode: an update is weighted by 1 / (1 + staleness) ** staleness_exponent')
+
+    parser.add_argument('--latency', type=str, default='none',
+                        choices=['none', 'constant', 'uniform', 'exponential', 'lognormal'],
+                        help='distribution of simulated per-client latency, used to report simulated time-to-accuracy '
+                             '(a simulated clock, not wall-clock time: clients are not trained concurrently)')
+
+    parser.add_argument('--latency_mean', type=float, default=1.0,
+                        help='mean simulated client latency in seconds')
+
+    parser.add_argument('--latency_sigma', type=float, default=1.0,
+                        help='sigma of the lognormal latency distribution')
+
+    parser.add_argument('--trace_file', type=str, default='',
+                        help='write per-round phase timings, samples/sec, bytes moved and peak RSS to this jsonl file')
+
+    parser.add_argument('--trace_wandb', action='store_true',
+                        help='also log the per-round profile to wandb')
+
+    parser.add_argument('--torch_profile_round', type=int, default=-1,
+                        help='record this round with torch.profiler (-1: disabled)')
+
+    parser.add_argument('--checkpoint_dir', type=str, default='',
+                        help='save a checkpoint (global params, round, RNG states, per-client state) to this folder '
+                             'every checkpoint_interval rounds, written in a background thread')
+
+    parser.add_argument('--checkpoint_interval', type=int, default=10,
+                        help='rounds between two checkpoints')
+
+    parser.add_argument('--resume', type=str, default='',
+                        help='continue from this checkpoint file (or checkpoint_dir), run with the same arguments')
+
     # use values from config dict by default
     parser.set_defaults(**config)
 
@@ -169,8 +288,10 @@ if __name__ == '__main__':
           f"lr:\t\t\t\t\t\t\t{args.lr}\n"
           f"optimizer:\t\t\t\t\t{args.client_optimizer}\n"
           f"device:\t\t\t\t\t\t{args.device}\n"
+          f"executor:\t\t\t\t\t{args.executor} x {args.num_workers}\n"
+          f"mode:\t\t\t\t\t\t{args.mode}\n"
           f"##################################################\n")
 
-    server = Server(args)
+    server = AsyncServer(args) if args.mode == 'async' else Server(args)
 
     server.federate()
@@ -0,0 +1,44 @@
+"""
+模拟客户端的训练+通信时间（单机上没有真实的设备差异，用一个随机模型代替）
+每个客户端有一个固定的平均耗时（设备快慢不同），每次训练的耗时再在这个平均值附近随机波动
+同步FedAvg每一轮的耗时是被选中客户端里最慢的那个，异步（FedBuff）模式按每个客户端各自的完成时间处理，
+这样就能在同一台机器上比较两种模式"达到某个准确率需要多少时间"
+"""
+import numpy as np
+
+
+class LatencyModel:
+    def __init__(self, num_clients, distribution='lognormal', mean=1.0, sigma=1.0, jitter=0.2, seed=0):
+        """
+        Args:
+            distribution: 客户端平均耗时的分布 constant/uniform/exponential/lognormal
+            mean: 所有客户端平均耗时的均值（秒）
+            sigma: lognormal的sigma，越大快慢客户端差得越多
+            jitter: 同一个客户端每次耗时的波动（lognormal的sigma）
+        """
+        rng = np.random.default_rng(seed)
+        if distribution == 'constant':
+            self.client_mean = np.full(num_clients, mean, dtype=np.float64)
+        elif distribution == 'uniform':
+            self.client_mean = rng.uniform(0, 2 * mean, size=num_clients)
+        elif distribution == 'exponential':
+            self.client_mean = rng.exponential(mean, size=num_clients)
+        elif distribution == 'lognormal':
+            # 均值为mean的lognormal
+            self.client_mean = rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, size=num_clients)
+        else:
+            raise ValueError(f"unknown latency distribution: {distribution}")
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed + 1)
+
+    def sample(self, client_id):
+        """这个客户端这一次训练+上传的耗时"""
+        return float(self.client_mean[int(client_id)] * self.rng.lognormal(-self.jitter ** 2 / 2, self.jitter))
+
+
+if __name__ == '__main__':
+    for distribution in ['constant', 'uniform', 'exponential', 'lognormal']:
+        model = LatencyModel(200, distribution)
+        rounds = [max(model.sample(c) for c in np.random.choice(200, 20, replace=False)) for _ in range(100)]
+        print(f"{distribution:12s} mean client latency {model.client_mean.mean():.2f}s, "
+              f"sync round (20 clients) {np.mean(rounds):.2f}s")
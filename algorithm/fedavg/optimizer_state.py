@@ -0,0 +1,124 @@
+"""
+本地优化器的状态（SGD的momentum_buffer、Adam的step/exp_avg/exp_avg_sq）
+默认每一轮都和新建一个优化器一样从0开始（FedAvg原来的做法），但不再每轮重新分配这些tensor，而是原地清零；
+打开stateful_optimizer时，每个客户端的状态在训练完后压成一个float32向量存在服务器上，下次选中这个客户端时再还原回去
+"""
+import torch
+
+
+def reset_optimizer_state(optimizer):
+    """原地清零，结果和新建一个优化器完全一样（第一次step时buffer=0 * momentum + grad）"""
+    for state in optimizer.state.values():
+        for key, value in state.items():
+            if isinstance(value, torch.Tensor):
+                value.zero_()
+            else:
+                state[key] = 0  # 如SparseAdam的step是python int
+
+
+class _GroupState:
+    """OptimizerGroup.state：按参数找到它所在的优化器的state"""
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    def __getitem__(self, p):
+        for optimizer in self.optimizers:
+            if any(p is q for q in _params(optimizer)):
+                return optimizer.state[p]
+        raise KeyError(p)
+
+    def values(self):
+        return [state for optimizer in self.optimizers for state in optimizer.state.values()]
+
+
+class OptimizerGroup:
+    """
+    几个优化器当作一个用，如稀疏梯度的embedding用SparseAdam、其他参数用Adam（见sparse_rows.py）
+    param_groups和state的用法和单个优化器一样，上面的reset/export/load都能直接用
+    """
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+        self.state = _GroupState(optimizers)
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+
+def _params(optimizer):
+    return [p for group in optimizer.param_groups for p in group['params']]
+
+
+def export_optimizer_state(optimizer):
+    """
+    把optimizer的状态展平成一个CPU上的float32向量
+    Returns: (layout, flat)，layout是[(参数序号, key, shape, dtype, kind), ...]，
+             kind是'tensor'、'sparse'（稀疏梯度时SGD的momentum_buffer）或'number'（SparseAdam的step）
+    """
+    params = _params(optimizer)
+    layout, values = [], []
+    for i, p in enumerate(params):
+        for key, value in sorted(optimizer.state[p].items()):
+            kind = 'number' if not isinstance(value, torch.Tensor) else 'sparse' if value.is_sparse else 'tensor'
+            value = torch.as_tensor(value)
+            if value.is_sparse:
+                value = value.to_dense()
+            layout.append((i, key, value.shape, value.dtype, kind))
+            values.append(value.detach().reshape(-1).float())
+    flat = torch.cat([value.cpu() for value in values]) if len(values) > 0 else torch.zeros(0)
+    return layout, flat
+
+
+def load_optimizer_state(optimizer, layout, flat):
+    """把export_optimizer_state得到的向量写回optimizer，optimizer的state还没有分配时按layout新建"""
+    params = _params(optimizer)
+    offset = 0
+    for i, key, shape, dtype, kind in layout:
+        numel = shape.numel()
+        value = flat[offset:offset + numel].view(shape)
+        offset += numel
+        state = optimizer.state[params[i]]
+        if kind == 'number':
+            state[key] = value.to(dtype).item()
+        elif kind == 'sparse':
+            # embedding的稀疏梯度只有第0维（行）是稀疏的
+            state[key] = value.to(device=params[i].device, dtype=dtype).to_sparse(sparse_dim=1)
+        elif isinstance(state.get(key), torch.Tensor):
+            state[key].copy_(value)
+        else:
+            device = params[i].device if len(shape) > 0 else 'cpu'  # Adam的step是CPU上的标量
+            state[key] = value.to(device=device, dtype=dtype).clone()
+
+
+class OptimizerStateStore:
+    """
+    client_id -> 这个客户端优化器状态展平后的float32向量
+    所有客户端的状态布局都一样，只保存一份layout
+    """
+
+    def __init__(self):
+        self.layout = None
+        self.states = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, client_id):
+        return self.states.get(int(client_id))
+
+    def put(self, client_id, layout, flat):
+        self.layout = layout
+        self.states[int(client_id)] = flat
+
+    def nbytes(self):
+        return sum(flat.numel() * flat.element_size() for flat in self.states.values())
@@ -0,0 +1,124 @@
+"""
+每一轮的性能统计：各阶段耗时（下发参数、本地训练、取回参数、聚合、评估）、每个客户端的训练速度(samples/sec)、
+传输的参数字节数、进程的峰值内存，每一轮写一行json到trace文件里（也可以同时记到wandb）
+另外可以指定某一轮用torch.profiler记录详细的算子耗时
+"""
+import os
+import json
+import time
+import resource
+import contextlib
+from collections import defaultdict
+
+import torch
+import wandb
+
+
+def params_nbytes(params):
+    """state_dict（或flat tensor、压缩后的CompressedDelta）占用的字节数"""
+    if hasattr(params, 'nbytes') and callable(params.nbytes):
+        return params.nbytes()
+    if isinstance(params, torch.Tensor):
+        return params.numel() * params.element_size()
+    return sum(value.numel() * value.element_size() for value in params.values())
+
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF):
+    # Linux上ru_maxrss的单位是KB
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+class RoundProfiler:
+    def __init__(self, trace_file='', use_wandb=False, torch_profile_round=-1, torch_profile_dir='./profiler'):
+        """
+        Args:
+            trace_file: 每一轮的统计写到这个jsonl文件，为空时不写文件
+            use_wandb: 同时用wandb.log记录每个阶段的耗时
+            torch_profile_round: 用torch.profiler记录这一轮，-1表示不记录
+            torch_profile_dir: torch.profiler的chrome trace保存的文件夹
+        """
+        self.trace_file = trace_file
+        self.use_wandb = use_wandb
+        self.torch_profile_round = torch_profile_round
+        self.torch_profile_dir = torch_profile_dir
+        self.enabled = bool(trace_file) or use_wandb or torch_profile_round >= 0
+        self.round_th = None
+        self.record = None
+        if self.trace_file:
+            os.makedirs(os.path.dirname(os.path.abspath(self.trace_file)), exist_ok=True)
+
+    def start_round(self, round_th):
+        self.round_th = round_th
+        self.record = {
+            'round': round_th,
+            'phases': defaultdict(float),  # 阶段 -> 秒
+            'clients': [],
+            'bytes': defaultdict(int),  # 'broadcast'/'upload' -> 字节数
+        }
+        self._round_start = time.perf_counter()
+        return self
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.record is not None:
+                self.record['phases'][name] += time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def torch_profile(self, round_th):
+        """只在指定的那一轮打开torch.profiler"""
+        if round_th != self.torch_profile_round:
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+            yield
+        os.makedirs(self.torch_profile_dir, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.torch_profile_dir, f'round_{round_th}.json'))
+        print(prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+
+    def add_bytes(self, name, nbytes):
+        if self.record is not None:
+            self.record['bytes'][name] += nbytes
+
+    def record_client(self, stats):
+        """
+        stats: 客户端训练时统计的信息，见executor.train_agent，
+        如 {'client_id', 'num_samples', 'set_params_time', 'train_time', 'get_params_time', 'samples_per_sec'}
+        """
+        if self.record is None:
+            return
+        self.record['clients'].append(stats)
+        for phase in ['set_params', 'train', 'get_params']:
+            self.record['phases'][f'client_{phase}'] += stats.get(f'{phase}_time', 0.)
+
+    def end_round(self):
+        if self.record is None or not self.enabled:
+            return None
+        record = self.record
+        record['phases'] = dict(record['phases'])
+        record['bytes'] = dict(record['bytes'])
+        record['round_time'] = time.perf_counter() - self._round_start
+        record['peak_rss'] = peak_rss_bytes()
+        record['peak_rss_children'] = peak_rss_bytes(resource.RUSAGE_CHILDREN)
+        if record['bytes'].get('upload', 0) > 0 and 'upload_uncompressed' in record['bytes']:
+            record['compression_ratio'] = record['bytes']['upload_uncompressed'] / record['bytes']['upload']
+        if len(record['clients']) > 0:
+            record['samples_per_sec'] = sum(c['samples_per_sec'] for c in record['clients']) / len(record['clients'])
+
+        if self.trace_file:
+            with open(self.trace_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.use_wandb:
+            log = {f"Profile/{name}_time": cost for name, cost in record['phases'].items()}
+            log.update({f"Profile/{name}_bytes": nbytes for name, nbytes in record['bytes'].items()})
+            log.update({"Profile/round_time": record['round_time'], "Profile/peak_rss": record['peak_rss'],
+                        "round": self.round_th})
+            wandb.log(log)
+        self.record = None
+        return record
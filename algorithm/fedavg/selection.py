@@ -0,0 +1,267 @@
+"""
+客户端选择
+每一轮用自己的np.random.Generator（由seed和轮数生成），不碰全局的np.random：
+同一个seed、同一轮选出来的客户端总是一样的，和其他地方用了多少随机数无关，续训时也不用保存选择用的随机数状态
+策略：
+    - uniform：均匀地不放回抽样
+    - size：按样本数加权的不放回抽样
+    - loss：按 样本数 x 最近一次的训练loss 加权（loss大的客户端更容易被选中），没训练过的客户端按已知的最大loss算
+    - power_of_choice：先按样本数抽candidates个候选，再从中选最近一次loss最大的k个（没训练过的优先），
+      loss用的是客户端上次训练时报告的loss，不额外评估
+加权的不放回抽样 = 有放回地按权重抽，重复的跳过（逐个不放回抽样）：
+权重放在树状数组（FenwickTree）里，第一次用时建树（O(n)），之后一个客户端的loss变了只改O(log n)个节点，
+每次抽样在树上按前缀和往下找，选k个客户端是O(k log n)，候选太少、要选的太多时（重复太多）换成Gumbel-top-k（O(n)）
+loss策略里没训练过的客户端的权重 = 样本数 x 已知的最大loss，最大loss一变所有这些权重都变，
+所以它们单独放一棵按样本数的树，抽样时整棵树乘上最大loss，最大loss用一个懒删除的堆维护
+"""
+import heapq
+
+import numpy as np
+
+STRATEGIES = ['uniform', 'size', 'loss', 'power_of_choice']
+
+
+class FenwickTree:
+    """树状数组：单点修改O(log n)，按前缀和查找（find）对一批随机数一起往下走，O(log n)次numpy操作"""
+
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float64)
+        self.n = len(self.values)
+        cdf = np.concatenate(([0.], np.cumsum(self.values)))
+        index = np.arange(1, self.n + 1)
+        self.tree = np.zeros(self.n + 1)
+        self.tree[1:] = cdf[index] - cdf[index - (index & -index)]  # 节点i管(i - lowbit(i), i]
+        self.total = float(cdf[-1])
+        self.positive = int(np.count_nonzero(self.values > 0))
+        self.top = 1 << (self.n.bit_length() - 1) if self.n > 0 else 0
+
+    def update(self, i, value):
+        delta = value - self.values[i]
+        self.positive += int(value > 0) - int(self.values[i] > 0)
+        self.values[i] = value
+        self.total += delta
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, u):
+        """对每个u返回最小的i，使values[:i + 1]的和 > u（u在[0, total)里时就是按权重抽到的下标）"""
+        pos, u = np.zeros(len(u), dtype=np.int64), np.array(u, dtype=np.float64)
+        step = self.top
+        while step > 0:
+            nxt = pos + step
+            move = nxt <= self.n
+            move[move] = self.tree[nxt[move]] <= u[move]
+            u[move] -= self.tree[nxt[move]]
+            pos[move] = nxt[move]
+            step >>= 1
+        return np.minimum(pos, self.n - 1)
+
+
+class ClientSelector:
+    def __init__(self, num_clients, strategy='uniform', seed=0, num_samples=None, candidates=0):
+        """
+        Args:
+            num_samples: 每个客户端的样本数（size、loss、power_of_choice用）
+            candidates: power_of_choice的候选数，0表示选k个时抽2k个候选
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"unknown client selection strategy: {strategy}, choose from {STRATEGIES}")
+        if strategy != 'uniform' and num_samples is None:
+            raise ValueError(f"client selection '{strategy}' needs the number of samples of each client")
+        self.num_clients = num_clients
+        self.strategy = strategy
+        self.seed = seed
+        self.candidates = candidates
+        self.num_samples = None if num_samples is None else np.asarray(num_samples, dtype=np.float64)
+        # 每个客户端最近一次训练的loss，nan表示还没训练过
+        self.losses = np.full(num_clients, np.nan)
+        self._trees = None  # 见_table，第一次抽样时创建
+        self._max_loss = []  # loss策略：(-loss, client_id)的堆，过期的（客户端后来又报告了别的loss）取最大值时才删
+
+    def rng(self, round_th):
+        """第round_th轮的随机数生成器，只由seed和round_th决定"""
+        return np.random.default_rng([self.seed, round_th])
+
+    def update(self, client_id, loss):
+        """客户端训练完后报告它的loss，loss策略下只改树上O(log n)个节点"""
+        client_id, loss = int(client_id), float(loss)
+        self.losses[client_id] = loss
+        if self.strategy != 'loss':
+            return
+        seen = not np.isnan(loss)
+        if seen:
+            heapq.heappush(self._max_loss, (-loss, client_id))
+            if len(self._max_loss) > 2 * self.num_clients + 1024:
+                self._rebuild_max_loss()
+        if self._trees is not None:
+            trained, untrained = self._trees
+            trained.update(client_id, self.num_samples[client_id] * loss if seen else 0.)
+            untrained.update(client_id, 0. if seen else self.num_samples[client_id])
+
+    def _rebuild_max_loss(self):
+        seen = np.flatnonzero(~np.isnan(self.losses))
+        self._max_loss = list(zip(-self.losses[seen], seen.tolist()))
+        heapq.heapify(self._max_loss)
+
+    def default_loss(self):
+        """loss策略里没训练过的客户端用的loss：已知的最大loss，还没有时为1"""
+        while self._max_loss and -self._max_loss[0][0] != self.losses[self._max_loss[0][1]]:
+            heapq.heappop(self._max_loss)
+        return -self._max_loss[0][0] if self._max_loss else 1.
+
+    def state_dict(self):
+        return {'losses': self.losses.copy()}
+
+    def load_state_dict(self, state):
+        self.losses = state['losses'].copy()
+        self._trees = None
+        self._rebuild_max_loss()
+
+    def weights(self):
+        if self.strategy == 'uniform':
+            return None
+        if self.strategy == 'loss':
+            seen = ~np.isnan(self.losses)
+            return self.num_samples * np.where(seen, self.losses, self.default_loss())
+        return self.num_samples  # size、power_of_choice的候选
+
+    def _table(self):
+        """
+        (训练过的客户端的权重树, 没训练过的客户端的样本数树)，后者的权重要乘上default_loss()
+        size、power_of_choice的权重不变，只有第一棵树
+        """
+        if self._trees is None:
+            if self.strategy == 'loss':
+                seen = ~np.isnan(self.losses)
+                self._trees = (FenwickTree(np.where(seen, self.num_samples * np.nan_to_num(self.losses), 0.)),
+                               FenwickTree(np.where(seen, 0., self.num_samples)))
+            else:
+                self._trees = (FenwickTree(self.num_samples), None)
+        return self._trees
+
+    def _draw(self, rng, m):
+        """有放回地按权重抽m个客户端"""
+        trained, untrained = self._table()
+        if untrained is None:
+            return trained.find(rng.random(m) * trained.total)
+        default = self.default_loss()
+        u = rng.random(m) * (trained.total + default * untrained.total)
+        chosen = np.empty(m, dtype=np.int64)
+        first = u < trained.total
+        chosen[first] = trained.find(u[first])
+        # default为0时u都小于trained.total，~first是空的
+        chosen[~first] = untrained.find((u[~first] - trained.total) / max(default, 1e-300))
+        return chosen
+
+    def select(self, round_th, k, exclude=None):
+        """
+        第round_th轮选k个客户端（可用的不够k个时全选）
+        Args:
+            exclude: 不能选的客户端（如异步模式下还在训练的）
+        Returns: 选中的client_id数组，按抽到的顺序
+        """
+        rng = self.rng(round_th)
+        exclude = np.zeros(0, dtype=np.int64) if exclude is None else np.fromiter(exclude, dtype=np.int64)
+        if self.strategy == 'power_of_choice':
+            d = max(self.candidates if self.candidates > 0 else 2 * k, k)
+            candidates = self._sample(rng, d, exclude)
+            # 没训练过的客户端loss当作inf，排在最前面；loss相同时保持抽到的顺序
+            losses = np.nan_to_num(self.losses[candidates], nan=np.inf)
+            return candidates[np.argsort(-losses, kind='stable')[:k]]
+        return self._sample(rng, k, exclude)
+
+    def _sample(self, rng, k, exclude):
+        """按权重（uniform时均匀）不放回地抽k个不在exclude里的客户端"""
+        if self.strategy == 'uniform':
+            available = self.num_clients - len(exclude)
+            positive = lambda ids: np.ones(len(ids), dtype=bool)
+        else:
+            trained, untrained = self._table()
+            if untrained is None:
+                positive = lambda ids: trained.values[ids] > 0
+                available = trained.positive
+            else:
+                positive = lambda ids: (trained.values[ids] > 0) | ((untrained.values[ids] > 0) &
+                                                                    (self.default_loss() > 0))
+                available = trained.positive + (untrained.positive if self.default_loss() > 0 else 0)
+            available -= np.count_nonzero(positive(exclude))
+        k = min(k, available)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        # 要选的超过可选的一半时重复太多，直接用Gumbel-top-k
+        if 2 * k <= available:
+            if self.strategy == 'uniform':
+                draw = lambda m: rng.integers(self.num_clients, size=m)
+            else:
+                draw = lambda m: self._draw(rng, m)
+            chosen = np.zeros(0, dtype=np.int64)
+            for _ in range(16):
+                batch = draw(2 * (k - len(chosen)) + 16)
+                # 同一批里重复的只留第一次出现的，已经选过、不能选的、（浮点误差落到）权重为0的跳过
+                _, first = np.unique(batch, return_index=True)
+                batch = batch[np.sort(first)]
+                batch = batch[~np.isin(batch, np.concatenate((chosen, exclude))) & positive(batch)]
+                chosen = np.concatenate((chosen, batch[:k - len(chosen)]))
+                if len(chosen) == k:
+                    return chosen
+        return self._gumbel_top_k(rng, k, self.weights(), exclude)
+
+    def _gumbel_top_k(self, rng, k, weights, exclude):
+        """log(权重) + Gumbel噪声最大的k个，和按权重逐个不放回抽样同分布"""
+        with np.errstate(divide='ignore'):
+            keys = rng.gumbel(size=self.num_clients) + (0. if weights is None else np.log(weights))
+        keys[exclude] = -np.inf
+        top = np.argpartition(-keys, k - 1)[:k]
+        return top[np.argsort(-keys[top], kind='stable')]
+
+
+if __name__ == '__main__':
+    # 每轮从n个客户端里选100个：原来的np.random.seed + np.random.choice（不放回时要把n个全排列一遍）vs ClientSelector
+    import time
+
+    for n in [10000, 1000000, 10000000]:
+        sizes = np.random.RandomState(0).randint(1, 500, size=n)
+        start = time.perf_counter()
+        for round_th in range(10):
+            np.random.seed(42 + round_th)
+            np.random.choice(n, size=100, replace=False)
+        legacy = (time.perf_counter() - start) / 10
+        costs = []
+        for strategy in STRATEGIES:
+            selector = ClientSelector(n, strategy, seed=42, num_samples=sizes)
+            selector.select(0, 100)  # 第一次会算权重的前缀和
+            start = time.perf_counter()
+            for round_th in range(1, 11):
+                selected = selector.select(round_th, 100, exclude={0, 1, 2})
+                assert len(np.unique(selected)) == 100
+            costs.append(f"{strategy} {(time.perf_counter() - start) / 10 * 1000:.2f}ms")
+        print(f"n={n:>8d}: np.random.choice {legacy * 1000:.2f}ms, " + ', '.join(costs))
+
+    # size加权抽样的经验频率应该和不放回抽样的理论值一致：用精确的Gumbel-top-k对比
+    selector = ClientSelector(20, 'size', seed=0, num_samples=np.arange(1, 21))
+    counts, gumbel_counts = np.zeros(20), np.zeros(20)
+    for round_th in range(20000):
+        counts[selector.select(round_th, 5)] += 1
+        gumbel_counts[selector._gumbel_top_k(selector.rng(round_th), 5, selector.num_samples, [])] += 1
+    print("size-weighted selection frequency (sampler vs gumbel-top-k):")
+    print(np.round(counts / 20000, 3))
+    print(np.round(gumbel_counts / 20000, 3))
+
+    # loss加权：树建好之后再update（包括新训练过的客户端和改变最大loss的客户端），抽样频率应该和按新权重的Gumbel-top-k一致
+    selector = ClientSelector(20, 'loss', seed=0, num_samples=np.arange(1, 21))
+    selector.select(0, 5)  # 先建树
+    for client_id, loss in [(0, 0.5), (3, 2.0), (7, 0.1), (3, 0.3), (19, 0.05), (12, 1.2)]:
+        selector.update(client_id, loss)
+    assert selector.default_loss() == 1.2  # client 3的2.0已经过期
+    trained, untrained = selector._table()
+    assert np.isclose(trained.total + selector.default_loss() * untrained.total, selector.weights().sum())
+    counts, gumbel_counts = np.zeros(20), np.zeros(20)
+    for round_th in range(20000):
+        counts[selector.select(round_th, 5)] += 1
+        gumbel_counts[selector._gumbel_top_k(selector.rng(round_th), 5, selector.weights(), [])] += 1
+    print("loss-weighted selection frequency after update() (sampler vs gumbel-top-k):")
+    print(np.round(counts / 20000, 3))
+    print(np.round(gumbel_counts / 20000, 3))
+    assert np.abs(counts - gumbel_counts).max() / 20000 < 0.02
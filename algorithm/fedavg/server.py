@@ -1,19 +1,22 @@
 import wandb
+import os
 import copy
 import numpy as np
 from algorithm.fedavg.client import Client
-from base import Metrics
-
-from tqdm import tqdm
-from sklearn.metrics import accuracy_score
-from sklearn.metrics import precision_score
-from sklearn.metrics import recall_score
-from sklearn.metrics import f1_score
-from sklearn.metrics import roc_auc_score
+from algorithm.fedavg.client_registry import ClientRegistry
+from algorithm.fedavg.executor import get_executor, train_agent, local_shuffle_seed
+from algorithm.fedavg.aggregator import StreamingAggregator, FlatParams, state_buffer_keys
+from algorithm.fedavg.compression import Compressor
+from algorithm.fedavg.evaluator import Evaluator
+from algorithm.fedavg.profiler import RoundProfiler, params_nbytes
+from algorithm.fedavg.optimizer_state import OptimizerStateStore
+from algorithm.fedavg.latency import LatencyModel
+from algorithm.fedavg.selection import ClientSelector
+from algorithm.fedavg.checkpoint import Checkpointer, load_checkpoint, snapshot_params, get_rng_state, set_rng_state
 
 from data_preprocessing.dummy_data import DummyData
 from data_preprocessing.mnist.data_loader import partition_data as partition_data_mnist
-from data_preprocessing.movielens.ctr.data_loader import partition_data as partition_data_movielens
+from data_preprocessing.movielens.ctr.data_loader import partition_data as partition_data_movielens, ctr_field_spec
 from models.fedavg.mnist.cnn import CNN
 from models.fedavg.movielens.mlp import MLP
 from models.fedavg.movielens.fm import FM
@@ -27,6 +30,11 @@ class Server:
         self.dataset = args.dataset
         self.client_num_in_total = args.client_num_in_total
         self.client_num_per_round = args.client_num_per_round
+        self.client_cache_size = args.client_cache_size
+        # 客户端选择策略（见selection.py），用自己的随机数生成器，不影响全局的np.random
+        self.client_selection = args.client_selection
+        self.selection_candidates = args.selection_candidates
+        self.selector = None
         self.num_rounds = args.num_rounds
         self.partition_method = args.partition_method
         self.lr = args.lr
@@ -39,27 +47,65 @@ class Server:
         self.lr_decay = args.lr_decay
         self.decay_step = args.decay_step
         self.early_stop = args.early_stop
-
-        self.clients: list = None
+        self.eval_batch_size = args.eval_batch_size
+        self.executor_name = args.executor
+        self.num_workers = args.num_workers
+        self.worker_address = args.worker_address
+        self.external_workers = args.external_workers
+        self.worker_authkey = args.worker_authkey or os.environ.get('FEDPRO_AUTHKEY', '')
+        self.stateful_optimizer = args.stateful_optimizer
+        self.optimizer_states = OptimizerStateStore()
+        # 上传压缩，'full'表示和原来一样上传完整参数
+        self.compressor = None if args.compression == 'full' else Compressor(args.compression, topk_ratio=args.topk_ratio)
+        self.error_feedback = args.error_feedback
+        self.residuals = {}  # client_id -> error feedback的residual
+        # embedding按行稀疏训练和上传，聚合时每一行只在更新过它的客户端之间平均
+        self.sparse_embedding = args.sparse_embedding
+        if self.sparse_embedding and self.compressor is not None:
+            raise ValueError("--sparse_embedding uploads row deltas itself, use it with --compression full")
+        self.row_inputs = None
+        # --resample_negatives（data_loader的参数）：movielens训练集的负样本每轮重新采样，见NegativeResampler
+        self.negative_resampler = None
+        # 模拟的客户端耗时，用来比较同步和异步模式的time-to-accuracy
+        self.latency_distribution = args.latency
+        self.latency_mean = args.latency_mean
+        self.latency_sigma = args.latency_sigma
+        self.latency = None
+        self.sim_time = 0.
+        self.profiler = RoundProfiler(trace_file=args.trace_file, use_wandb=args.trace_wandb,
+                                      torch_profile_round=args.torch_profile_round)
+        # 每隔checkpoint_interval轮在后台保存一次checkpoint，resume不为空时从这个checkpoint继续
+        self.checkpointer = Checkpointer(args.checkpoint_dir, interval=args.checkpoint_interval)
+        self.resume = args.resume
+
+        self.clients: ClientRegistry = None
         self.agents: list = None
         self.model = None
         self.global_params = None
+        self.executor = None
+        self.aggregator = None
+        self.evaluator = None
 
     @staticmethod
-    def _select_model(model_name):
+    def _select_model(model_name, sparse=False):
+        """sparse: embedding使用稀疏梯度（只对mlp、widedeep、fm有效）"""
         model = None
         if model_name == 'cnn':
             model = CNN()
         elif model_name == 'mlp':
-            # user_id, movie_id进行embedding的网络模型
-            model = MLP()
+            # user_id, movie_id进行embedding的网络模型，embedding的行数是数据里的user、movie个数
+            user_num, movie_num = ctr_field_spec()[0][:2]
+            model = MLP(user_num, movie_num, sparse=sparse)
         elif model_name == 'widedeep':
-            model = WideDeep()
+            user_num, movie_num = ctr_field_spec()[0][:2]
+            model = WideDeep(user_num, movie_num, sparse=sparse)
         elif model_name == 'fm':
-            model = FM(n=4, k=10)
+            # 每个field（--ctr_fields）一个embedding，直接在field的隐向量上做FM
+            field_dims, multi_hot = ctr_field_spec()
+            model = FM(k=10, field_dims=field_dims, multi_hot=multi_hot, sparse=sparse)
         elif model_name == 'lr':
             # 针对ctr数据集的lr
-            model = LR()
+            model = LR(*ctr_field_spec()[0][:2])
         return model
 
     # TODO: load data
@@ -73,28 +119,20 @@ class Server:
                                                                      self.client_num_in_total,
                                                                      self.batch_size)
         elif self.dataset == "movielens":
-            train_dataloader, test_dataloader = partition_data_movielens(self.partition_method,
-                                                                         self.client_num_in_total,
-                                                                         self.batch_size)
+            train_dataloader, test_dataloader, self.negative_resampler = partition_data_movielens(
+                self.partition_method, self.client_num_in_total, self.batch_size, return_resampler=True)
         datasets['train'], datasets['test'] = train_dataloader, test_dataloader
         return datasets
 
     def _select_clients(self, round_th):
-        np.random.seed(seed=self.seed + round_th)
-        selected_clients_index = np.random.choice(self.client_num_in_total,
-                                                  size=self.client_num_per_round,
-                                                  replace=False)
+        selected_clients_index = self.selector.select(round_th, self.client_num_per_round)
         return selected_clients_index
 
     def _setup_clients(self, datasets=None):
         # setup all clients (actually we just want to store the data into client)
         # 这里不需要传递epoch,lr,model_name，因为这些每个客户端是一样的，我只要在agent里设置就行了
-        train_dataloader, test_dataloader = datasets['train'], datasets['test']
-        clients = [
-            Client(user_id=i,
-                   train_dataloader=train_dataloader[i],
-                   test_dataloader=test_dataloader[i])
-            for i in np.arange(self.client_num_in_total)]
+        # 客户端的Client和dataloader在被选中时才创建，最近用过的放在LRU缓存里（见client_registry.py）
+        clients = ClientRegistry(datasets['train'], datasets['test'], cache_size=self.client_cache_size)
         return clients
 
     def _setup_agents(self):
@@ -102,102 +140,116 @@ class Server:
         Your can use only one model to train. The only thing you need to is update the datasets and parameters for this each client
         Also you can define num_per_round models and use multiprocessing to speed up training if you want.
         """
+        # 串行训练时所有槽位共用一个模型；并行训练时每个槽位要有自己的模型副本，否则会互相覆盖参数
+        parallel = self.executor.num_workers > 1
         # Client need to update the dataset and params
         agent = [Client(user_id=i, train_dataloader=None, test_dataloader=None,
-                        model=self.model, epoch=self.epoch, lr=self.lr, lr_decay=self.lr_decay,
+                        model=copy.deepcopy(self.model) if parallel else self.model,
+                        epoch=self.epoch, lr=self.lr, lr_decay=self.lr_decay,
                         decay_step=self.decay_step, optimizer=self.optimizer,
-                        device=self.device)
+                        device=self.device, stateful_optimizer=self.stateful_optimizer,
+                        compressor=self.compressor, error_feedback=self.error_feedback,
+                        row_inputs=self.row_inputs)
                  for i in range(self.client_num_per_round)]
         # print(agent[0].model)
         return agent
 
-    def _aggregate_and_update_global_params(self, updates):
-        n = sum([n_k for (params, n_k) in updates])
-
-        new_params = updates[0][0]
-        for key in updates[0][0].keys():  # key: cov1.weight, cov1.bias...
-            for i in range(len(updates)):
-                client_params, n_k = updates[i]
-                if i == 0:
-                    new_params[key] = (client_params[key] * n_k).true_divide(n)
-                else:
-                    new_params[key] += (client_params[key] * n_k).true_divide(n)
-
-        self.global_params = new_params
+    def _aggregate_and_update_global_params(self, aggregator):
+        # 客户端的参数在训练完时已经流式累加到aggregator里了，这里只需要除以总样本数
+        self.global_params = aggregator.result()
         return self
 
-    def _train_on_clients(self, round_th, updates=[]):
+    def _make_tasks(self, clients_index, round_th, seed_round=None):
+        """
+        把clients_index中的客户端依次放到agent槽位上，返回executor要执行的任务
+        seed_round: 用来生成shuffle种子的"轮数"，默认就是round_th
+        """
+        seed_round = round_th if seed_round is None else seed_round
+        tasks = []
+        for k, client_id in enumerate(clients_index):
+            # 训练时只把参数发给被选中的客户端
+            agent = self.agents[k]  # 放到第k个槽位上
+            agent.update_local_dataset(self.clients[client_id])  # update datasets
+            if self.stateful_optimizer:
+                flat = self.optimizer_states.get(client_id)
+                agent.optimizer_state = None if flat is None else (self.optimizer_states.layout, flat)
+            if self.error_feedback:
+                agent.residual = self.residuals.get(int(client_id))
+            tasks.append((agent, self.global_params, round_th,
+                          local_shuffle_seed(self.seed, seed_round, client_id), client_id))
+        self.profiler.add_bytes('broadcast', params_nbytes(self.global_params) * len(tasks))
+        return tasks
+
+    def _collect_client_state(self, result):
+        """客户端训练完后，把它要留到下次的状态（优化器状态、residual）存回服务器，并记录profile"""
+        local_params, train_data_num, sample_loss, stats = result
+        self.selector.update(stats['client_id'], stats['sample_loss'])
+        if 'optimizer_state' in stats:
+            self.optimizer_states.put(stats['client_id'], *stats.pop('optimizer_state'))
+        if 'residual' in stats:
+            self.residuals[stats['client_id']] = stats.pop('residual')
+        self.profiler.add_bytes('upload', params_nbytes(local_params))
+        self.profiler.add_bytes('upload_uncompressed', params_nbytes(self.global_params))
+        self.profiler.record_client(stats)
+        return stats
+
+    def _delta_base(self):
+        """客户端上传delta时，aggregator的结果要加在当前的全局参数上"""
+        if self.compressor is not None or self.sparse_embedding:
+            return FlatParams(self.global_params).flat
+        return None
+
+    def _train_on_clients(self, round_th):
         selected_clients_index = self._select_clients(round_th=round_th)
         print("-" * 50)
         print(f"Round {round_th}")
         print("train local models:")
         # print(selected_clients_index)
-        for k in tqdm(range(self.client_num_per_round)):
-            # 训练时只把参数发给被选中的客户端
-            agent = self.agents[k]  # 放到第k个槽位上
-            agent.update_local_dataset(self.clients[selected_clients_index[k]])  # update datasets and params
-            agent.set_params(self.global_params)
-            # 本地训练 local client training
-            local_params, train_data_num, sample_loss \
-                = agent.train(round_th)
-            # print(local_params['fc2.weight'].sum().item())
-            updates.append((local_params, train_data_num))
-        return updates
-
-    def _eval_global_model(self, dataset: str = 'test'):
-        """
-        评估当前的全局模型在所有客户端训练集或测试集上性能
-        """
-        metrics = {
-            'loss': 0,
-            'total_sample_nums': 0,
-            'labels_list': [],  # 所有客户端数据：[1,0,0,1...1,0,1,1]
-            'predicted_list': [],
-            'prob_list': [],
-        }
-        metrics = Metrics()
-
-        total_loss_per_client_list = []
-        sample_nums_per_client_list = []
+        tasks = self._make_tasks(selected_clients_index, round_th)
 
-        for k in tqdm(range(self.client_num_in_total)):
-            agent = self.agents[k % self.client_num_per_round]  # 放到槽位上去算
-            agent.update_local_dataset(self.clients[k])  # update dataset and params
-            agent.set_params(self.global_params)
+        # 同步模式一轮的（模拟）耗时取决于最慢的客户端
+        if self.latency is not None:
+            self.sim_time += max(self.latency.sample(client_id) for client_id in selected_clients_index)
 
-            client_metrics = agent.test(dataset=dataset)
+        # 本地训练 local client training，每个客户端训练完就按槽位顺序累加到aggregator上，不保存所有客户端的参数
+        # 上传的是delta时，aggregator在本轮的全局参数上加上delta的加权平均
+        aggregator = self.aggregator.reset(base=self._delta_base())
+        upload = {'bytes': 0, 'error': []}
 
-            metrics.labels_list += client_metrics.labels_list
-            metrics.predicted_list += client_metrics.predicted_list
-            metrics.prob_list += client_metrics.prob_list
+        def on_client_finished(result):
+            stats = self._collect_client_state(result)
+            if 'compression_error' in stats:
+                upload['error'].append(stats['compression_error'])
+            upload['bytes'] += params_nbytes(result[0])
+            aggregator.add(params=result[0], n_k=result[1])
 
-            total_loss_per_client_list.append(client_metrics.loss * client_metrics.num)
-            sample_nums_per_client_list.append(client_metrics.num)
+        self.executor.run(train_agent, tasks, callback=on_client_finished)
 
-        metrics.nums = sum(sample_nums_per_client_list)
-        metrics.loss = sum(total_loss_per_client_list) / sum(sample_nums_per_client_list)
+        if self.compressor is not None:
+            ratio = params_nbytes(self.global_params) * len(tasks) / upload['bytes']
+            error = float(np.mean(upload['error']))
+            print(f"upload compression ({self.compressor.method}): {ratio:.1f}x, relative error {error:.4f}")
+            wandb.log({"Compression/ratio": ratio, "Compression/relative_error": error, "round": round_th})
+        return aggregator
 
-        return metrics
+    def _eval_global_model(self, dataset: str = 'test'):
+        """
+        评估当前的全局模型在所有客户端训练集或测试集上性能
+        全局参数只加载一次，所有客户端的数据拼在一起按大batch评估
+        """
+        return self.evaluator.evaluate(self.global_params, self.clients, dataset=dataset)
 
     def visualize(self, metrics=None, info='test', round_th=1):
-        labels_list = metrics.labels_list
-        predicted_list = metrics.predicted_list
-        prob_list = metrics.prob_list
         loss = metrics.loss
 
         if self.dataset == "movielens":
             # binary classification
-            precision = precision_score(labels_list, predicted_list, average='binary')
-            recall = recall_score(labels_list, predicted_list)
-            f1 = f1_score(labels_list, predicted_list)
-            auc = roc_auc_score(labels_list, prob_list)
-
-            wandb.log({f"{info.title()}/precision": precision, "round": round_th})
-            wandb.log({f"{info.title()}/recall": recall, "round": round_th})
-            wandb.log({f"{info.title()}/f1": f1, "round": round_th})
-            wandb.log({f"{info.title()}/auc": auc, "round": round_th})
+            wandb.log({f"{info.title()}/precision": metrics.precision, "round": round_th})
+            wandb.log({f"{info.title()}/recall": metrics.recall, "round": round_th})
+            wandb.log({f"{info.title()}/f1": metrics.f1, "round": round_th})
+            wandb.log({f"{info.title()}/auc": metrics.auc, "round": round_th})
 
-        accuracy = accuracy_score(labels_list, predicted_list)
+        accuracy = metrics.accuracy
 
         wandb.log({f"{info.title()}/accuracy": accuracy, "round": round_th})
         wandb.log({f"{info.title()}/loss": loss, "round": round_th})
@@ -205,69 +257,157 @@ class Server:
         print(f"[{info.upper()}] Avg acc: {accuracy * 100:.3f}%, loss: {loss:.5f}")
 
         if info == 'test':
-            print("first 30 Ground Truth: ", labels_list[:30])
-            print("first 30 Prediction:   ", predicted_list[:30])
+            print("first 30 Ground Truth: ", metrics.head_labels[:30])
+            print("first 30 Prediction:   ", metrics.head_predicted[:30])
 
         return self
 
-    @staticmethod
-    def avg_metric(metric_list):
-        # 其实你把所有的结果加到一起再用sklearn去得到accuracy，precision，recall等指标也是OK的
-        total_num = 0
-        total_metric = 0
-        for (client_num, metric) in metric_list:
-            total_num += client_num
-            total_metric += metric * client_num
-        avg_metric = total_metric / total_num
-        return avg_metric
-
-    def federate(self):
-        """
-        FedAvg Core Function
-        """
-        print("Begin Federating!")
-        print(f"Training among {self.client_num_in_total} clients! \n")
-
-        self.model = self._select_model(self.model_name)
+    def _setup(self):
+        """创建模型、客户端、agent槽位、执行器、聚合器和评估器，同步和异步模式共用"""
+        self.model = self._select_model(self.model_name, sparse=self.sparse_embedding)
+        if self.sparse_embedding:
+            if not hasattr(self.model, 'row_inputs'):
+                raise ValueError(f"--sparse_embedding is not supported by model {self.model_name}")
+            self.row_inputs = self.model.row_inputs
 
         # get the initialized global model params
         self.global_params = copy.deepcopy(self.model.state_dict())
 
         datasets = self.get_dataloader()
+        if self.negative_resampler is not None and self.executor_name == 'socket':
+            # socket worker只在第一次收到训练集tensor，之后原地改写的负样本传不过去
+            raise ValueError("--resample_negatives is not supported with --executor socket")
 
         self.clients = self._setup_clients(datasets)
 
+        self.selector = ClientSelector(self.client_num_in_total, self.client_selection, seed=self.seed,
+                                       num_samples=self.clients.num_samples()[:self.client_num_in_total],
+                                       candidates=self.selection_candidates)
+
+        self.executor = get_executor(self.executor_name, self.num_workers, self.device,
+                                     address=self.worker_address, spawn_workers=not self.external_workers,
+                                     authkey=self.worker_authkey)
+
         self.agents = self._setup_agents()
 
-        min_loss = 1000
-        early_stop_cnt = 0
+        self.aggregator = StreamingAggregator(self.global_params, row_keys=self.row_inputs,
+                                              buffer_keys=state_buffer_keys(self.model))
+
+        self.evaluator = Evaluator(self.model, device=self.device, batch_size=self.eval_batch_size)
+
+        if self.latency_distribution != 'none':
+            self.latency = LatencyModel(self.client_num_in_total, self.latency_distribution,
+                                        mean=self.latency_mean, sigma=self.latency_sigma, seed=self.seed)
+        self.sim_time = 0.
+        return self
+
+    def _run_config(self):
+        """续训时必须和checkpoint一致的设置"""
+        return {'model': self.model_name, 'dataset': self.dataset, 'client_num_in_total': self.client_num_in_total,
+                'client_num_per_round': self.client_num_per_round, 'seed': self.seed,
+                'client_selection': self.client_selection, 'mode': self.__class__.__name__}
+
+    def _checkpoint_state(self, next_round, min_loss, early_stop_cnt):
+        """要保存的状态（快照），next_round是续训时第一个要训练的轮"""
+        return {
+            'config': self._run_config(),
+            'round': next_round,
+            'global_params': snapshot_params(self.global_params),
+            'min_loss': min_loss,
+            'early_stop_cnt': early_stop_cnt,
+            'rng': get_rng_state(),
+            'sim_time': self.sim_time,
+            'latency_rng': None if self.latency is None else self.latency.rng.bit_generator.state,
+            # 客户端的状态每次都是整个替换的，浅拷贝一下字典就够了
+            'optimizer_states': (self.optimizer_states.layout, dict(self.optimizer_states.states)),
+            'residuals': dict(self.residuals),
+            'selector': self.selector.state_dict(),
+        }
+
+    def _load_checkpoint_state(self, state):
+        """在_setup之后调用，覆盖掉重新创建出来的状态"""
+        if state['config'] != self._run_config():
+            raise ValueError(f"checkpoint was saved with {state['config']}, current run is {self._run_config()}")
+        self.global_params = state['global_params']
+        set_rng_state(state['rng'])
+        self.sim_time = state['sim_time']
+        if state['latency_rng'] is not None:
+            self.latency.rng.bit_generator.state = state['latency_rng']
+        self.optimizer_states.layout, self.optimizer_states.states = state['optimizer_states']
+        self.residuals = state['residuals']
+        self.selector.load_state_dict(state['selector'])
+        return state
+
+    def _resume_or_start(self):
+        """Returns: (第一个要训练的轮, min_loss, early_stop_cnt)"""
+        if not self.resume:
+            return 0, 1000, 0
+        state = self._load_checkpoint_state(load_checkpoint(self.resume))
+        print(f"Resume from {self.resume}, round {state['round']}")
+        return state['round'], state['min_loss'], state['early_stop_cnt']
+
+    def _evaluate(self, round_th):
+        """评估全局模型并记录，返回测试集上的loss"""
+        print("evaluate global model:")
+        with self.profiler.phase('eval'):
+            train_set_metrics = self._eval_global_model(dataset='train')
+            test_set_metrics = self._eval_global_model(dataset='test')
+
+        self.visualize(metrics=train_set_metrics, info='train', round_th=round_th)
+        self.visualize(metrics=test_set_metrics, info='test', round_th=round_th)
+        if self.latency is not None:
+            print(f"simulated time: {self.sim_time:.2f}s (simulated clock, not wall-clock)")
+            wandb.log({"Time/simulated": self.sim_time, "round": round_th})
+        return test_set_metrics.loss
+
+    def _resample_negatives(self, round_th):
+        self.negative_resampler.resample(round_th)
+        # non-iid时评估用的训练集是拼接后的副本，要重新拼
+        self.evaluator.cache.pop('train', None)
+        return self
+
+    def federate(self):
+        """
+        FedAvg Core Function
+        """
+        print("Begin Federating!")
+        print(f"Training among {self.client_num_in_total} clients! \n")
+
+        self._setup()
+
+        start_round, min_loss, early_stop_cnt = self._resume_or_start()
 
         # Server-Client communication
-        for round_th in range(self.num_rounds):
-            # (1)
-            updates = self._train_on_clients(round_th)
-            # (2)
-            self._aggregate_and_update_global_params(updates)
-            if round_th % self.eval_interval == 0:
-                # (3)
-                print("evaluate global model:")
-                train_set_metrics = self._eval_global_model(dataset='train')
-                test_set_metrics = self._eval_global_model(dataset='test')
-
-                # (4)
-                self.visualize(metrics=train_set_metrics, info='train', round_th=round_th)
-                self.visualize(metrics=test_set_metrics, info='test', round_th=round_th)
-
-                test_loss = test_set_metrics.loss
-                if min_loss > test_loss:
-                    min_loss = test_loss
-                    early_stop_cnt = 0
-                else:
-                    early_stop_cnt += self.eval_interval
+        for round_th in range(start_round, self.num_rounds):
+            self.profiler.start_round(round_th)
+            if self.negative_resampler is not None and round_th > 0:
+                # 第0轮用的是生成数据集时采的负样本
+                with self.profiler.phase('resample'):
+                    self._resample_negatives(round_th)
+            with self.profiler.torch_profile(round_th):
+                # (1)
+                with self.profiler.phase('train'):
+                    aggregator = self._train_on_clients(round_th)
+                # (2)
+                with self.profiler.phase('aggregate'):
+                    self._aggregate_and_update_global_params(aggregator)
+                if round_th % self.eval_interval == 0:
+                    # (3) (4)
+                    test_loss = self._evaluate(round_th)
+                    if min_loss > test_loss:
+                        min_loss = test_loss
+                        early_stop_cnt = 0
+                    else:
+                        early_stop_cnt += self.eval_interval
+            # 快照在这里做，写盘在后台进行
+            if self.checkpointer.due(round_th) and early_stop_cnt < self.early_stop:
+                with self.profiler.phase('checkpoint'):
+                    self.checkpointer.save(self._checkpoint_state(round_th + 1, min_loss, early_stop_cnt))
+            self.profiler.end_round()
 
             # Stop training if your model stops improving for 'early_stop' rounds.
             if early_stop_cnt >= self.early_stop:
                 break
 
-
-
+        self.checkpointer.wait()
+        self.executor.shutdown()
@@ -0,0 +1,115 @@
+"""
+进程池训练时的全局模型广播和参数上传，都通过共享内存：
+    - 全局模型的浮点参数放在一个共享内存向量flat里，服务器每个版本只写一次（一次memcpy），
+      worker进程在启动时就映射好了这块内存，任务里只带版本号，worker检查版本号后直接拿flat上的view来set_params，
+      所以广播的开销和worker数量无关，也不用每个任务都pickle一遍global_params
+    - 每个agent槽位一个共享内存的上传槽slots[k]，worker训练完把参数直接拼到槽里（见Client.params_out），
+      返回给服务器的只是槽位上的view（pickle时只传共享内存的句柄），服务器按槽位顺序原地累加到aggregator上
+"""
+import torch
+
+
+class SharedParams:
+    def __init__(self, template, num_slots):
+        """
+        Args:
+            template: 全局模型的state_dict，确定每个参数在flat中的位置
+            num_slots: 上传槽的数量（一次run最多的任务数，即client_num_per_round）
+        """
+        self.keys = list(template.keys())
+        self.shapes = {key: template[key].shape for key in self.keys}
+        self.float_keys = [key for key in self.keys if template[key].is_floating_point()]
+        self.offsets, offset = {}, 0
+        for key in self.float_keys:
+            self.offsets[key] = (offset, offset + template[key].numel())
+            offset += template[key].numel()
+
+        self.flat = torch.zeros(offset, dtype=torch.float32).share_memory_()
+        # 非浮点的buffer（如num_batches_tracked）很小，每个一块共享内存
+        self.other = {key: template[key].detach().cpu().clone().share_memory_()
+                      for key in self.keys if key not in self.offsets}
+        self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.slots = torch.zeros(num_slots, offset, dtype=torch.float32).share_memory_()
+
+    @property
+    def num_slots(self):
+        return self.slots.shape[0]
+
+    def publish(self, params):
+        """把新的全局参数写进共享内存，返回新的版本号"""
+        with torch.no_grad():
+            torch.cat([params[key].detach().reshape(-1).float() for key in self.float_keys], out=self.flat)
+            for key, value in self.other.items():
+                value.copy_(params[key])
+        self.version += 1
+        return int(self.version)
+
+    def params(self, version=None):
+        """
+        共享内存上的全局参数（view，不复制），只用来读
+        version: 任务发出时的版本号，和共享内存中的不一致说明服务器已经写了新版本，这个任务读到的参数不对
+        """
+        if version is not None and int(self.version) != version:
+            raise RuntimeError(f"shared global params are version {int(self.version)}, task expects {version}")
+        params = {}
+        for key in self.keys:
+            if key in self.offsets:
+                start, end = self.offsets[key]
+                params[key] = self.flat[start:end].view(self.shapes[key])
+            else:
+                params[key] = self.other[key]
+        return params
+
+
+_worker_shared = None
+
+
+def _init_worker(shared):
+    global _worker_shared
+    _worker_shared = shared
+
+
+def _touch(params):
+    # benchmark用：读一下每个参数
+    return 0. if params is None else sum(float(value.reshape(-1)[0]) for value in params.values())
+
+
+def _touch_shared(version):
+    return 0. if version is None else _touch(_worker_shared.params(version))
+
+
+if __name__ == '__main__':
+    # 每一轮把全局模型发给num_workers个worker的耗时：每个任务pickle一份global_params vs 共享内存 + 版本号
+    import os
+    import sys
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from models.fedavg.movielens.mlp import MLP
+    from algorithm.fedavg import shared_params as package
+
+    params = {key: value.clone() for key, value in MLP(100000, 20000).state_dict().items()}
+    size = sum(value.numel() * value.element_size() for value in params.values()) / 2 ** 20
+    rounds = 5
+    for num_workers in [2, 4, 8]:
+        tasks_per_round = num_workers * 2
+
+        with ProcessPoolExecutor(num_workers) as pool:
+            list(pool.map(package._touch, [None] * num_workers))  # 启动worker
+            start = time.perf_counter()
+            for _ in range(rounds):
+                params = {key: value.clone() for key, value in params.items()}  # 每一轮都是新的全局参数
+                list(pool.map(package._touch, [params] * tasks_per_round))
+            pickled = (time.perf_counter() - start) / rounds
+
+        shared = SharedParams(params, num_slots=tasks_per_round)
+        with ProcessPoolExecutor(num_workers, initializer=package._init_worker, initargs=(shared,)) as pool:
+            list(pool.map(package._touch_shared, [None] * num_workers))
+            start = time.perf_counter()
+            for _ in range(rounds):
+                version = shared.publish(params)
+                list(pool.map(package._touch_shared, [version] * tasks_per_round))
+            cost = (time.perf_counter() - start) / rounds
+        print(f"{size:.1f} MB model, {num_workers} workers x {tasks_per_round} tasks/round: "
+              f"pickled {pickled * 1000:7.1f} ms/round, shared {cost * 1000:6.1f} ms/round")
@@ -0,0 +1,133 @@
+"""
+推荐模型embedding表的稀疏更新
+一个客户端只会用到自己数据里的user_id和movie_id，embedding表里其他的行在本地训练时根本不会变（使用稀疏梯度时），
+所以客户端只上传用到的那些行的delta，其余参数（全连接层等）照常上传；
+聚合时embedding的每一行只在更新过这一行的客户端之间按样本数加权平均，不会被没用到这一行的客户端稀释
+
+模型用类属性row_inputs声明哪些参数是按行查表的：{参数名: 输入x的第几列}，如MLP的
+{'user_id_embed.weight': 0, 'movie_id_embed.weight': 1}
+"""
+import torch
+
+
+def touched_rows(dataloader, row_inputs):
+    """这个客户端的训练数据会用到每个embedding表的哪些行（排好序、去重的LongTensor）"""
+    from algorithm.fedavg.evaluator import collect_tensors  # aggregator.py也会import这个模块，用到时再import
+    inputs, _ = collect_tensors(dataloader)
+    return {key: torch.unique(inputs[:, column].long()) for key, column in row_inputs.items()}
+
+
+class RowSparseDelta:
+    """
+    客户端上传的稀疏delta
+        rows:  {embedding参数名: (行号LongTensor, 这些行的delta (len(行号), dim))}
+        dense: {其他浮点参数名: delta}
+        other: {非浮点buffer名: 原值}（如num_batches_tracked）
+    """
+
+    def __init__(self, rows, dense, other):
+        self.rows = rows
+        self.dense = dense
+        self.other = other
+
+    def nbytes(self):
+        total = sum(index.numel() * index.element_size() + values.numel() * values.element_size()
+                    for index, values in self.rows.values())
+        for value in list(self.dense.values()) + list(self.other.values()):
+            total += value.numel() * value.element_size()
+        return total
+
+    def cpu(self):
+        self.rows = {key: (index.cpu(), values.cpu()) for key, (index, values) in self.rows.items()}
+        self.dense = {key: value.cpu() for key, value in self.dense.items()}
+        self.other = {key: value.cpu() for key, value in self.other.items()}
+        return self
+
+
+class RowSparseUploader:
+    """
+    客户端一侧：set_params之后记下本轮要用到的行和它们的全局值，训练完只上传这些行的delta
+    """
+
+    def __init__(self, row_inputs, buffer_keys=()):
+        """buffer_keys: 模型的buffer（如BatchNorm的running_var），和非浮点buffer一样上传原值"""
+        self.row_inputs = row_inputs
+        self.buffer_keys = set(buffer_keys)
+        self.rows = None
+        self.global_rows = None
+        self.global_dense = None
+
+    def begin(self, state, dataloader):
+        """state: agent模型的state_dict（已经拷贝好了全局参数）"""
+        self.rows = {key: index.to(state[key].device) for key, index in touched_rows(dataloader, self.row_inputs).items()}
+        self.global_rows = {key: state[key][index].clone() for key, index in self.rows.items()}
+        self.global_dense = {key: value.detach().clone() for key, value in state.items()
+                             if value.is_floating_point() and key not in self.row_inputs
+                             and key not in self.buffer_keys}
+
+    def end(self, state):
+        rows = {key: (index, state[key].detach()[index] - self.global_rows[key]) for key, index in self.rows.items()}
+        dense = {key: state[key].detach() - value for key, value in self.global_dense.items()}
+        other = {key: value.detach().clone() for key, value in state.items()
+                 if not value.is_floating_point() or key in self.buffer_keys}
+        return RowSparseDelta(rows, dense, other).cpu()
+
+
+if __name__ == '__main__':
+    # 用更大的ID空间对比稠密和稀疏两种方式：一个客户端训练 + 上传 + 聚合的耗时和上传的字节数
+    import os
+    import sys
+    import time
+    import copy
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from torch.utils.data import TensorDataset, DataLoader
+    from models.fedavg.movielens.mlp import MLP
+    from algorithm.fedavg.aggregator import StreamingAggregator, FlatParams
+    from algorithm.fedavg.optimizer_state import OptimizerGroup
+    from algorithm.fedavg.profiler import params_nbytes
+    # 用包里的类，aggregator按类型判断上传的是哪种格式
+    from algorithm.fedavg.sparse_rows import RowSparseUploader
+
+    torch.manual_seed(0)
+    num_clients, samples_per_client = 10, 512
+    for user_num, movie_num in [(6040, 3883), (100000, 20000), (400000, 50000)]:
+        x = torch.stack([torch.randint(user_num, (num_clients * samples_per_client,)),
+                         torch.randint(movie_num, (num_clients * samples_per_client,))], dim=1)
+        y = torch.randint(2, (len(x),))
+        loaders = [DataLoader(TensorDataset(x[i::num_clients], y[i::num_clients]), batch_size=64)
+                   for i in range(num_clients)]
+
+        for sparse in [False, True]:
+            model = MLP(user_num, movie_num, sparse=sparse)
+            global_params = copy.deepcopy(model.state_dict())
+            aggregator = StreamingAggregator(global_params, row_keys=list(MLP.row_inputs) if sparse else None)
+            aggregator.reset(base=FlatParams(global_params).flat if sparse else None)
+            uploader = RowSparseUploader(MLP.row_inputs)
+            if sparse:
+                embeddings = [model.user_id_embed.weight, model.movie_id_embed.weight]
+                others = [p for p in model.parameters() if all(p is not e for e in embeddings)]
+                optimizer = OptimizerGroup([torch.optim.SparseAdam(embeddings, lr=1e-3),
+                                            torch.optim.Adam(others, lr=1e-3)])
+            else:
+                optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+            upload_bytes = 0
+            start = time.perf_counter()
+            for loader in loaders:
+                model.load_state_dict(global_params)
+                if sparse:
+                    uploader.begin(model.state_dict(), loader)
+                for inputs, labels in loader:
+                    optimizer.zero_grad()
+                    loss = model.cal_loss(model(inputs), labels)
+                    loss.backward()
+                    optimizer.step()
+                update = uploader.end(model.state_dict()) if sparse else FlatParams(model.state_dict())
+                upload_bytes += params_nbytes(update)
+                aggregator.add(update, samples_per_client)
+            aggregator.result()
+            cost = time.perf_counter() - start
+            print(f"{user_num:>6d} users x {movie_num:>5d} movies, {'sparse' if sparse else 'dense '}: "
+                  f"{cost / num_clients * 1000:7.1f} ms/client, upload {upload_bytes / num_clients / 2 ** 20:7.2f} MB/client")
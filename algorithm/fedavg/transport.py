@@ -0,0 +1,422 @@
+"""
+服务器和worker进程之间的通信：本机TCP、Unix socket，或者测试用的进程内loopback（不经过socket，但走同样的编码）
+
+一条消息（frame）的格式：
+    header:   magic(4 bytes) + 消息类型(1 byte) + storage表长度(4 bytes) + pickle长度(8 bytes)，网络字节序
+    storage表: pickle的[(nbytes, cache_key, cached), ...]
+    pickle:   对象本身，其中的tensor用persistent_id换成(storage序号, offset, shape, stride, dtype)，不在pickle里
+    storages: 所有tensor的storage原始字节，依次排列
+tensor的数据不经过pickle，发送时直接把storage的内存交给socket，接收时直接recv_into到新分配的buffer里；
+共享同一个storage的tensor（如FlatParams里的view）只发一次。
+客户端的数据集tensor每轮都不会变，标记为static后每个连接只发一次，之后只发cache_key
+
+安全：收到的消息会被unpickle，worker还会执行消息里的函数，所以socket连接建立后先用authkey做双向认证
+（和multiprocessing.connection一样的HMAC challenge-response，见authenticate），认证通过之前不收发任何pickle。
+认证不加密：消息内容（模型参数、客户端数据）在网络上是明文，跨机器时只在可信的网络里用，或者走SSH隧道/VPN
+"""
+import io
+import os
+import hmac
+import queue
+import pickle
+import socket
+import struct
+import threading
+import traceback
+
+import torch
+import torch.nn as nn
+
+MAGIC = b'FPRO'
+HEADER = struct.Struct('!4sBIQ')
+
+TASK, RESULT, ERROR, SHUTDOWN = 1, 2, 3, 4
+
+CHALLENGE_SIZE = 32
+AUTH_TIMEOUT = 30.
+WELCOME, FAILURE = b'#WELCOME#', b'#FAILURE#'
+
+
+def _storage_bytes(storage):
+    """CPU storage的原始字节（uint8 numpy数组，不复制）"""
+    return torch.tensor([], dtype=torch.uint8).set_(storage).numpy()
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, encoder):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.encoder = encoder
+
+    def persistent_id(self, obj):
+        if isinstance(obj, torch.Tensor) and type(obj) in (torch.Tensor, nn.Parameter) and obj.layout == torch.strided:
+            return self.encoder.tensor_id(obj)
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, storages):
+        super().__init__(file)
+        self.storages = storages
+
+    def persistent_load(self, pid):
+        index, offset, shape, stride, dtype, is_param, requires_grad = pid
+        tensor = torch.tensor([], dtype=getattr(torch, dtype)).set_(self.storages[index], offset, shape, stride)
+        if is_param:
+            return nn.Parameter(tensor, requires_grad=requires_grad)
+        return tensor.requires_grad_(requires_grad) if requires_grad else tensor
+
+
+class Encoder:
+    """
+    一个连接发送方向的编码器，记住已经发过的static storage
+    """
+
+    def __init__(self):
+        self.static = {}  # (data_ptr, nbytes) -> cache_key，标记为不会再改变的storage
+        self.static_refs = []  # 保持引用，防止storage被释放后地址被重用
+        self.sent = set()  # 已经发给对方的cache_key
+
+    def mark_static(self, tensor):
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), storage.nbytes())
+        if tensor.device.type == 'cpu' and key not in self.static:
+            self.static[key] = len(self.static) + 1
+            self.static_refs.append(storage)
+
+    def tensor_id(self, tensor):
+        is_param, requires_grad = isinstance(tensor, nn.Parameter), tensor.requires_grad
+        tensor = tensor.detach()
+        if tensor.device.type != 'cpu':
+            tensor = tensor.cpu()
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), storage.nbytes())
+        if key not in self._index:
+            self._index[key] = len(self._storages)
+            self._storages.append(storage)
+        return (self._index[key], tensor.storage_offset(), tuple(tensor.shape), tuple(tensor.stride()),
+                str(tensor.dtype).split('.')[-1], is_param, requires_grad)
+
+    def encode(self, msg_type, obj):
+        """返回要依次发送的buffer列表"""
+        self._storages, self._index = [], {}
+        file = io.BytesIO()
+        _Pickler(file, self).dump(obj)
+        payload = file.getvalue()
+
+        table, buffers = [], []
+        for storage in self._storages:
+            cache_key = self.static.get((storage.data_ptr(), storage.nbytes()))
+            if cache_key is not None and cache_key in self.sent:
+                table.append((storage.nbytes(), cache_key, True))
+                continue
+            table.append((storage.nbytes(), cache_key, False))
+            buffers.append(_storage_bytes(storage))
+            if cache_key is not None:
+                self.sent.add(cache_key)
+        table = pickle.dumps(table, protocol=pickle.HIGHEST_PROTOCOL)
+        self._storages, self._index = None, None
+        return [HEADER.pack(MAGIC, msg_type, len(table), len(payload)), table, payload] + buffers
+
+
+class Decoder:
+    """一个连接接收方向的解码器，保存对方发过来的static storage"""
+
+    def __init__(self):
+        self.cache = {}
+
+    def decode(self, table, payload, read_storage):
+        """read_storage(nbytes) 返回一个新的、装满数据的bytearray"""
+        storages = []
+        for nbytes, cache_key, cached in pickle.loads(table):
+            if cached:
+                storages.append(self.cache[cache_key])
+                continue
+            storage = torch.frombuffer(read_storage(nbytes), dtype=torch.uint8).untyped_storage() \
+                if nbytes > 0 else torch.UntypedStorage(0)
+            if cache_key is not None:
+                self.cache[cache_key] = storage
+            storages.append(storage)
+        return _Unpickler(io.BytesIO(payload), storages).load()
+
+
+class Connection:
+    """子类实现_send_buffers和_recv_into"""
+
+    def __init__(self):
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        # 这个连接上收发的总字节数
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, msg_type, obj):
+        buffers = self.encoder.encode(msg_type, obj)
+        self._send_buffers(buffers)
+        nbytes = sum(memoryview(buffer).nbytes for buffer in buffers)
+        self.bytes_sent += nbytes
+        return nbytes
+
+    def _recv_exact(self, nbytes):
+        buffer = bytearray(nbytes)
+        self._recv_into(memoryview(buffer))
+        self.bytes_received += nbytes
+        return buffer
+
+    def send_bytes(self, data):
+        """认证用的短消息：4字节长度 + 原始字节，不经过pickle"""
+        self._send_buffers([struct.pack('!I', len(data)), data])
+
+    def recv_bytes(self, max_size=256):
+        size, = struct.unpack('!I', self._recv_exact(4))
+        if size > max_size:
+            raise ConnectionError(f"unexpected message of {size} bytes during authentication")
+        return bytes(self._recv_exact(size))
+
+    def recv(self):
+        magic, msg_type, table_len, payload_len = HEADER.unpack(self._recv_exact(HEADER.size))
+        if magic != MAGIC:
+            raise ConnectionError(f"bad frame magic: {magic!r}")
+        table = self._recv_exact(table_len)
+        payload = self._recv_exact(payload_len)
+        return msg_type, self.decoder.decode(table, payload, self._recv_exact)
+
+    def close(self):
+        pass
+
+
+class SocketConnection(Connection):
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        if sock.family != getattr(socket, 'AF_UNIX', None):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send_buffers(self, buffers):
+        for buffer in buffers:
+            self.sock.sendall(buffer)
+
+    def _recv_into(self, view):
+        while len(view) > 0:
+            received = self.sock.recv_into(view)
+            if received == 0:
+                raise ConnectionError("connection closed")
+            view = view[received:]
+
+    def close(self):
+        self.sock.close()
+
+
+class LoopbackConnection(Connection):
+    """进程内的假连接（测试用）：buffer直接放进对方的队列，不经过socket，编码和解码和socket完全一样"""
+
+    def __init__(self, inbox, outbox):
+        super().__init__()
+        self.inbox, self.outbox = inbox, outbox
+        self.pending = memoryview(b'')
+
+    @staticmethod
+    def pair():
+        a, b = queue.Queue(), queue.Queue()
+        return LoopbackConnection(a, b), LoopbackConnection(b, a)
+
+    def _send_buffers(self, buffers):
+        self.outbox.put(b''.join(memoryview(buffer).cast('B') for buffer in buffers))
+
+    def _recv_into(self, view):
+        while len(view) > 0:
+            if len(self.pending) == 0:
+                self.pending = memoryview(self.inbox.get())
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            view, self.pending = view[n:], self.pending[n:]
+
+
+def listen(address):
+    """
+    address: tcp://host:port（port为0时自动分配）或 unix:///path/to.sock
+    Returns: (listening socket, 实际的address)
+    """
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+        address = f"tcp://{host}:{sock.getsockname()[1]}"
+    elif address.startswith('unix://'):
+        path = address[len('unix://'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    else:
+        raise ValueError(f"unknown address: {address}")
+    sock.listen()
+    return sock, address
+
+
+def connect(address):
+    if address.startswith('tcp://'):
+        host, port = address[len('tcp://'):].rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)))
+    elif address.startswith('unix://'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address[len('unix://'):])
+    else:
+        raise ValueError(f"unknown address: {address}")
+    return SocketConnection(sock)
+
+
+def _deliver_challenge(connection, authkey):
+    challenge = os.urandom(CHALLENGE_SIZE)
+    connection.send_bytes(challenge)
+    response = connection.recv_bytes()
+    if not hmac.compare_digest(response, hmac.new(authkey, challenge, 'sha256').digest()):
+        connection.send_bytes(FAILURE)
+        raise ConnectionError("peer failed authentication (wrong authkey?)")
+    connection.send_bytes(WELCOME)
+
+
+def _answer_challenge(connection, authkey):
+    challenge = connection.recv_bytes()
+    if len(challenge) != CHALLENGE_SIZE:
+        raise ConnectionError("bad authentication challenge")
+    connection.send_bytes(hmac.new(authkey, challenge, 'sha256').digest())
+    if connection.recv_bytes() != WELCOME:
+        raise ConnectionError("authentication rejected by peer (wrong authkey?)")
+
+
+def authenticate(connection, authkey, server_side):
+    """
+    双向认证：双方各发一个随机challenge，对方回复HMAC-SHA256(authkey, challenge)，两个方向都通过才返回，
+    否则抛出ConnectionError。服务器先验证worker，worker再验证服务器（worker会执行收到的函数，也要确认对方是服务器）
+    """
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if not authkey:
+        raise ValueError("socket connections need a non-empty authkey")
+    sock = getattr(connection, 'sock', None)
+    timeout = sock.gettimeout() if sock is not None else None
+    if sock is not None:
+        # 不让一个不说话的连接一直卡住服务器
+        sock.settimeout(AUTH_TIMEOUT)
+    try:
+        if server_side:
+            _deliver_challenge(connection, authkey)
+            _answer_challenge(connection, authkey)
+        else:
+            _answer_challenge(connection, authkey)
+            _deliver_challenge(connection, authkey)
+    finally:
+        if sock is not None:
+            sock.settimeout(timeout)
+    return connection
+
+
+def serve(connection):
+    """worker的主循环：收到(fn, args)就执行fn(*args)并把结果发回去，直到收到SHUTDOWN"""
+    while True:
+        msg_type, message = connection.recv()
+        if msg_type == SHUTDOWN:
+            break
+        fn, args = message
+        try:
+            connection.send(RESULT, fn(*args))
+        except Exception:
+            connection.send(ERROR, traceback.format_exc())
+    connection.close()
+
+
+def run_worker(address, num_threads=None, authkey=None):
+    """worker进程的入口，也可以在另一台机器上用 algorithm/fedavg/worker.py 启动；authkey要和服务器的一样"""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    serve(authenticate(connect(address), authkey, server_side=False))
+
+
+def _echo(obj):
+    return obj
+
+
+if __name__ == '__main__':
+    # 1. 吞吐量：把全局模型发给worker（广播），worker原样发回（上传），对比直接pickle.dumps/loads
+    # 2. 端到端：SocketExecutor真正训练客户端时每个任务收发的字节数
+    import sys
+    import time
+    import tempfile
+    import multiprocessing as mp
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+    from models.fedavg.mnist.cnn import CNN
+    from models.fedavg.movielens.widedeep import WideDeep
+    from models.fedavg.movielens.mlp import MLP
+    # 用包里的函数，worker进程里才能按名字找到它
+    from algorithm.fedavg.transport import run_worker as package_run_worker, _echo as echo
+    from algorithm.fedavg.client import Client
+    from algorithm.fedavg.executor import SocketExecutor, train_agent, _dataset_tensors
+    from benchmarks.synthetic import movielens_like, client_dataloaders
+
+    repeat = 20
+    authkey = os.urandom(32)
+    for model in [CNN(), MLP(), WideDeep(), MLP(100000, 20000)]:
+        params = model.state_dict()
+        size = sum(value.numel() * value.element_size() for value in params.values()) / 2 ** 20
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            pickle.loads(pickle.dumps(params))
+        baseline = repeat * size * 2 / (time.perf_counter() - start)
+
+        results = [f"pickle round trip {baseline:7.0f} MB/s"]
+        for kind in ['loopback', 'tcp', 'unix']:
+            if kind == 'loopback':
+                server, worker = LoopbackConnection.pair()
+                thread = threading.Thread(target=serve, args=(worker,), daemon=True)
+                thread.start()
+            else:
+                address = 'tcp://127.0.0.1:0' if kind == 'tcp' else f"unix://{tempfile.mkdtemp()}/fedpro.sock"
+                listener, address = listen(address)
+                process = mp.get_context('spawn').Process(target=package_run_worker, args=(address, None, authkey))
+                process.start()
+                server = authenticate(SocketConnection(listener.accept()[0]), authkey, server_side=True)
+            server.send(TASK, (echo, (params,)))
+            server.recv()  # 预热
+            start = time.perf_counter()
+            for _ in range(repeat):
+                server.send(TASK, (echo, (params,)))
+                msg_type, echoed = server.recv()
+            cost = time.perf_counter() - start
+            assert all(torch.equal(echoed[key], params[key]) for key in params)
+            server.send(SHUTDOWN, None)
+            results.append(f"{kind} {repeat * size * 2 / cost:7.0f} MB/s")
+            if kind != 'loopback':
+                process.join()
+                listener.close()
+        print(f"{model.__class__.__name__:8s} ({size:6.1f} MB): " + ", ".join(results))
+
+    # 每轮20个客户端、2个worker，训练3轮；对比原来每个任务发(train_agent, (agent, global_params, ...))的大小
+    num_clients, num_rounds = 20, 3
+    inputs, labels = movielens_like(num_clients * 200)
+    loaders = client_dataloaders(inputs, labels, num_clients, batch_size=64)
+    model = MLP()
+    size = sum(value.numel() * value.element_size() for value in model.state_dict().values())
+    agents = [Client(user_id=None, model=copy_model, epoch=1, lr=1e-3, optimizer='adam', device='cpu')
+              for copy_model in [MLP() for _ in range(num_clients)]]
+    executor = SocketExecutor(2, 'tcp://127.0.0.1:0')
+    old = Encoder()
+    for tensor in _dataset_tensors(loaders[0]):
+        old.mark_static(tensor)
+    old.encode(TASK, loaders[0])  # 数据集tensor已经发过
+    old_bytes = 0
+    for round_th in range(num_rounds):
+        global_params = {key: value.clone() for key, value in model.state_dict().items()}
+        tasks = []
+        for client_id, (agent, loader) in enumerate(zip(agents, loaders)):
+            agent.train_dataloader = agent.test_dataloader = loader
+            tasks.append((agent, global_params, round_th, client_id, client_id))
+            old_bytes += sum(memoryview(b).nbytes for b in old.encode(TASK, (train_agent, tasks[-1])))
+        executor.run(train_agent, tasks, callback=lambda result: None)
+    sent, received = executor.bytes_moved()
+    executor.shutdown()
+    num_tasks = num_clients * num_rounds
+    print(f"MLP ({size / 2 ** 20:.1f} MB) end-to-end per task: sent {sent / num_tasks / 2 ** 20:.2f} MB "
+          f"(was {old_bytes / num_tasks / 2 ** 20:.2f} MB), received {received / num_tasks / 2 ** 20:.2f} MB")
@@ -0,0 +1,26 @@
+"""
+socket执行器的worker：连到服务器，接收任务，训练完把结果发回去
+服务器用 FEDPRO_AUTHKEY=<secret> ... --executor socket --external_workers --worker_address tcp://0.0.0.0:29500 启动后，
+在每台机器上运行
+    FEDPRO_AUTHKEY=<secret> python algorithm/fedavg/worker.py --address tcp://server_host:29500
+authkey只用来认证（双方都要证明知道它才会收发消息），通信不加密，只在可信的网络里用
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from algorithm.fedavg.transport import run_worker
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FedAvg socket worker')
+    parser.add_argument('--address', type=str, required=True, help='tcp://host:port or unix:///path.sock')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch threads used by this worker')
+    parser.add_argument('--authkey', type=str, default=os.environ.get('FEDPRO_AUTHKEY', ''),
+                        help='shared secret, same as the server\'s --worker_authkey (default: env FEDPRO_AUTHKEY)')
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error('an authkey is required (--authkey or FEDPRO_AUTHKEY)')
+    run_worker(args.address, args.num_threads, args.authkey)
@@ -0,0 +1,152 @@
+"""
+每个benchmark是一个函数，返回(值, 单位, 是否越大越好)
+run.py把每个benchmark放在单独的子进程里跑，所以子进程的峰值内存就是这个benchmark的峰值内存
+quick=True时用更小的数据（只用来检查能不能跑通）
+"""
+import copy
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import mnist_like, movielens_like, client_dataloaders
+from algorithm.fedavg.client import Client
+from algorithm.fedavg.aggregator import StreamingAggregator, FlatParams
+from algorithm.fedavg.evaluator import Evaluator
+from algorithm.fedavg.selection import ClientSelector, STRATEGIES
+from data_preprocessing.partition import data_split
+from models.fedavg.mnist.cnn import CNN
+from models.fedavg.movielens.mlp import MLP
+from models.fedavg.movielens.fm import FM
+from models.fedavg.movielens.lr import LR
+from models.fedavg.movielens.widedeep import WideDeep
+
+# 模型 -> (创建模型, 数据集, 本地优化器)，和fedavg_main里的默认配置一样
+MODELS = {
+    'cnn': (CNN, 'mnist', 'sgd'),
+    'mlp': (MLP, 'movielens', 'adam'),
+    'fm': (lambda: FM(k=10), 'movielens', 'adam'),
+    'lr': (LR, 'movielens', 'adam'),
+    'widedeep': (WideDeep, 'movielens', 'adam'),
+}
+
+
+def _dataset(name, num_samples):
+    return mnist_like(num_samples) if name == 'mnist' else movielens_like(num_samples)
+
+
+def _best_time(fn, repeat):
+    """跑repeat次，取最快的一次（最不受机器上其他负载的影响）"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def train_throughput(model_name, quick=False):
+    """一个客户端本地训练一个epoch（和Client.train一样，包括取回参数）的samples/sec"""
+    make_model, dataset, optimizer = MODELS[model_name]
+    num_samples = {'mnist': 2048, 'movielens': 20000}[dataset] // (8 if quick else 1)
+    batch_size = 32 if dataset == 'mnist' else 64
+    inputs, labels = _dataset(dataset, num_samples)
+    train_dataloader = client_dataloaders(inputs, labels, 1, batch_size)[0]
+    model = make_model()
+    agent = Client(user_id=0, train_dataloader=train_dataloader, test_dataloader=None, model=model, epoch=1,
+                   lr=1e-3, optimizer=optimizer, device='cpu')
+    global_params = copy.deepcopy(model.state_dict())
+
+    def run():
+        agent.set_params(global_params)
+        agent.train(round_th=0)
+
+    run()  # 预热：第一次会创建优化器、缓存state_dict
+    return num_samples / _best_time(run, 1 if quick else 3), 'samples/s', True
+
+
+def aggregate_time(model_name, num_clients, quick=False):
+    """一轮里num_clients个客户端的参数流式聚合（reset + add + result）的耗时"""
+    model = {'cnn': CNN, 'mlp': MLP, 'mlp_large': lambda: MLP(100000, 20000)}[model_name]()
+    params = model.state_dict()
+    # 只准备几份不同的参数轮流用，不然大模型 x 100个客户端内存不够
+    updates = []
+    for i in range(4):
+        update = {key: value.clone() for key, value in params.items()}
+        for value in update.values():
+            if value.is_floating_point():
+                value.add_(torch.randn_like(value))
+        updates.append(FlatParams(update))
+    aggregator = StreamingAggregator(params)
+
+    def run():
+        aggregator.reset()
+        for k in range(num_clients):
+            aggregator.add(updates[k % len(updates)], n_k=k + 1)
+        aggregator.result()
+
+    run()
+    return _best_time(run, 1 if quick else 3) * 1000, 'ms', False
+
+
+def eval_throughput(model_name, quick=False):
+    """全局模型在所有客户端测试集上评估（Evaluator）的samples/sec"""
+    make_model, dataset, _ = MODELS[model_name]
+    num_samples = {'mnist': 10000, 'movielens': 200000}[dataset] // (8 if quick else 1)
+    inputs, labels = _dataset(dataset, num_samples)
+    loaders = client_dataloaders(inputs, labels, 200, batch_size=64, shuffle=False)
+    clients = [Client(user_id=k, train_dataloader=loader, test_dataloader=loader) for k, loader in enumerate(loaders)]
+    model = make_model()
+    evaluator = Evaluator(model, device='cpu', batch_size=4096)
+    global_params = model.state_dict()
+
+    def run():
+        evaluator.evaluate(global_params, clients, dataset='test').loss
+
+    run()  # 预热：第一次会把所有客户端的数据拼起来
+    return num_samples / _best_time(run, 1 if quick else 3), 'samples/s', True
+
+
+def partition_time(num_samples, num_classes, num_clients=200, quick=False):
+    """狄利克雷non-iid划分（data_split）的耗时"""
+    num_samples //= 8 if quick else 1
+    labels = np.random.RandomState(0).randint(num_classes, size=num_samples)
+
+    def run():
+        np.random.seed(0)
+        data_split(labels, num_clients, alpha=0.5)
+
+    return _best_time(run, 1 if quick else 3) * 1000, 'ms', False
+
+
+def selection_time(strategy, num_clients, k=100, quick=False):
+    """每轮从num_clients个客户端里选k个（每轮选中的客户端都会报告新的loss）的耗时"""
+    num_clients //= 8 if quick else 1
+    rng = np.random.RandomState(0)
+    selector = ClientSelector(num_clients, strategy, seed=0, num_samples=rng.randint(1, 500, size=num_clients))
+    round_th = [0]
+
+    def run():
+        for _ in range(10):
+            selected = selector.select(round_th[0], k)
+            for client_id in selected:
+                selector.update(client_id, rng.rand())
+            round_th[0] += 1
+
+    run()
+    return _best_time(run, 1 if quick else 3) * 100, 'ms', False
+
+
+CASES = {}
+for _name in MODELS:
+    CASES[f'train/{_name}'] = (train_throughput, {'model_name': _name})
+for _name in ['cnn', 'mlp', 'mlp_large']:
+    for _num_clients in [10, 40, 100]:
+        CASES[f'aggregate/{_name}/{_num_clients}_clients'] = \
+            (aggregate_time, {'model_name': _name, 'num_clients': _num_clients})
+for _name in ['cnn', 'mlp', 'fm']:
+    CASES[f'eval/{_name}'] = (eval_throughput, {'model_name': _name})
+for _strategy in STRATEGIES:
+    CASES[f'select/{_strategy}/1m_clients'] = (selection_time, {'strategy': _strategy, 'num_clients': 1000000})
+CASES['partition/mnist_60k'] = (partition_time, {'num_samples': 60000, 'num_classes': 10})
+CASES['partition/movielens_1m'] = (partition_time, {'num_samples': 1000000, 'num_classes': 2})
@@ -0,0 +1,299 @@
+"""
+正确性检查：benchmark只看快不快，这里看优化后的实现和原来的写法结果是不是一样
+每个check是一个不带参数的函数，结果不对就抛AssertionError；在项目根目录运行：
+    python -m benchmarks.checks                  # 跑全部
+    python -m benchmarks.checks --filter wide    # 只跑名字里含wide的
+python -m benchmarks.run --check 也会先跑所有check，有失败的就返回1
+"""
+import argparse
+import sys
+import traceback
+
+import torch
+
+CHECKS = {}
+
+
+def check(fn):
+    CHECKS[fn.__name__] = fn
+    return fn
+
+
+@check
+def aggregate_matches_weighted_average():
+    """流式聚合 == 按key逐个算的加权平均（非浮点buffer四舍五入）"""
+    from algorithm.fedavg.aggregator import StreamingAggregator
+    from models.fedavg.movielens.widedeep import WideDeep
+
+    torch.manual_seed(0)
+    params = WideDeep().state_dict()
+    updates = []
+    for i in range(5):
+        update = {key: value.clone() for key, value in params.items()}
+        for value in update.values():
+            value.add_(torch.randn_like(value.float()).to(value.dtype) if value.is_floating_point() else i)
+        updates.append((update, i + 1))
+    aggregator = StreamingAggregator(params)
+    for update, n_k in updates:
+        aggregator.add(update, n_k)
+    result = aggregator.result()
+    total = sum(n_k for _, n_k in updates)
+    for key, value in params.items():
+        expected = sum(update[key].double() * n_k for update, n_k in updates) / total
+        expected = expected if value.is_floating_point() else torch.round(expected)
+        torch.testing.assert_close(result[key].double(), expected.to(value.dtype).double(), rtol=1e-5, atol=1e-5)
+
+
+@check
+def wide_sparse_linear_matches_dense():
+    """LR/WideDeep的wide部分：按下标取权重（sparse_linear）== one-hot后过nn.Linear（dense_linear），前向和梯度都一样"""
+    from benchmarks.reference import dense_linear
+    from models.fedavg.movielens.wide import sparse_linear
+
+    torch.manual_seed(0)
+    field_dims = [6040, 3883]
+    for batch_size in [1, 7, 256]:
+        linear = torch.nn.Linear(sum(field_dims), 1)
+        x = torch.stack((torch.randint(6040, (batch_size,)), torch.randint(3883, (batch_size,))), dim=1)
+        x[0] = torch.tensor([6039, 3882])  # 每个field的最后一个ID
+        grads = []
+        for fn in [sparse_linear, dense_linear]:
+            linear.zero_grad()
+            out = fn(x, linear, field_dims)
+            (out * torch.arange(1., batch_size + 1)[:, None]).sum().backward()
+            grads.append((out.detach(), linear.weight.grad.clone(), linear.bias.grad.clone()))
+        for sparse, dense in zip(*grads):
+            torch.testing.assert_close(sparse, dense)
+
+
+@check
+def evaluator_per_client_metrics():
+    """一次评估所有客户端的per-client混淆矩阵：加起来等于全局的，每个客户端的和单独评估这个客户端一样"""
+    import numpy as np
+    from algorithm.fedavg.base import Metrics
+    from algorithm.fedavg.client_registry import ClientRegistry
+    from algorithm.fedavg.evaluator import Evaluator
+    from benchmarks.synthetic import movielens_like
+    from data_preprocessing.client_dataset import index_partition
+    from models.fedavg.movielens.mlp import MLP
+
+    torch.manual_seed(0)
+    inputs, labels = movielens_like(3000)
+    rng = np.random.RandomState(0)
+    # 大小不一的客户端，还有一个没有样本的
+    client_indices = np.split(rng.permutation(3000), [5, 5, 700, 1500, 2999])
+    partition = index_partition(inputs, labels, client_indices, 64, shuffle=False)
+    clients = ClientRegistry(partition, partition)
+    model = MLP()
+    metrics = Evaluator(model, device='cpu', batch_size=256).evaluate(model.state_dict(), clients, per_client=True)
+
+    assert metrics.client_confusion_matrix().shape == (len(client_indices), 2, 2)
+    np.testing.assert_array_equal(metrics.client_confusion_matrix().sum(axis=0), metrics.confusion_matrix())
+    np.testing.assert_array_equal(metrics.client_nums, [len(index) for index in client_indices])
+    assert metrics.client_nums.sum() == metrics.nums == 3000
+    model.eval()
+    with torch.no_grad():
+        for k, index in enumerate(client_indices):
+            if len(index) == 0:
+                assert np.isnan(metrics.client_accuracy[k])
+                continue
+            index = torch.as_tensor(index)
+            single = Metrics().update(model(inputs[index]), labels[index])
+            np.testing.assert_array_equal(metrics.client_confusion_matrix()[k], single.confusion_matrix())
+            assert metrics.client_accuracy[k] == single.accuracy
+
+
+@check
+def metrics_loss_is_nan_without_losses():
+    """Metrics.loss：没有update过、update时没给loss时是nan；只有一部分batch给了loss时按这些样本平均"""
+    import math
+    from algorithm.fedavg.base import Metrics
+
+    assert math.isnan(Metrics().loss)
+    output, labels = torch.tensor([[0.2, 0.8], [0.6, 0.4]]), torch.tensor([1, 1])
+    metrics = Metrics().update(output, labels)
+    assert math.isnan(metrics.loss) and metrics.nums == 2
+    metrics.update(output, labels, loss=torch.tensor(0.5))
+    assert metrics.loss == 0.5
+    assert Metrics().merge(Metrics()).merge(metrics).loss == 0.5
+
+
+@check
+def sign_compression_keeps_zeros():
+    """sign压缩：为0的元素（没用到的embedding行、buffer）解压后是0，scale是非0元素|delta|的均值，符号都对"""
+    from algorithm.fedavg.compression import Compressor
+
+    torch.manual_seed(0)
+    delta = torch.zeros(1000, 16)
+    touched = torch.randperm(1000)[:30]
+    delta[touched] = torch.randn(30, 16)
+    delta = delta.reshape(-1)
+    nonzero = delta != 0
+    compressor = Compressor('sign')
+    decoded = compressor.compress(delta).decompress()
+    assert torch.equal(decoded[~nonzero], torch.zeros(int((~nonzero).sum())))
+    torch.testing.assert_close(decoded[nonzero].abs(), delta[nonzero].abs().mean().expand(int(nonzero.sum())))
+    assert torch.equal(torch.sign(decoded), torch.sign(delta))
+    assert compressor.compress(torch.zeros(10)).decompress().abs().sum() == 0
+
+    # error feedback跑几轮：没更新过的位置residual一直是0
+    residual = None
+    for _ in range(5):
+        _, residual, _ = compressor.compress_with_feedback(delta, residual)
+        assert residual[~nonzero].abs().max() == 0
+
+
+@check
+def transport_loopback_round_trip():
+    """transport的编码/解码：共享storage的view、Parameter、非连续tensor、static缓存发第二次时都原样还原"""
+    from algorithm.fedavg import transport
+
+    server, worker = transport.LoopbackConnection.pair()
+    base = torch.randn(10, 8)
+    static = torch.randint(100, (1000, 2))
+    server.encoder.mark_static(static)
+    obj = {'flat': base, 'view': base[2:5], 'transposed': base.t(), 'param': torch.nn.Parameter(torch.randn(3)),
+           'static': static, 'empty': torch.zeros(0), 'ints': torch.arange(5, dtype=torch.int32), 'meta': [1, 'a']}
+    sizes = []
+    for _ in range(2):
+        sizes.append(server.send(transport.TASK, obj))
+        msg_type, received = worker.recv()
+        assert msg_type == transport.TASK and received['meta'] == [1, 'a']
+        assert isinstance(received['param'], torch.nn.Parameter)
+        for key in ['flat', 'view', 'transposed', 'param', 'static', 'empty', 'ints']:
+            assert received[key].dtype == obj[key].dtype and torch.equal(received[key].detach(), obj[key].detach())
+        # view和原tensor还是同一块storage
+        assert received['view'].untyped_storage().data_ptr() == received['flat'].untyped_storage().data_ptr()
+    # 第二次不再发static tensor的数据
+    assert sizes[0] - sizes[1] == static.numel() * static.element_size()
+
+
+@check
+def transport_rejects_wrong_authkey():
+    """HMAC双向认证：authkey相同时两边都通过，不同时两边都抛ConnectionError"""
+    import threading
+    from algorithm.fedavg import transport
+
+    for server_key, worker_key, ok in [(b'secret', b'secret', True), (b'secret', b'guess', False)]:
+        server, worker = transport.LoopbackConnection.pair()
+        errors = {}
+
+        def side(name, connection, key, server_side):
+            try:
+                transport.authenticate(connection, key, server_side=server_side)
+            except ConnectionError as e:
+                errors[name] = e
+
+        threads = [threading.Thread(target=side, args=('server', server, server_key, True)),
+                   threading.Thread(target=side, args=('worker', worker, worker_key, False))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert not any(thread.is_alive() for thread in threads)
+        assert (not errors) if ok else set(errors) == {'server', 'worker'}, errors
+
+
+@check
+def socket_executor_sends_params_once_per_version():
+    """SocketExecutor：每个连接每个版本的全局参数只发一次，结果和串行训练一样"""
+    import copy
+    from algorithm.fedavg.client import Client
+    from algorithm.fedavg.executor import SocketExecutor, SerialExecutor, train_agent
+    from benchmarks.synthetic import movielens_like, client_dataloaders
+    from models.fedavg.movielens.lr import LR
+
+    torch.manual_seed(0)
+    inputs, labels = movielens_like(600)
+    loaders = client_dataloaders(inputs, labels, 6, batch_size=32)
+    model = LR()
+    size = sum(value.numel() * value.element_size() for value in model.state_dict().values())
+    agent = Client(user_id=None, model=model, epoch=1, lr=1e-3, optimizer='adam', device='cpu')
+
+    def tasks(global_params):
+        result = []
+        for client_id, loader in enumerate(loaders):
+            client_agent = copy.copy(agent)
+            client_agent.train_dataloader = client_agent.test_dataloader = loader
+            result.append((client_agent, global_params, 0, client_id, client_id))
+        return result
+
+    params = [copy.deepcopy(model.state_dict()) for _ in range(2)]
+    executor = SocketExecutor(1, 'loopback')
+    try:
+        sent = []
+        for global_params in [params[0], params[0], params[1]]:
+            before = executor.bytes_moved()[0]
+            results = executor.run(train_agent, tasks(global_params))
+            sent.append(executor.bytes_moved()[0] - before)
+        # 第一次：agent模型 + 全局参数；同一个版本再跑：不发参数；新版本：只发一次参数
+        assert sent[1] < size / 10, sent
+        assert size <= sent[2] < 1.5 * size, sent
+        expected = SerialExecutor().run(train_agent, tasks(params[1]))
+        for (got, *_), (want, *_) in zip(results, expected):
+            for key in want:
+                torch.testing.assert_close(got[key], want[key])
+    finally:
+        executor.shutdown()
+
+
+@check
+def negative_resampler_keeps_partition():
+    """--resample_negatives：只改训练集负样本的电影，用户、正样本不变，新的负样本不是这个用户的正样本，同一轮结果一样"""
+    import numpy as np
+    import pandas as pd
+    from data_preprocessing.movielens.ctr.data_loader import NegativeResampler
+    from data_preprocessing.movielens.ctr.negative_sampler import NegativeSampler
+
+    rng = np.random.RandomState(0)
+    # 和data_loader一样用编码后的ID（users, movies表的行号）
+    pos = pd.DataFrame({'user_id': rng.randint(50, size=2000), 'movie_id': rng.randint(200, size=2000)}).drop_duplicates()
+    sampler = NegativeSampler(np.arange(50), np.arange(200), pos['user_id'], pos['movie_id'], ratio_of_neg_to_pos=2, seed=0)
+    neg_users, neg_movies = sampler.sample()
+    all_users = np.concatenate((pos['user_id'], neg_users))
+    all_movies = np.concatenate((pos['movie_id'], neg_movies))
+    slots = np.concatenate((np.full(len(pos), -1), np.arange(len(neg_users))))
+    train = rng.permutation(len(slots))[:len(slots) * 4 // 5]
+    perm = rng.permutation(len(train))
+    inputs = torch.as_tensor(np.stack((all_users[train], all_movies[train]), axis=1)[perm])
+    before = inputs.clone()
+    resampler = NegativeResampler(sampler, slots[train], None, None, ['user_id', 'movie_id'], seed=0).bind(inputs, perm)
+    positives = set(zip(pos['user_id'], pos['movie_id']))
+
+    resampler.resample(1)
+    negative = torch.as_tensor(slots[train][perm] >= 0)
+    assert torch.equal(inputs[~negative], before[~negative]) and torch.equal(inputs[:, 0], before[:, 0])
+    assert not (inputs[negative] == before[negative]).all()
+    assert not any((u, m) in positives for u, m in inputs[negative].tolist())
+    resampled = inputs.clone()
+    resampler.resample(1)
+    assert torch.equal(inputs, resampled)
+
+
+def run_checks(name_filter=''):
+    """返回失败的check的名字"""
+    failures = []
+    for name, fn in CHECKS.items():
+        if name_filter not in name:
+            continue
+        try:
+            fn()
+            print(f"check {name:48s} ok", flush=True)
+        except Exception:
+            traceback.print_exc()
+            print(f"check {name:48s} FAILED", flush=True)
+            failures.append(name)
+    return failures
+
+
+if __name__ == '__main__':
+    from benchmarks.run import _setup_path
+
+    _setup_path()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', type=str, default='', help='只跑名字里包含这个字符串的check')
+    args = parser.parse_args()
+    failures = run_checks(args.filter)
+    if failures:
+        print(f"{len(failures)} check(s) failed: {', '.join(failures)}")
+        sys.exit(1)
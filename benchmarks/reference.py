@@ -0,0 +1,83 @@
+"""
+原来的写法，只用于benchmark对比和正确性检查（checks.py），训练代码不会用到：
+    - dense_linear：wide部分先onehot再过nn.Linear（对应models/fedavg/movielens/wide.py的sparse_linear）
+    - DenseFM, FactorizationMachineLayer：在拼接后的稠密向量上做FM（对应models/fedavg/movielens/fm.py的FM）
+    - naive_aggregate：存下所有客户端的state_dict再按key逐个加权相加（对应aggregator.py的StreamingAggregator）
+    - run_agent_tasks：ProcessExecutor的每个任务都带着整个agent（对应executor.py的ProcessExecutor.worker_tasks）
+"""
+import torch
+import torch.nn as nn
+
+
+def dense_linear(x, linear, field_dims):
+    """原来的写法：先把每个field onehot后拼接，再过nn.Linear"""
+    onehot = [nn.functional.one_hot(x[:, i].long(), num_classes=dim).float() for i, dim in enumerate(field_dims)]
+    return linear(torch.cat(onehot, dim=-1))
+
+
+class FactorizationMachineLayer(nn.Module):
+    """原来的写法：在拼接后的稠密向量上做FM"""
+
+    # O(kn^2) -> O(kn) time complexity
+    def __init__(self, n, k):
+        super().__init__()
+        self.V = nn.Parameter(torch.randn(n, k))  # 随机初始化隐向量矩阵V
+        nn.init.uniform_(self.V, -0.1, 0.1)
+
+    def forward(self, x):
+        # 这里具体写下公式就懂了
+        temp = torch.mm(x, self.V)  # [b, n] * [n, v]
+        sum_pow_interaction = torch.pow(temp, 2)
+        pow_sum_interaction = torch.mm(torch.pow(x, 2), torch.pow(self.V, 2))
+        # output: [batch_size, 1]
+        output = 0.5 * torch.sum(sum_pow_interaction - pow_sum_interaction, dim=1, keepdim=True)
+        return output
+
+
+class DenseFM(nn.Module):
+    """原来的FM模型：user_id, movie_id各128维的embedding拼成256维，再过线性层和FactorizationMachineLayer"""
+
+    def __init__(self, k=10, user_num=6040, movie_num=3883):
+        super(DenseFM, self).__init__()
+        self.user_id_embed = nn.Embedding(user_num, 128)
+        self.movie_id_embed = nn.Embedding(movie_num, 128)
+        self.linear = nn.Linear(128 * 2, 1)
+        self.fm_layer = FactorizationMachineLayer(128 * 2, k)
+        self.sig = nn.Sigmoid()
+
+    def forward(self, x):
+        x = torch.cat((self.user_id_embed(x[:, 0].long()), self.movie_id_embed(x[:, 1].long())), axis=-1)
+        output = self.sig(self.linear(x) + self.fm_layer(x))
+        return torch.cat((1 - output, output), dim=-1)
+
+
+def naive_aggregate(updates):
+    """原来Server._aggregate_and_update_global_params的写法（会原地修改updates[0][0]）"""
+    n = sum([n_k for (params, n_k) in updates])
+    new_params = updates[0][0]
+    for key in updates[0][0].keys():
+        for i in range(len(updates)):
+            client_params, n_k = updates[i]
+            if i == 0:
+                new_params[key] = (client_params[key] * n_k).true_divide(n)
+            else:
+                new_params[key] += (client_params[key] * n_k).true_divide(n)
+    return new_params
+
+
+def run_with_agent(fn, slot, version, agent, *args):
+    """在worker进程里执行：任务带着整个agent，全局参数还是从共享内存读"""
+    from algorithm.fedavg import executor as executor_module
+
+    shared = executor_module._process_shared
+    agent.params_out = None if slot is None else shared.slots[slot]
+    return fn(agent, shared.params(version), *args)
+
+
+def run_agent_tasks(executor, fn, tasks, callback):
+    """原来的做法：每个任务把整个agent pickle给worker，worker每次重新建优化器（executor是ProcessExecutor）"""
+    from algorithm.fedavg import executor as executor_module
+
+    version = executor.worker_tasks(fn, tasks, callback)[0][2]
+    tasks = [(fn, k, version, task[0]) + tuple(task[2:]) for k, task in enumerate(tasks)]
+    return executor_module.ThreadExecutor.run(executor, run_with_agent, tasks, callback)
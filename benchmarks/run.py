@@ -0,0 +1,140 @@
+"""
+离线benchmark（合成数据，不需要下载数据集），在项目根目录运行：
+    python -m benchmarks.run                              # 跑全部，和benchmarks/baseline.json比较
+    python -m benchmarks.run --filter aggregate           # 只跑名字里含aggregate的
+    python -m benchmarks.run --output result.json         # 结果写成json
+    python -m benchmarks.run --save_baseline              # 把这次的结果存成baseline
+    python -m benchmarks.run --check                      # 先跑正确性检查（checks.py），有check失败、
+                                                          # 或者有比baseline慢超过tolerance的就返回1（可以放进CI）
+每个benchmark在单独的子进程里跑，互不影响，peak_rss_mb是这个子进程的峰值内存
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def _setup_path():
+    # algorithm/fedavg下的模块互相用 from base import ... 的方式导入
+    for path in [ROOT, os.path.join(ROOT, 'algorithm', 'fedavg')]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def _run_case(name, quick, queue):
+    _setup_path()
+    import torch
+    from benchmarks.cases import CASES
+    torch.manual_seed(0)
+    fn, kwargs = CASES[name]
+    value, unit, higher_is_better = fn(quick=quick, **kwargs)
+    # linux上ru_maxrss的单位是KB，macOS上是B
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+    queue.put({'value': value, 'unit': unit, 'higher_is_better': higher_is_better, 'peak_rss_mb': peak_rss})
+
+
+def run_case(name, quick=False):
+    """在spawn出来的子进程里跑一个benchmark（干净的进程，峰值内存不受前面的benchmark影响）"""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(name, quick, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"benchmark {name} failed with exit code {process.exitcode}")
+    return queue.get()
+
+
+def compare(results, baseline, tolerance):
+    """
+    和baseline比较，返回变慢超过tolerance（相对值）的benchmark名字
+    ratio > 1 表示比baseline好
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:40s} {result['value']:12.2f} {result['unit']:10s} (no baseline)")
+            continue
+        base = baseline[name]['value']
+        ratio = result['value'] / base if result['higher_is_better'] else base / result['value']
+        status = ''
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressions.append(name)
+        elif ratio > 1 + tolerance:
+            status = 'improved'
+        print(f"{name:40s} {result['value']:12.2f} {result['unit']:10s} baseline {base:12.2f}  x{ratio:.2f} {status}")
+    return regressions
+
+
+if __name__ == '__main__':
+    _setup_path()
+    from benchmarks.cases import CASES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', type=str, default='', help='只跑名字里包含这个字符串的benchmark')
+    parser.add_argument('--quick', action='store_true', help='用更小的数据，只检查能不能跑通')
+    parser.add_argument('--output', type=str, default=None, help='结果写到这个json文件')
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE)
+    parser.add_argument('--save_baseline', action='store_true', help='把这次的结果写进baseline（只更新跑了的benchmark）')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='比baseline差超过这个比例算regression')
+    parser.add_argument('--check', action='store_true', help='先跑checks.py里的正确性检查，有失败或regression时返回1')
+    args = parser.parse_args()
+
+    failures = []
+    if args.check:
+        from benchmarks.checks import run_checks
+        failures = run_checks(args.filter)
+
+    results = {}
+    for name in CASES:
+        if args.filter not in name:
+            continue
+        results[name] = run_case(name, quick=args.quick)
+        result = results[name]
+        print(f"{name:40s} {result['value']:12.2f} {result['unit']:10s} peak {result['peak_rss_mb']:8.1f} MB",
+              flush=True)
+
+    import torch
+    report = {
+        'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+                 'torch': torch.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                 'quick': args.quick},
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('quick') != args.quick:
+            print(f"warning: baseline quick={baseline['meta'].get('quick')}, this run quick={args.quick}")
+        print(f"\ncompare with {args.baseline} ({baseline['meta']['time']}, {baseline['meta']['cpus']} cpus):")
+        regressions = compare(results, baseline['results'], args.tolerance)
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            baseline['results'].update(results)
+            report['results'] = baseline['results']
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+
+    if args.check and (regressions or failures):
+        if failures:
+            print(f"{len(failures)} check(s) failed: {', '.join(failures)}")
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,33 @@
+"""
+离线的合成数据（不需要下载MNIST/MovieLens），形状和真实数据一样：
+    - MNIST：和DummyData一样用np.random生成 [n, 1, 28, 28] 的图片和0-9的label
+    - MovieLens CTR：每个样本是(user_id, movie_id)两个ID，label是0/1
+客户端数据集和真实的data_loader一样，所有客户端共用一份tensor，每个客户端一个下标区间
+"""
+import numpy as np
+import torch
+
+from data_preprocessing.client_dataset import range_datasets, make_dataloader
+
+
+def mnist_like(num_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    inputs = torch.as_tensor(rng.randn(num_samples, 1, 28, 28), dtype=torch.float32)
+    labels = torch.as_tensor(rng.randint(10, size=num_samples), dtype=torch.long)
+    return inputs, labels
+
+
+def movielens_like(num_samples, user_num=6040, movie_num=3883, seed=0):
+    rng = np.random.RandomState(seed)
+    inputs = torch.as_tensor(np.stack([rng.randint(user_num, size=num_samples),
+                                       rng.randint(movie_num, size=num_samples)], axis=1), dtype=torch.long)
+    # label和ID有关，模型能学到一点东西
+    labels = torch.as_tensor((inputs[:, 0] + inputs[:, 1]) % 3 == 0, dtype=torch.long)
+    return inputs, labels
+
+
+def client_dataloaders(inputs, labels, num_clients, batch_size, shuffle=True):
+    """和data_loader.split_data_iid一样每个客户端一段连续的样本"""
+    return [make_dataloader(dataset, batch_size=batch_size, shuffle=shuffle)
+            for dataset in range_datasets(inputs, labels, num_clients)]
+
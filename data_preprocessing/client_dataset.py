@@ -0,0 +1,198 @@
+"""
+客户端数据集：所有客户端共用一份存储（整个train/test的inputs和labels tensor），每个客户端只保存自己的下标，
+iid划分时是一个连续的下标区间（slice，取出来是view），non-iid划分时是一个下标数组
+这样客户端再多，内存也只有一份原始数据的大小；ID特征用int64存，图片用uint8存，用到的时候再转float：
+TensorBatchLoader取出的是原始的batch，训练/评估时放到device上之后再对整个batch做transform（见to_device）
+客户端很多（10万以上）时连每个客户端一个dataset/dataloader对象都嫌多，划分结果用ClientPartition保存，
+只在客户端被选中时才创建它的dataset和dataloader
+"""
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+class IndexedDataset(Dataset):
+    def __init__(self, inputs, labels, index=None, transform=None):
+        """
+        Args:
+            inputs, labels: 所有客户端共用的tensor
+            index: slice(start, stop) 或者 LongTensor，None表示整个数据集
+            transform: 对inputs做的变换（单个样本和整个batch都要能用），如uint8图片转float并归一化
+        """
+        self.inputs = inputs
+        self.labels = labels
+        self.index = slice(0, len(labels)) if index is None else index
+        self.transform = transform
+
+    def __len__(self):
+        if isinstance(self.index, slice):
+            return self.index.stop - self.index.start
+        return len(self.index)
+
+    def _position(self, i):
+        if isinstance(self.index, slice):
+            return self.index.start + i
+        return self.index[i]
+
+    def __getitem__(self, i):
+        position = self._position(i)
+        x = self.inputs[position]
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, self.labels[position]
+
+    def tensors(self, raw=False):
+        """一次取出这个客户端的所有数据，slice时不复制；raw=True时不做transform"""
+        x, y = self.inputs[self.index], self.labels[self.index]
+        if self.transform is not None and not raw:
+            x = self.transform(x)
+        return x, y
+
+
+def range_datasets(inputs, labels, num_clients, transform=None):
+    """
+    和np.array_split一样把[0, n)平均切成num_clients段（不均匀不会报错），每个客户端一段
+    """
+    n = len(labels)
+    size, extra = divmod(n, num_clients)
+    datasets, start = [], 0
+    for k in range(num_clients):
+        stop = start + size + (1 if k < extra else 0)
+        datasets.append(IndexedDataset(inputs, labels, slice(start, stop), transform))
+        start = stop
+    return datasets
+
+
+def index_datasets(inputs, labels, client_indices, transform=None):
+    """每个客户端一个下标数组（如狄利克雷划分的结果）"""
+    return [IndexedDataset(inputs, labels, torch.as_tensor(index, dtype=torch.long), transform)
+            for index in client_indices]
+
+
+class ClientPartition:
+    """
+    一个数据集（train或test）在所有客户端上的划分，只保存紧凑的元数据：
+        - iid：客户端k是一个连续区间 [bounds[k], bounds[k+1])
+        - non-iid：所有客户端的下标按客户端顺序拼成一个order，客户端k的下标是order[bounds[k]:bounds[k+1]]
+    partition[k]在用到时才创建客户端k的dataloader，用法和原来的dataloader列表一样
+    """
+
+    def __init__(self, inputs, labels, bounds, order=None, batch_size=32, shuffle=True, transform=None):
+        self.inputs = inputs
+        self.labels = labels
+        self.bounds = np.asarray(bounds, dtype=np.int64)
+        self.order = order
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    @property
+    def sizes(self):
+        """每个客户端的样本数"""
+        return np.diff(self.bounds)
+
+    def dataset(self, k):
+        if not 0 <= k < len(self):
+            raise IndexError(f"client {k} out of range")
+        start, stop = int(self.bounds[k]), int(self.bounds[k + 1])
+        index = slice(start, stop) if self.order is None else self.order[start:stop]
+        return IndexedDataset(self.inputs, self.labels, index, self.transform)
+
+    def __getitem__(self, k):
+        return make_dataloader(self.dataset(k), batch_size=self.batch_size, shuffle=self.shuffle)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def tensors(self, raw=False):
+        """所有客户端的数据按客户端顺序拼起来（评估用），iid时是一个view，不复制"""
+        start, stop = int(self.bounds[0]), int(self.bounds[-1])
+        index = slice(start, stop) if self.order is None else self.order[start:stop]
+        return IndexedDataset(self.inputs, self.labels, index, self.transform).tensors(raw)
+
+
+def range_partition(inputs, labels, num_clients, batch_size, shuffle, transform=None, order=None, min_samples=2):
+    """
+    和range_datasets的划分一样，但只保存num_clients + 1个边界
+    order: 不为None时切的是按order重排后的样本（只重排下标，不复制数据）
+    min_samples: 每个客户端至少有多少个样本，和partition.data_split一样默认2（1个样本的客户端没法训练带BatchNorm的模型）
+    """
+    size, extra = divmod(len(labels), num_clients)
+    if size < min_samples:
+        raise ValueError(f"{len(labels)} samples are not enough for {num_clients} clients "
+                         f"with at least {min_samples} samples each")
+    counts = np.full(num_clients, size, dtype=np.int64)
+    counts[:extra] += 1
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    if order is not None:
+        order = torch.as_tensor(order, dtype=torch.long)
+    return ClientPartition(inputs, labels, bounds, order, batch_size=batch_size, shuffle=shuffle, transform=transform)
+
+
+def index_partition(inputs, labels, client_indices, batch_size, shuffle, transform=None):
+    """和index_datasets的划分一样，但所有客户端的下标拼在一个tensor里"""
+    counts = np.array([len(index) for index in client_indices], dtype=np.int64)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    order = torch.as_tensor(np.concatenate(client_indices) if len(client_indices) > 0 else [], dtype=torch.long)
+    return ClientPartition(inputs, labels, bounds, order, batch_size=batch_size, shuffle=shuffle, transform=transform)
+
+
+class TensorBatchLoader:
+    """
+    数据已经是tensor时代替torch的DataLoader：每个epoch打乱一次下标，再按batch_size切片，
+    不需要像DataLoader那样对每个样本调用__getitem__再collate，对CTR这种每个样本只有两个ID的数据快很多
+    shuffle（训练）时最后一个batch只有1个样本就丢掉（下个epoch重新打乱，丢的是另一个样本）：
+    训练模式的BatchNorm1d在只有1个样本的batch上会报错。只有1个样本的客户端没法训练带BatchNorm的模型，
+    划分数据时要保证每个客户端至少2个样本（见partition.data_split的min_samples）
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, generator=None):
+        """
+        Args:
+            dataset: IndexedDataset，取出的batch不做dataset.transform，由使用者放到device上之后再做（见to_device）
+            generator: 打乱用的torch.Generator，None时和DataLoader一样用全局的torch随机数
+        """
+        self.dataset = dataset
+        self.transform = dataset.transform
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.num_samples = len(dataset)
+        # Client.train中用train_dataloader.sampler.num_samples得到样本数，这里保持一样的用法
+        self.sampler = self
+
+    def _stop(self):
+        """最后一个batch的结束位置（不含被丢掉的1个样本）"""
+        if self.shuffle and self.num_samples > 1 and self.num_samples % self.batch_size == 1:
+            return self.num_samples - 1
+        return self.num_samples
+
+    def __len__(self):
+        return (self._stop() + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        x, y = self.dataset.tensors(raw=True)
+        if self.shuffle:
+            perm = torch.randperm(self.num_samples, generator=self.generator)
+            for start in range(0, self._stop(), self.batch_size):
+                index = perm[start:start + self.batch_size]
+                yield x[index], y[index]
+        else:
+            for start in range(0, self.num_samples, self.batch_size):
+                yield x[start:start + self.batch_size], y[start:start + self.batch_size]
+
+
+def to_device(inputs, device, transform=None):
+    """把一个batch的inputs放到device上，再在device上对整个batch做transform（如uint8图片归一化）"""
+    inputs = inputs.to(device)
+    return inputs if transform is None else transform(inputs)
+
+
+def make_dataloader(dataset, batch_size, shuffle):
+    if isinstance(dataset, IndexedDataset):
+        return TensorBatchLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
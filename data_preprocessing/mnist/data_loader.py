@@ -1,11 +1,9 @@
-import random
 import numpy as np
-import bisect
 import torch
-from data_preprocessing.mnist.datasets import get_datasets
+from data_preprocessing.mnist.datasets import get_datasets, normalize
+from data_preprocessing.partition import data_split
+from data_preprocessing.client_dataset import IndexedDataset, range_partition, index_partition, make_dataloader
 from sklearn.utils import shuffle
-from torch.utils.data import TensorDataset
-from itertools import accumulate
 import argparse
 
 
@@ -55,127 +53,54 @@ def partition_data(partition_method="hetero", client_num_in_total=None, batch_si
 
 
 def centralized_data(train_data, test_data, batch_size=32):
+    """所有数据一个客户端，和iid、non-iid一样直接用uint8的图片，每个batch在device上归一化"""
     train_dataloader, test_dataloader = [], []
 
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True)
+    train_loader = make_dataloader(IndexedDataset(train_data.data, train_data.targets, transform=normalize),
+                                   batch_size=batch_size, shuffle=True)
     train_dataloader.append(train_loader)
 
-    test_loader = torch.utils.data.DataLoader(test_data, batch_size=batch_size, shuffle=True)
+    test_loader = make_dataloader(IndexedDataset(test_data.data, test_data.targets, transform=normalize),
+                                  batch_size=batch_size, shuffle=True)
     test_dataloader.append(test_loader)
 
     return train_dataloader, test_dataloader
 
 
-def split_data_iid(train_data, test_data, num_clients, batch_size):
-    train_dataloader, test_dataloader = [], []
+def iid_partition(data, num_clients, batch_size):
+    """
+    用固定的seed把所有样本打乱一次，再平均切成num_clients段（和原来先shuffle再np.array_split的划分一样）
+    打乱的只是下标，图片还是memmap里的那一份，不复制
+    """
+    perm = shuffle(np.arange(len(data.targets)), random_state=42)
+    return range_partition(data.data, data.targets, num_clients, batch_size, shuffle=True, transform=normalize,
+                           order=perm)
 
-    # =============== train_data =====================
-    # 随机打乱数据集的seed，划分成iid
-    train_X = train_data.data.reshape((len(train_data.data), 1, 28, 28))
-    train_X = train_X.numpy()
-    train_Y = train_data.targets.numpy()
-    train_X, train_Y = shuffle(train_X, train_Y, random_state=42)
-
-    # array_split 划分数据集，不均匀不会报错
-    train_X_list = np.array_split(train_X, num_clients)
-    train_Y_list = np.array_split(train_Y, num_clients)
-
-    for X, Y in zip(train_X_list, train_Y_list):
-        X_train = torch.as_tensor(X, dtype=torch.float32)
-        Y_train = torch.as_tensor(Y, dtype=torch.long)
-        train_ids = TensorDataset(X_train, Y_train)
-        train_loader = torch.utils.data.DataLoader(dataset=train_ids, batch_size=batch_size, shuffle=True)
-        train_dataloader.append(train_loader)
-
-    # =============== test_data =====================
-    # 随机打乱数据集的seed，划分成iid
-    test_X = test_data.data.reshape((len(test_data.data), 1, 28, 28))
-    test_X = test_X.numpy()
-    test_Y = test_data.targets.numpy()
-    test_X, test_Y = shuffle(test_X, test_Y, random_state=42)
-
-    # array_split 划分数据集，不均匀不会报错
-    test_X_list = np.array_split(test_X, num_clients)
-    test_Y_list = np.array_split(test_Y, num_clients)
-
-    for X, Y in zip(test_X_list, test_Y_list):
-        X_test = torch.as_tensor(X, dtype=torch.float32)
-        Y_test = torch.as_tensor(Y, dtype=torch.long)
-        test_ids = TensorDataset(X_test, Y_test)
-        test_loader = torch.utils.data.DataLoader(dataset=test_ids, batch_size=batch_size, shuffle=True)
-        test_dataloader.append(test_loader)
-
-    # b = np.array([[1,2],[3,4],[5,6],[7,8]])
-    # c = np.array([0, 1, 2, 3])
-    return train_dataloader, test_dataloader
+
+def split_data_iid(train_data, test_data, num_clients, batch_size):
+    """
+    返回的是ClientPartition，客户端的dataloader用到时才创建
+    原来iid划分时直接用0-255的像素值训练，没有归一化，现在和non-iid、centralized一样归一化
+    """
+    return iid_partition(train_data, num_clients, batch_size), iid_partition(test_data, num_clients, batch_size)
 
 
 def split_data_non_iid(train_data, test_data, num_clients, alpha, batch_size):
     """
     使用狄利克雷分布划分MNIST数据集为non-iid数据集
+    只根据targets划分出每个客户端的样本下标，所有客户端共用一份uint8图片，每个batch在device上归一化
     """
-    train_dataloader, test_dataloader = [], []
+    clients_train_index = data_split(train_data.targets.numpy(), num_clients, alpha)
+    train_dataloader = index_partition(train_data.data, train_data.targets, clients_train_index, batch_size,
+                                       shuffle=True, transform=normalize)
 
-    clients_train_data = data_split(train_data, num_clients, alpha)
-    for client_train_data in clients_train_data:
-        train_dataloader.append(data_to_dataloader(client_train_data, batch_size))
-
-    clients_test_data = data_split(test_data, num_clients, alpha)
-    for client_test_data in clients_test_data:
-        test_dataloader.append(data_to_dataloader(client_test_data, batch_size))
+    clients_test_index = data_split(test_data.targets.numpy(), num_clients, alpha)
+    test_dataloader = index_partition(test_data.data, test_data.targets, clients_test_index, batch_size,
+                                      shuffle=True, transform=normalize)
 
     return train_dataloader, test_dataloader
 
 
-# *****************************************************************************************
-#                         狄利克雷分布产生non-iid数据集
-# *****************************************************************************************
-
-def data_split(data, num_clients, alpha):
-    # alpha不能过小，不然有些客户端会只有0个样本
-    # 解决方法：每个客户端都事先加点样本，或者概率加上一个0.1后作归一化(zs)
-    # return a dict user2data
-    label2data = split_by_label(data)
-    user2data = {i: [] for i in range(num_clients)}
-
-    for label, samples in label2data.items():
-        ret = dirichlet_partition(samples, num_clients, alpha)
-        for user, sample in ret.items():
-            user2data[user] += sample  # [(data_i, 5), (data_j, 5)] += [(data_k, 3), (data_t, 3), ...]
-
-    return list(user2data.values())  # 得到每个客户端划分好后的数据集[client_1_data, ..., client_n_data]
-
-
-def dirichlet_partition(samples, num_clients, alpha):
-    """O(n)"""
-    ret = {i: [] for i in range(num_clients)}
-    random.shuffle(samples)
-    # TODO: what does it mean
-    prop = np.random.dirichlet(np.repeat(alpha, num_clients))
-    prop = list(accumulate(prop))
-    i = 0
-    for idx in range(0, len(prop)):
-        pre = i
-        while i / (len(samples)) < prop[idx]:
-            i += 1
-        ret[idx] += samples[pre:i]
-    return ret
-
-
-def split_by_label(data):
-    ret = {}
-    for sample, label in data:  # sample shape: torch.Size([1, 28, 28])
-        if label not in ret.keys():
-            ret[label] = []
-        ret[label].append((sample, label))
-    # ret: {0: [(data_i, 0), (data_j, 0)], 1: [..., ..., ...], ..., 9: [..., ...]}
-    return ret
-
-
-def data_to_dataloader(data, batch_size):
-    return torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=True)
-
-
 # *****************************************************************************************
 
 if __name__ == "__main__":
@@ -1,26 +1,90 @@
 """
-Pytorch torchvision  MNIST datasets
+MNIST数据集
+第一次运行时用torchvision下载MNIST，把图片和label预处理成
+    {root}/MNIST/store/{train,test}-images.u8   uint8 [n, 1, 28, 28]，np.memmap
+    {root}/MNIST/store/{train,test}-labels.npy  int64 [n]
+之后直接memmap读进来，不再经过torchvision，也不对每张图片调用ToTensor() + Normalize
+图片一直是uint8，归一化（normalize）在取出一个batch、放到device上之后对整个batch一次做完，
+iid、non-iid和centralized划分都一样
 """
+import os
+
+import numpy as np
 import torch
 import torchvision
-import torchvision.transforms as transforms
+
+MEAN, STD = 0.1307, 0.3081
+
+
+def normalize(x):
+    """uint8图片 -> 和torchvision的ToTensor() + Normalize((0.1307,), (0.3081,))一样的float"""
+    return (x.float() / 255).sub_(MEAN).div_(STD)
+
+
+class MNISTStore:
+    """一个划分（train或test）的图片和label，属性名和torchvision.datasets.MNIST一样"""
+
+    def __init__(self, data, targets):
+        self.data = data  # uint8 [n, 1, 28, 28]
+        self.targets = targets  # int64 [n]
+
+    def __len__(self):
+        return len(self.targets)
 
 
-def get_datasets():
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,))
-    ])
+def _store_paths(root, split):
+    folder = os.path.join(root, 'MNIST', 'store')
+    return os.path.join(folder, f'{split}-images.u8'), os.path.join(folder, f'{split}-labels.npy')
 
-    train_data = torchvision.datasets.MNIST(root='../../data/', train=True, download=True, transform=transform)
-    test_data = torchvision.datasets.MNIST(root='../../data/', train=False, download=True, transform=transform)
-    return train_data, test_data
+
+def _build_store(root, split):
+    images_path, labels_path = _store_paths(root, split)
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+    dataset = torchvision.datasets.MNIST(root=root, train=split == 'train', download=True)
+    images = dataset.data.numpy()
+    # 先写到临时文件再改名，中途中断不会留下不完整的文件
+    images_tmp = np.memmap(images_path + '.tmp', dtype=np.uint8, mode='w+', shape=(len(images), 1, 28, 28))
+    images_tmp[:, 0] = images
+    images_tmp.flush()
+    del images_tmp
+    with open(labels_path + '.tmp', 'wb') as f:
+        np.save(f, dataset.targets.numpy().astype(np.int64))
+    os.replace(images_path + '.tmp', images_path)
+    os.replace(labels_path + '.tmp', labels_path)
+
+
+def load_store(root, split):
+    images_path, labels_path = _store_paths(root, split)
+    if not (os.path.exists(images_path) and os.path.exists(labels_path)):
+        _build_store(root, split)
+    # mode='c'（copy-on-write）：torch认为是可写的，但不会改到文件
+    images = np.memmap(images_path, dtype=np.uint8, mode='c').reshape(-1, 1, 28, 28)
+    targets = np.load(labels_path)
+    return MNISTStore(torch.from_numpy(images), torch.from_numpy(targets))
+
+
+def get_datasets(root='../../data/'):
+    return load_store(root, 'train'), load_store(root, 'test')
 
 
 if __name__ == "__main__":
-    classes = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
+    import time
+    import torchvision.transforms as transforms
+
+    # 原来：torchvision的MNIST，每张图片ToTensor() + Normalize，一次取一张 vs uint8 memmap，每个batch一次归一化
+    start = time.perf_counter()
     train_data, test_data = get_datasets()
-    print(train_data.data.shape)
+    print(f"load store: {time.perf_counter() - start:.3f}s")
+    print(train_data.data.shape, train_data.data.dtype)
     print(train_data.targets.shape)
     print(test_data.data.shape)
     print(test_data.targets.shape)
+
+    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((MEAN,), (STD,))])
+    torchvision_data = torchvision.datasets.MNIST(root='../../data/', train=True, download=True, transform=transform)
+    start = time.perf_counter()
+    per_item = torch.stack([torchvision_data[i][0] for i in range(len(torchvision_data))])
+    print(f"torchvision per-item transform: {time.perf_counter() - start:.3f}s")
+    start = time.perf_counter()
+    batched = torch.cat([normalize(train_data.data[i:i + 4096]) for i in range(0, len(train_data), 4096)])
+    print(f"batched normalize: {time.perf_counter() - start:.3f}s, max difference {(per_item - batched).abs().max():.2e}")
@@ -1,14 +1,16 @@
 # 这里要写完整的路径
-from data_preprocessing.movielens.ctr.datasets import get_ctr_movielens_datasets, get_negative_samples_per_user
+from data_preprocessing.movielens.ctr.datasets import get_ctr_movielens_datasets, get_id_vocab, get_ctr_features, \
+    CTR_FIELDS
+from data_preprocessing.movielens.ctr.negative_sampler import NegativeSampler
 from sklearn.model_selection import train_test_split
 import torch
-from torch.utils.data import Dataset, TensorDataset, DataLoader
+from torch.utils.data import Dataset, DataLoader
+from data_preprocessing.partition import data_split
+from data_preprocessing.client_dataset import IndexedDataset, range_partition, index_partition, make_dataloader
 import numpy as np
 import pandas as pd
 from sklearn.utils import shuffle
 import argparse
-import random
-from itertools import accumulate
 
 
 def parse_args():
@@ -23,6 +25,9 @@ def parse_args():
         "ratio_of_neg_to_pos": 1,
         "partition_alpha": 0.8,  # 用狄利克雷划分non-iid可能出现客户端数据集为0的情况
         "proportion_of_test_datasets": 0.1,
+        "ctr_fields": 'user_id,movie_id',
+        "movielens_path": None,
+        "resample_negatives": False,
     }
 
     parser = argparse.ArgumentParser(description='*******data_loader*******')
@@ -36,47 +41,60 @@ def parse_args():
     parser.add_argument('--partition_alpha', type=float, default=0.9, metavar='RPN',
                         help='partition_alpha')
 
+    parser.add_argument('--ctr_fields', type=str, default='user_id,movie_id',
+                        help='comma separated input fields, from ' + ', '.join(CTR_FIELDS) +
+                             '; must start with user_id,movie_id (the fm model uses all of them, '
+                             'the other models only user_id and movie_id)')
+
+    parser.add_argument('--movielens_path', type=str, default=None,
+                        help='folder of the movielens dataset (ml-1m, ml-10m or ml-20m), default data/MovieLens/1m')
+
+    parser.add_argument('--resample_negatives', action='store_true',
+                        help='draw new negative movies for the training set every round (the test set keeps its '
+                             'negatives); not supported with --executor socket or --mode async')
+
     parser.set_defaults(**config)
 
     args = parser.parse_known_args()[0]
     return args
 
 
-def get_train_test_dataset(args):
-    users, movies, ratings, all_data = get_ctr_movielens_datasets()  # 导入的模块函数
+def ctr_field_spec(args=None):
+    """
+    输入x每一列对应的field，user_id, movie_id的取值个数是数据里的ID个数（模型的embedding按这个大小创建）
+    Returns: (field_dims, multi_hot)，multi_hot是multi-hot的field在x中的列号
+    """
+    args = args or parse_args()
+    fields = args.ctr_fields.split(',')
+    if fields[:2] != ['user_id', 'movie_id']:
+        raise ValueError(f"--ctr_fields must start with user_id,movie_id, got {fields}")
+    user_id_vocab, movie_id_vocab = get_id_vocab(args.movielens_path)
+    field_dims = [len(user_id_vocab), len(movie_id_vocab)] + [CTR_FIELDS[field][0] for field in fields[2:]]
+    return field_dims, [i for i, field in enumerate(fields) if CTR_FIELDS[field][1]]
 
-    # 生成负样本
-    df_negative_items = get_negative_samples_per_user(users, movies, ratings,
-                                                      ratio_of_neg_to_pos=args.ratio_of_neg_to_pos)
 
-    ratings = ratings.append(df_negative_items).reset_index(drop=True)
-    ratings.drop(columns=['timestamp'], inplace=True)
+def get_train_test_dataset(args):
+    # 第一次运行会把预处理结果缓存到data/MovieLens/1m/cache，之后直接读缓存；all_data这里用不到，不用合并
+    users, movies, ratings, all_data = get_ctr_movielens_datasets(args.movielens_path, merge=False)  # 导入的模块函数
 
-    # 生成负样本后再进行下面操作
     # ----------- embedding 准备工作 ----------------
-    # 我们需要对user_id, movie_id特征创建字典（方便后续embedding）
-    user_id_origin = list(users['user_id'])
-    user_id_dic = {}
-    for user_id in user_id_origin:
-        if user_id not in user_id_dic:
-            user_id_dic[user_id] = len(user_id_dic)
-
-    # 在movies表中建立dict比较快
-    movie_id_origin = list(movies['movie_id'])
-    movie_id_dic = {}
-    for movie_id in movie_id_origin:
-        if movie_id not in movie_id_dic:
-            movie_id_dic[movie_id] = len(movie_id_dic)
-    # movie_id_dic: {1:0, ..., 3952: 3882}
-
-    # 把ratings中的特征转换为dict映射后的值
-    # apply is very fast
-    ratings['user_id'] = ratings['user_id'].apply(lambda x: user_id_dic[x])
-    ratings['movie_id'] = ratings['movie_id'].apply(lambda x: movie_id_dic[x])
-
-    # movielens点击率预测label设置
-    # ratings.loc[ratings['rating'] == 0, 'rating'] = 0 # 否则设为0
-    ratings.loc[ratings['rating'] >= 1, 'rating'] = 1  # 评过分的record设为1
+    # 我们需要对user_id, movie_id特征编码成0..n-1（方便后续embedding）
+    # 预处理时每一块ratings已经按编码表编好了（见datasets.fill_ratings），编码后的ID就是users, movies表的行号，
+    # ratings是缓存里memory-map的列，这里不用再整列查表
+
+    # 生成负样本（和get_negative_samples_per_user一样，sampler留着给--resample_negatives每轮重新采样）
+    sampler = NegativeSampler(np.arange(len(users)), np.arange(len(movies)), ratings['user_id'], ratings['movie_id'],
+                              ratio_of_neg_to_pos=args.ratio_of_neg_to_pos)
+    negative_users, negative_movies = sampler.sample()
+
+    # 正样本和负样本拼在一起（只拼要用的列），negative_slot是每条负样本是第几个负样本（正样本为-1），
+    # 打乱和划分之后还能找到它是哪个用户的第几个负样本
+    num_positives, num_negatives = len(ratings['user_id']), len(negative_users)
+    ratings = {'user_id': np.concatenate((ratings['user_id'], negative_users)),
+               'movie_id': np.concatenate((ratings['movie_id'], negative_movies)),
+               # movielens点击率预测label设置：评过分的record设为1，负样本设为0（ml-10m、ml-20m有0.5分，不能用>= 1）
+               'rating': np.concatenate((np.asarray(ratings['rating']) > 0, np.zeros(num_negatives, dtype=bool))),
+               'negative_slot': np.concatenate((np.full(num_positives, -1), np.arange(num_negatives)))}
 
     # 对year进行归一化（后来我改成了onehot）
     # data['year'] = data['year'].astype(int)
@@ -86,15 +104,15 @@ def get_train_test_dataset(args):
     # features = list(data.columns.drop(labels=['rating', 'user_id', 'movie_id']))
     # len(features)
 
-    features = ['user_id', 'movie_id']
-    labels = ['rating']
+    features = args.ctr_fields.split(',')
 
-    # 打乱数据集
-    ratings = shuffle(ratings, random_state=42)
+    # 打乱数据集（和原来对DataFrame做shuffle(ratings, random_state=42)的顺序一样）
+    perm = shuffle(np.arange(num_positives + num_negatives), random_state=42)
+    ratings = {column: values[perm] for column, values in ratings.items()}
 
-    # TODO: 100万条数据我先取前面10000条，这样速度快一点
-    X = ratings[features][:200000]
-    X = X.values  # pandas -> numpy
+    # 用全部数据（原来为了速度只取前20万条）
+    # user_id, movie_id之外的field（gender, age, occupation, genres）按编码后的ID从users, movies表里取
+    X = get_ctr_features(ratings, users, movies, features)  # pandas -> numpy
 
     # if args.id_onehot == True:
     #     X['user_id'] = X['user_id'].apply(str)
@@ -104,14 +122,70 @@ def get_train_test_dataset(args):
     #     print("End onehot")
 
 
-    Y = ratings[labels][:200000]
-    Y = Y.values.reshape(len(Y))  # pandas -> numpy
+    Y = ratings['rating'].astype(np.int64)
     # array([1, 1, 1, ..., 0, 1, 1])
 
     # 利用train_test_split将数据集随机划分为训练集和测试集 4:1 (这里有个随机种子seed)
-    train_data, test_data, train_label, test_label = train_test_split(X, Y, test_size=args.proportion_of_test_datasets,
-                                                                      random_state=42)
-    return train_data, test_data, train_label, test_label
+    # negative_slot跟着一起划分，多传一个数组不影响X, Y的划分结果
+    train_data, test_data, train_label, test_label, train_slots, _ = train_test_split(
+        X, Y, ratings['negative_slot'], test_size=args.proportion_of_test_datasets, random_state=42)
+    resampler = None
+    if args.resample_negatives:
+        resampler = NegativeResampler(sampler, train_slots, users, movies, features)
+    return train_data, test_data, train_label, test_label, resampler
+
+
+class NegativeResampler:
+    """
+    --resample_negatives：每轮给训练集里的负样本重新采样电影（用户和label不变），原地改写所有客户端共用的inputs tensor，
+    所以客户端的划分、样本数都不变；测试集的负样本不重新采样，每轮的test loss还可以互相比较
+    用sampler.iter_samples一次只生成一部分用户的负样本，不用再生成一整张负样本表
+    新采的负样本只避开这个用户的正样本，可能和测试集里这个用户的负样本重复
+    """
+
+    def __init__(self, sampler, train_slots, users, movies, features, seed=None):
+        """
+        Args:
+            sampler: 生成原来的负样本的NegativeSampler（用编码后的ID，采出来的直接是users, movies表的行号）
+            train_slots: 训练集每一行的negative_slot（正样本为-1）
+            seed: None时从np.random的全局状态中取一个种子（和NegativeSampler一样受setup_seed控制）
+        """
+        self.sampler = sampler
+        self.train_slots = np.asarray(train_slots)
+        self.users, self.movies, self.features = users, movies, features
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.inputs, self.rows, self.slots = None, None, None
+
+    def bind(self, inputs, perm=None):
+        """
+        inputs: 划分后所有客户端共用的训练集tensor，perm: inputs的第i行是划分前训练集的第perm[i]行（None表示没有重排）
+        """
+        slots = self.train_slots if perm is None else self.train_slots[perm]
+        rows = np.nonzero(slots >= 0)[0]
+        order = np.argsort(slots[rows], kind='stable')
+        self.inputs, self.rows, self.slots = inputs, rows[order], slots[rows][order]
+        return self
+
+    def resample(self, round_th):
+        """重新采样第round_th轮的负样本，只由seed和round_th决定（resume之后的数据和不中断时一样）"""
+        rng = np.random.default_rng((self.seed, round_th))
+        self.sampler.rng = rng
+        start = 0
+        for user_ids, item_ids in self.sampler.iter_samples():
+            stop = start + len(user_ids)
+            # 每个用户的负样本数量每次都一样，按用户顺序排好，所以第j个负样本还是原来第j个负样本那个用户的；
+            # 同一个用户的负样本是按电影排好序的，打乱之后再放回这个用户的位置，不然落在训练集里的总是ID小的电影
+            group = np.cumsum(np.concatenate(([False], user_ids[1:] != user_ids[:-1])))
+            order = np.lexsort((rng.random(len(user_ids)), group))
+            lo, hi = np.searchsorted(self.slots, [start, stop])
+            take = order[self.slots[lo:hi] - start]
+            chunk = {'user_id': user_ids[take], 'movie_id': item_ids[take]}
+            self.inputs[torch.as_tensor(self.rows[lo:hi])] = torch.as_tensor(
+                get_ctr_features(chunk, self.users, self.movies, self.features), dtype=self.inputs.dtype)
+            start = stop
+        if start != self.sampler.num_neg.sum():
+            raise RuntimeError(f"resampled {start} negatives, expected {int(self.sampler.num_neg.sum())}")
+        return self
 
 
 class MyDataset(Dataset):
@@ -128,174 +202,101 @@ class MyDataset(Dataset):
         return len(self.label)
 
 
-def partition_data(partition_method="homo", client_num_in_total=None, batch_size=None):
+def partition_data(partition_method="homo", client_num_in_total=None, batch_size=None, return_resampler=False):
+    """
+    return_resampler: 为True时多返回一个NegativeResampler（没有--resample_negatives时为None），每轮调用它的resample
+    """
     # TODO: add parse_args
     args = parse_args()
 
-    train_data, test_data, train_label, test_label = get_train_test_dataset(args)
+    train_data, test_data, train_label, test_label, resampler = get_train_test_dataset(args)
 
     if partition_method == "homo":
         train_dataloader, test_dataloader = split_data_iid(train_data, test_data, train_label, test_label,
                                                            num_clients=client_num_in_total,
-                                                           batch_size=batch_size)
+                                                           batch_size=batch_size, resampler=resampler)
     elif partition_method == "hetero":
         # alpha越小,异质程度越高
         train_dataloader, test_dataloader = split_data_non_iid(train_data, test_data, train_label, test_label,
                                                                num_clients=client_num_in_total,
                                                                alpha=args.partition_alpha,
-                                                               batch_size=batch_size)
+                                                               batch_size=batch_size, resampler=resampler)
     elif partition_method == "centralized":
         train_dataloader, test_dataloader = centralized_data(train_data, test_data, train_label, test_label,
-                                                             batch_size=batch_size)
+                                                             batch_size=batch_size, resampler=resampler)
+    if return_resampler:
+        return train_dataloader, test_dataloader, resampler
     return train_dataloader, test_dataloader
 
 
-def split_data_iid(train_data, test_data, train_label, test_label, num_clients, batch_size):
-    train_dataloader, test_dataloader = [], []
-
+def split_data_iid(train_data, test_data, train_label, test_label, num_clients, batch_size, resampler=None):
+    """
+    所有客户端共用一份int64的ID tensor，先整体打乱一次，每个客户端只保存自己那一段的下标区间
+    （和原来先shuffle再np.array_split得到的每个客户端的数据完全一样）
+    返回的是ClientPartition，客户端的dataloader用到时才创建
+    """
     # =============== train_data =====================
     # 随机打乱数据集的seed，划分成iid
-    train_X = train_data
-    train_Y = train_label
-    train_X, train_Y = shuffle(train_X, train_Y, random_state=12)
-
-    # array_split 划分数据集，不均匀不会报错
-    train_X_list = np.array_split(train_X, num_clients)
-    train_Y_list = np.array_split(train_Y, num_clients)
-
-    for X, Y in zip(train_X_list, train_Y_list):
-        X_train = torch.as_tensor(X, dtype=torch.float32)
-        Y_train = torch.as_tensor(Y, dtype=torch.long)
-        train_ids = MyDataset(X_train, Y_train)
-        train_loader = torch.utils.data.DataLoader(dataset=train_ids, batch_size=batch_size, shuffle=True)
-        train_dataloader.append(train_loader)
+    perm = shuffle(np.arange(len(train_label)), random_state=12)
+    X_train = torch.as_tensor(train_data[perm], dtype=torch.long)
+    Y_train = torch.as_tensor(train_label[perm], dtype=torch.long)
+    train_dataloader = range_partition(X_train, Y_train, num_clients, batch_size, shuffle=True)
+    if resampler is not None:
+        resampler.bind(X_train, perm)
 
     # =============== test_data =====================
     # 随机打乱数据集的seed，划分成iid
-    test_X = test_data
-    test_Y = test_label
-    test_X, test_Y = shuffle(test_X, test_Y, random_state=42)
-
-    # array_split 划分数据集，不均匀不会报错
-    test_X_list = np.array_split(test_X, num_clients)
-    test_Y_list = np.array_split(test_Y, num_clients)
-
-    for X, Y in zip(test_X_list, test_Y_list):
-        X_test = torch.as_tensor(X, dtype=torch.float32)
-        Y_test = torch.as_tensor(Y, dtype=torch.long)
-        test_ids = TensorDataset(X_test, Y_test)
-        # Note: 跨模块的seed不一定起作用
-        test_loader = torch.utils.data.DataLoader(dataset=test_ids, batch_size=batch_size, shuffle=False)
-        test_dataloader.append(test_loader)
-
-    # b = np.array([[1,2],[3,4],[5,6],[7,8]])
-    # c = np.array([0, 1, 2, 3])
+    perm = shuffle(np.arange(len(test_label)), random_state=42)
+    X_test = torch.as_tensor(test_data[perm], dtype=torch.long)
+    Y_test = torch.as_tensor(test_label[perm], dtype=torch.long)
+    # Note: 跨模块的seed不一定起作用
+    test_dataloader = range_partition(X_test, Y_test, num_clients, batch_size, shuffle=False)
+
     return train_dataloader, test_dataloader
 
 
-def split_data_non_iid(train_data, test_data, train_label, test_label, num_clients, alpha, batch_size):
+def split_data_non_iid(train_data, test_data, train_label, test_label, num_clients, alpha, batch_size,
+                       resampler=None):
     """
-    使用狄利克雷分布划分MNIST数据集为non-iid数据集
+    使用狄利克雷分布划分数据集为non-iid数据集
+    只根据label划分出每个客户端的样本下标，所有客户端共用一份数据，不复制样本
     """
-    train_dataloader, test_dataloader = [], []
-
-    # 把train_data, test_data, train_label, test_label合并下
-    # X_train = torch.as_tensor(train_data, dtype=torch.float32)
-    # Y_train = torch.as_tensor(train_label, dtype=torch.long)
-    # train_ids = MyDataset(X_train, Y_train)
-
-    train_ids = []
-    for data, label in zip(train_data, train_label):
-        train_ids.append((data, int(label)))
-
-    clients_train_data = data_split(train_ids, num_clients, alpha)
-    for client_train_data in clients_train_data:
-        train_dataloader.append(data_to_dataloader(client_train_data, batch_size))
-
-    test_ids = []
-    for data, label in zip(test_data, test_label):
-        test_ids.append((data, int(label)))
+    X_train = torch.as_tensor(train_data, dtype=torch.long)
+    Y_train = torch.as_tensor(train_label, dtype=torch.long)
+    train_dataloader = index_partition(X_train, Y_train, data_split(train_label, num_clients, alpha), batch_size,
+                                       shuffle=True)
+    if resampler is not None:
+        resampler.bind(X_train)
 
-    clients_test_data = data_split(test_ids, num_clients, alpha)
-    for client_test_data in clients_test_data:
-        test_dataloader.append(data_to_dataloader(client_test_data, batch_size))
+    X_test = torch.as_tensor(test_data, dtype=torch.long)
+    Y_test = torch.as_tensor(test_label, dtype=torch.long)
+    test_dataloader = index_partition(X_test, Y_test, data_split(test_label, num_clients, alpha), batch_size,
+                                      shuffle=True)
 
     return train_dataloader, test_dataloader
 
 
-def centralized_data(train_data, test_data, train_label, test_label, batch_size):
+def centralized_data(train_data, test_data, train_label, test_label, batch_size, resampler=None):
     train_dataloader, test_dataloader = [], []
 
     # 处理训练集
-    X_train = torch.as_tensor(train_data.astype(float), dtype=torch.float32)
+    X_train = torch.as_tensor(train_data, dtype=torch.long)
     Y_train = torch.as_tensor(train_label, dtype=torch.long)
-    train_ids = TensorDataset(X_train, Y_train)
-    train_loader = DataLoader(dataset=train_ids, batch_size=batch_size, shuffle=True)  # shuffle打乱TensorDataset
+    train_ids = IndexedDataset(X_train, Y_train)
+    if resampler is not None:
+        resampler.bind(X_train)
+    train_loader = make_dataloader(train_ids, batch_size=batch_size, shuffle=True)  # shuffle打乱
     train_dataloader.append(train_loader)
 
     # 处理测试集
-    X_test = torch.as_tensor(test_data.astype(float), dtype=torch.float32)
+    X_test = torch.as_tensor(test_data, dtype=torch.long)
     Y_test = torch.as_tensor(test_label, dtype=torch.long)
-    test_ids = TensorDataset(X_test, Y_test)
-    test_loader = DataLoader(dataset=test_ids, batch_size=batch_size, shuffle=False)  # shuffle打乱TensorDataset
+    test_ids = IndexedDataset(X_test, Y_test)
+    test_loader = make_dataloader(test_ids, batch_size=batch_size, shuffle=False)
     test_dataloader.append(test_loader)
 
     return train_dataloader, test_dataloader
 
 
-# *****************************************************************************************
-"""狄利克雷分布产生non-iid数据集"""
-
-
-def data_split(data, num_clients, alpha):
-    # TODO: alpha不能过小，不然有些客户端会只有0个样本
-    # 解决方法：每个客户端都事先加点样本，或者概率加上一个0.1后作归一化(zs)
-    # return a dict user2data
-    label2data = split_by_label(data)
-    user2data = {i: [] for i in range(num_clients)}
-
-    for label, samples in label2data.items():
-        ret = dirichlet_partition(samples, num_clients, alpha)
-        for user, sample in ret.items():
-            user2data[user] += sample  # [(data_i, 5), (data_j, 5)] += [(data_k, 3), (data_t, 3), ...]
-
-    return list(user2data.values())  # 得到每个客户端划分好后的数据集[client_1_data, ..., client_n_data]
-
-
-def dirichlet_partition(samples, num_clients, alpha):
-    """
-    O(n)
-    """
-    ret = {i: [] for i in range(num_clients)}
-    random.shuffle(samples)
-    # TODO: what does it mean
-    prop = np.random.dirichlet(np.repeat(alpha, num_clients))
-    prop = list(accumulate(prop))
-    i = 0
-    for idx in range(0, len(prop)):
-        pre = i
-        while i / (len(samples)) < prop[idx]:
-            i += 1
-        ret[idx] += samples[pre:i]
-    # for i, sample in enumerate(samples):
-    #     idx = bisect.bisect_left(prop, i/len(samples), 0, len(prop))
-    #     ret[idx].append(sample)
-    return ret
-
-
-def split_by_label(data):
-    ret = {}
-    for sample, label in data:  # sample shape: torch.Size([1, 28, 28])
-        if label not in ret.keys():
-            ret[label] = []
-        ret[label].append((sample, label))
-    # ret: {0: [(data_i, 0), (data_j, 0)], 1: [..., ..., ...], ..., 9: [..., ...]}
-    return ret
-
-
-def data_to_dataloader(data, batch_size):
-    return torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=True)
-
-
 if __name__ == "__main__":
     partition_data(partition_method="hetero")
@@ -1,33 +1,147 @@
 """
 这个文件是处理movielens-1m数据集的（用于模拟联邦点击率预测ctr实验）
 （这里我把评分1-5中的1-2转为未点击，3-5转为点击）
+ml-10m、ml-20m也可以用（没有users.dat，只能用user_id, movie_id, genres这几个field；ml-20m的文件是.csv）
 
 这个处理的数据，最后其实只用到了ratings和get_negative_samples_per_user方法
 """
 import pandas as pd
 from tqdm import tqdm
 import os
+import json
+import shutil
+import hashlib
 import random
 import numpy as np
 from random import sample
+from data_preprocessing.movielens.ctr.negative_sampler import NegativeSampler
+from data_preprocessing.movielens.dat_reader import read_dat, iter_ratings, RATING_COLUMNS
 
 
-def get_ctr_movielens_datasets():
+# 预处理后的缓存版本，预处理逻辑变了就加1，旧的缓存自动失效
+# 3: ratings的user_id, movie_id存的是编码后的ID
+CACHE_VERSION = 3
+
+DEFAULT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")) + '/data/MovieLens/1m'
+
+GENRES = ["Action", "Adventure", "Animation", "Children's", "Comedy", "Crime",
+          "Documentary", "Drama", "Fantasy", "Film-Noir", "Horror", "Musical",
+          "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
+
+# 可以作为FM的field的特征：{field: (取值个数, 是否multi-hot)}
+# gender/age/occupation是用户的单值类别特征，genres是电影的multi-hot特征（一部电影可以属于多个类型）
+# user_id, movie_id的取值个数由数据决定，是ID编码表的长度（见get_id_vocab），ml-1m是6040和3883
+CTR_FIELDS = {
+    'user_id': (None, False),
+    'movie_id': (None, False),
+    'gender': (2, False),
+    'age': (7, False),
+    'occupation': (21, False),
+    'genres': (len(GENRES), True),
+}
+
+
+def get_ctr_movielens_datasets(path=None, use_cache=True, merge=True):
+    """
+    Args:
+        path: movielens数据集所在的文件夹，默认是 data/MovieLens/1m
+        use_cache: 第一次运行时把预处理好的users, movies, ratings按列保存成.npy，之后直接memory-map读取
+        merge: 是否合并成all_data（100万行 x 上百列，很慢，只用ratings的话可以不合并）
+
+    Returns: users, movies, ratings, all_data（merge=False时all_data为None）
+        ratings是{列名: 数组}（用缓存时是memory-map的.npy，不复制成DataFrame），
+        其中user_id, movie_id已经编码成users, movies表的行号（见get_id_vocab）；all_data里的是原始ID
+    """
     # path: https://ugirc.blog.csdn.net/article/details/115645345
     # os.path.dirname(__file__) 获得当前模块的绝对路径
     # 用os.path.join可以返回上一级..
-    path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")) + '/data/MovieLens/1m'
     # 不建议用os.getcwd()
+    path = path or DEFAULT_PATH
 
     pd.set_option('display.max_columns', 20)
     pd.set_option('display.max_rows', 100)
 
+    if use_cache:
+        cache_dir = f'{path}/cache/{get_cache_key(path)}'
+        if not os.path.exists(cache_dir):
+            save_cache(cache_dir, path)
+        users, movies, ratings = load_cache(cache_dir)
+    else:
+        users, movies, ratings = preprocess_movielens(path)
+
+    all_data = None
+    if merge:
+        # 编码后的ID就是行号，直接按行号取users, movies的行
+        all_data = pd.concat((pd.DataFrame({'rating': ratings['rating'], 'timestamp': ratings['timestamp']}),
+                              users.iloc[ratings['user_id']].reset_index(drop=True),
+                              movies.iloc[ratings['movie_id']].reset_index(drop=True)), axis=1)
+    return users, movies, ratings, all_data
+
+
+def data_file(path, name):
+    """ml-1m、ml-10m是name.dat，ml-20m是name.csv；都没有时返回None（ml-10m、ml-20m没有users）"""
+    for suffix in ['.dat', '.csv']:
+        if os.path.exists(f'{path}/{name}{suffix}'):
+            return f'{path}/{name}{suffix}'
+    return None
+
+
+def preprocess_movielens(path):
+    """读入原始的.dat（或.csv）文件，把类别特征转为onehot/multi-hot，ratings是编码后的{列名: 数组}（不用缓存时）"""
+    users, movies, num_ratings, rating_dtype = preprocess_tables(path)
+    ratings = {column: np.empty(num_ratings, dtype=rating_dtype if column == 'rating' else np.int32)
+               for column in RATING_COLUMNS}
+    fill_ratings(ratings, path, users, movies)
+    return users, movies, ratings
+
+
+def scan_ratings(path):
+    """
+    按块扫一遍ratings（全是数字，按块解析成int32的列，见dat_reader.iter_ratings）
+    Returns: 行数, rating的dtype（ml-10m、ml-20m有半星，是float32）, 出现过的所有user_id（排好序）
+    """
+    num_ratings, is_float, user_ids = 0, False, np.zeros(0, dtype=np.int32)
+    for chunk in iter_ratings(data_file(path, 'ratings')):
+        num_ratings += len(chunk['user_id'])
+        is_float = is_float or chunk['rating'].dtype != np.int32
+        user_ids = np.union1d(user_ids, chunk['user_id'])
+    return num_ratings, np.float32 if is_float else np.int32, user_ids
+
+
+def fill_ratings(columns, path, users, movies):
+    """
+    一块一块地读ratings，每一块的user_id, movie_id单独按users, movies表编码（编码成行号），写到columns的对应位置
+    columns: {列名: 长度为总行数的数组}，可以是np.lib.format.open_memmap打开的.npy，这样整个ratings都不用放进内存
+    """
+    user_id_vocab, movie_id_vocab = pd.Index(users['user_id']), pd.Index(movies['movie_id'])
+    start = 0
+    for chunk in iter_ratings(data_file(path, 'ratings')):
+        stop = start + len(chunk['user_id'])
+        chunk['user_id'] = encode_ids(chunk['user_id'], user_id_vocab)
+        chunk['movie_id'] = encode_ids(chunk['movie_id'], movie_id_vocab)
+        for column, values in columns.items():
+            values[start:stop] = chunk[column]
+        start = stop
+    return columns
+
+
+def preprocess_tables(path):
+    """
+    users, movies表（都很小），以及ratings的行数和rating的dtype（ratings本身之后再按块读）
+    """
+    num_ratings, rating_dtype, rating_user_ids = scan_ratings(path)
+
     # *******************************************
     # **************** users ********************
     # *******************************************
 
+    if data_file(path, 'users') is None:
+        # 没有用户信息，用户就是ratings里出现过的所有user_id
+        return pd.DataFrame({'user_id': rating_user_ids}), preprocess_movies(path), num_ratings, rating_dtype
+
     unames = ['user_id', 'gender', 'age', 'occupation', 'zip']
-    users = pd.read_table(f'{path}/users.dat', sep="::", header=None, names=unames, encoding='utf-8', engine="python")
+    # sep="::"时pandas只能用很慢的python engine，这里用dat_reader（结果一样）
+    users = read_dat(data_file(path, 'users'), unames, encoding='utf-8')
 
     users = users.join(pd.get_dummies(users['gender'], prefix="gender"))
     users.drop(columns=['gender'], inplace=True)
@@ -44,16 +158,19 @@ def get_ctr_movielens_datasets():
     # 性别'F','M'转为0,1
     # users['gender'] = users['gender'].apply(lambda x: 0 if x == 'F' else 1)
 
+    return users, preprocess_movies(path), num_ratings, rating_dtype
+
+
+def preprocess_movies(path):
     # *******************************************
     # *************** movies ********************
     # *******************************************
 
     mnames = ['movie_id', 'title', 'genres']
-    movies = pd.read_table(f'{path}/movies.dat', sep='::', header=None, names=mnames, encoding='ISO-8859-1',
-                           engine='python')
+    movies = read_dat(data_file(path, 'movies'), mnames, encoding='ISO-8859-1')
 
     # 从电影title中提取出电影的年份year
-    movies['year'] = movies.title.str.extract("\((\d{4})\)", expand=False)
+    movies['year'] = movies.title.str.extract(r"\((\d{4})\)", expand=False)
     # 对year进行one_hot的话，会有81维
     movies = movies.join(pd.get_dummies(movies['year'], prefix="year"))
     movies.drop(columns=['year'], inplace=True)
@@ -62,40 +179,206 @@ def get_ctr_movielens_datasets():
     movies.drop(columns='title', inplace=True)
 
     # 将分割genres，转换为multi-hot
-    genres_list = ["Action", "Adventure", "Animation", "Children's", "Comedy", "Crime",
-                   "Documentary", "Drama", "Fantasy", "Film-Noir", "Horror", "Musical",
-                   "Mystery", "Romance", "Sci-Fi", "Thriller", "War", "Western"]
-
-    # 增加多个列
-    movies[genres_list] = 0
-
     # **** for loop is slow ****
     # # 创建一个tqdm对象
     # pbar = enumerate(tqdm(movies['genres'], desc="movies Processing Bar: ", ncols=100))
     # for i, genre in pbar:
     #     movies.loc[i, genre.split('|')] = 1
 
-    # apply传入多个参数
-    movies.apply(lambda x: split_genre(row=x, df=movies), axis=1)  # axis=1，每次得到一行数据
+    # **** apply + .loc也很慢（每一行都要写一次DataFrame），str.get_dummies一次就能得到multi-hot ****
+    genres = movies['genres'].str.get_dummies(sep='|').reindex(columns=GENRES, fill_value=0)
+    movies = movies.join(genres.astype('int64'))
 
     movies.drop(columns='genres', inplace=True)
+    return movies
 
-    # *******************************************
-    # ************** ratings ********************
-    # *******************************************
 
-    rnames = ['user_id', 'movie_id', 'rating', 'timestamp']
-    ratings = pd.read_table(f'{path}/ratings.dat', sep='::', header=None, names=rnames, encoding='utf-8',
-                            engine='python')
+# *******************************************
+# ************** cache **********************
+# *******************************************
+
+_cache_keys = {}  # 本进程里算过的key：path -> (原始文件的签名, key)
 
-    all_data = pd.merge(pd.merge(ratings, users), movies)
-    return users, movies, ratings, all_data
+
+def _file_signature(path):
+    """原始文件的[文件名, 大小, 修改时间]，都没变就认为内容没变"""
+    signature = []
+    for name in ['users', 'movies', 'ratings']:
+        file = data_file(path, name)
+        if file is not None:
+            stat = os.stat(file)
+            signature.append([os.path.basename(file), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _hash_files(path):
+    md5 = hashlib.md5(f'version={CACHE_VERSION}'.encode())
+    for name in ['users', 'movies', 'ratings']:
+        if data_file(path, name) is None:
+            continue
+        with open(data_file(path, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    return md5.hexdigest()[:16]
+
+
+def get_cache_key(path):
+    """
+    用原始文件的内容和CACHE_VERSION算一个hash，原始文件或者预处理逻辑变了，缓存就会重新生成
+    hash整个原始文件很慢（ml-20m有几百MB），一次运行里又会调用好几次，所以算过的key按文件的大小和修改时间记下来：
+    同一个进程里记在内存里，不同进程之间记在{path}/cache/key.json里，签名变了才重新hash
+    """
+    signature = _file_signature(path)
+    memo = _cache_keys.get(os.path.abspath(path))
+    if memo is not None and memo[0] == signature:
+        return memo[1]
+
+    key_file = f'{path}/cache/key.json'
+    try:
+        with open(key_file) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    if saved.get('version') == CACHE_VERSION and saved.get('signature') == signature:
+        key = saved['key']
+    else:
+        key = _hash_files(path)
+        try:
+            os.makedirs(f'{path}/cache', exist_ok=True)
+            with open(f'{key_file}.tmp{os.getpid()}', 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'signature': signature, 'key': key}, f)
+            os.replace(f'{key_file}.tmp{os.getpid()}', key_file)
+        except OSError:
+            pass  # 数据目录不可写时每个进程hash一次
+    _cache_keys[os.path.abspath(path)] = (signature, key)
+    return key
+
+
+def save_cache(cache_dir, path):
+    """
+    预处理path下的原始文件，每张表存成一个文件夹，每一列一个.npy（列名可能含有特殊字符，所以文件名用列的序号，列名存到columns.json里）
+    ratings按块读、按块编码后直接写进.npy（open_memmap），不在内存里拼成一整张表
+    还会保存user_id, movie_id的编码表（第i个位置就是编码为i的原始ID）
+    先写到临时文件夹，写完再rename，避免中途中断留下不完整的缓存
+    """
+    users, movies, num_ratings, rating_dtype = preprocess_tables(path)
+    tmp_dir = f'{cache_dir}.tmp{os.getpid()}'
+    for name, df in [('users', users), ('movies', movies)]:
+        os.makedirs(f'{tmp_dir}/{name}')
+        for i, column in enumerate(df.columns):
+            np.save(f'{tmp_dir}/{name}/{i}.npy', df[column].to_numpy())
+        with open(f'{tmp_dir}/{name}/columns.json', 'w') as f:
+            json.dump(list(df.columns), f)
+
+    os.makedirs(f'{tmp_dir}/ratings')
+    ratings = {column: np.lib.format.open_memmap(f'{tmp_dir}/ratings/{i}.npy', mode='w+', shape=(num_ratings,),
+                                                 dtype=rating_dtype if column == 'rating' else np.int32)
+               for i, column in enumerate(RATING_COLUMNS)}
+    for values in fill_ratings(ratings, path, users, movies).values():
+        values.flush()
+    del ratings
+    with open(f'{tmp_dir}/ratings/columns.json', 'w') as f:
+        json.dump(RATING_COLUMNS, f)
+
+    # ID编码表：第i个位置是编码为i的原始ID，data_loader中编码ID、确定embedding的大小要用
+    np.save(f'{tmp_dir}/user_id_vocab.npy', users['user_id'].drop_duplicates().to_numpy())
+    np.save(f'{tmp_dir}/movie_id_vocab.npy', movies['movie_id'].drop_duplicates().to_numpy())
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # 别的进程已经先写好了同样的缓存
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_cache(cache_dir):
+    """users, movies是DataFrame（都很小）；ratings是{列名: memory-map的数组}，不复制成DataFrame"""
+    tables = []
+    for name in ['users', 'movies', 'ratings']:
+        with open(f'{cache_dir}/{name}/columns.json') as f:
+            columns = json.load(f)
+        # mmap_mode='r'不会把整个文件读进内存，用到哪一列才读哪一列
+        data = {column: np.load(f'{cache_dir}/{name}/{i}.npy', mmap_mode='r') for i, column in enumerate(columns)}
+        tables.append(data if name == 'ratings' else pd.DataFrame(data, columns=columns))
+    return tables
+
+
+def get_id_vocab(path=None):
+    """
+    Returns: user_id_vocab, movie_id_vocab，第i个位置是编码为i的原始ID，如 movie_id_vocab: [1, 2, ..., 3952]（共3883个）
+    """
+    path = path or DEFAULT_PATH
+    cache_dir = f'{path}/cache/{get_cache_key(path)}'
+    if not os.path.exists(cache_dir):
+        save_cache(cache_dir, path)
+    return np.load(f'{cache_dir}/user_id_vocab.npy'), np.load(f'{cache_dir}/movie_id_vocab.npy')
+
+
+def encode_ids(ids, vocab):
+    """
+    原始ID -> 在vocab中的位置（0..len(vocab)-1），pd.Index按hash一次查完整个数组，
+    代替原来的 Series.apply(lambda x: dic[x])（每个元素调用一次python函数，2000万条评分要几十秒）
+    """
+    codes = pd.Index(vocab).get_indexer(np.asarray(ids))
+    if (codes < 0).any():
+        raise ValueError(f"{int((codes < 0).sum())} ids are not in the vocab, e.g. {np.asarray(ids)[codes < 0][0]}")
+    return codes.astype(np.int64)
+
+
+def field_codes(table, prefix):
+    """get_dummies后的one-hot列（如age_1, age_18, ...）还原成类别编号0..n-1"""
+    columns = [column for column in table.columns if column.startswith(prefix + '_')]
+    return np.stack([table[column].to_numpy() for column in columns], axis=1).argmax(axis=1)
+
+
+def get_ctr_features(ratings, users, movies, fields):
+    """
+    Args:
+        ratings: DataFrame或{列名: 数组}，user_id, movie_id已经编码成0..n-1（编码表就是users, movies的行顺序，见get_id_vocab）
+        fields: CTR_FIELDS中的field名
+    Returns: [len(ratings), len(fields)]的int64数组，每一列是一个field；
+             multi-hot的field（genres）是一个bitmask，第j位为1表示属于GENRES[j]
+    """
+    user_index = np.asarray(ratings['user_id'])
+    movie_index = np.asarray(ratings['movie_id'])
+    columns = []
+    for field in fields:
+        if field in ('user_id', 'movie_id'):
+            columns.append(np.asarray(ratings[field]))
+        elif field == 'genres':
+            multi_hot = np.stack([movies[genre].to_numpy() for genre in GENRES], axis=1).astype(np.int64)
+            columns.append((multi_hot << np.arange(len(GENRES))).sum(axis=1)[movie_index])
+        elif field in CTR_FIELDS:
+            if not any(column.startswith(field + '_') for column in users.columns):
+                raise ValueError(f"ctr field {field} is not available in this dataset (no users.dat)")
+            columns.append(field_codes(users, field)[user_index])
+        else:
+            raise ValueError(f"unknown ctr field: {field}")
+    return np.stack(columns, axis=1).astype(np.int64)
 
 
 # 负采样 按照比例进行负采样
 
 
-def get_negative_samples_per_user(users=None, movies=None, ratings=None, ratio_of_neg_to_pos=1):
+def get_negative_samples_per_user(users=None, movies=None, ratings=None, ratio_of_neg_to_pos=1, seed=None):
+    """
+    用于生成负样本，向量化的实现见negative_sampler.py（原来逐个用户构造候选列表再random.sample的写法见get_negative_samples_per_user_1）
+    Args:
+        ratings: get_ctr_movielens_datasets返回的ratings（user_id, movie_id是编码后的ID）
+        movies:
+        users:
+        ratio_of_neg_to_pos: 正负样本的比例
+        seed: 负采样的随机种子
+
+    Returns: 所有负样本的构成的ratings表（user_id, movie_id也是编码后的ID）
+
+    """
+    sampler = NegativeSampler(np.arange(len(users)), np.arange(len(movies)), ratings['user_id'], ratings['movie_id'],
+                              ratio_of_neg_to_pos=ratio_of_neg_to_pos, seed=seed)
+    return sampler.sample_dataframe()
+
+
+def get_negative_samples_per_user_1(users=None, movies=None, ratings=None, ratio_of_neg_to_pos=1):
     """
     用于生成负样本 numpy a little fast
     Args:
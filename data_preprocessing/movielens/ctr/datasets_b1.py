@@ -8,6 +8,7 @@ import pandas as pd
 from tqdm import tqdm
 import os
 import time, random
+from data_preprocessing.movielens.dat_reader import read_dat, read_ratings
 
 # path: https://ugirc.blog.csdn.net/article/details/115645345
 # os.path.dirname(__file__) 获得当前模块的绝对路径
@@ -23,7 +24,7 @@ pd.set_option('display.max_rows', 100)
 # *******************************************
 
 unames = ['user_id', 'gender', 'age', 'occupation', 'zip']
-users = pd.read_table(f'{path}/users.dat', sep="::", header=None, names=unames, encoding='utf-8', engine="python")
+users = read_dat(f'{path}/users.dat', unames, encoding='utf-8')
 
 # 性别'F','M'转为0,1
 users['gender'] = users['gender'].apply(lambda x : 0 if x == 'F' else 1)
@@ -66,7 +67,7 @@ users = users.join(pd.get_dummies(users['occupation']))
 # *******************************************
 
 mnames = ['movie_id', 'title', 'genres']
-movies = pd.read_table(f'{path}/movies.dat', sep='::', header=None, names=mnames, encoding='ISO-8859-1', engine='python')
+movies = read_dat(f'{path}/movies.dat', mnames, encoding='ISO-8859-1')
 
 # 从电影title中提取出电影的年份year
 movies['year'] = movies.title.str.extract("\((\d{4})\)", expand=False)
@@ -112,8 +113,7 @@ movies.apply(split_genre, axis=1) # axis=1，每次得到一行数据
 # ************** ratings ********************
 # *******************************************
 
-rnames = ['user_id', 'movie_id', 'rating', 'timestamp']
-ratings = pd.read_table(f'{path}/ratings.dat', sep='::', header=None, names=rnames, encoding='utf-8', engine='python')
+ratings = read_ratings(f'{path}/ratings.dat')
 
 # 这里我把评分1-5中的1-2转为未点击，3-5转为点击
 ratings['rating'] = ratings['rating'] - 1
@@ -0,0 +1,122 @@
+"""
+向量化的负采样
+每个用户的负样本从他没有评过分的电影中无放回均匀采样，数量为 min(正样本数 * ratio_of_neg_to_pos, 没看过的电影数)，
+和datasets.py中 get_negative_samples_per_user_1 用 random.sample 的结果同分布，但不需要对每个用户构造候选列表
+
+用户看过的电影用CSR的方式保存：把(user, item)编码成 user * num_items + item 后排序，
+indptr[u]:indptr[u+1] 就是用户u的正样本，判断一个(user, item)是不是正样本只需要一次 np.searchsorted
+"""
+import numpy as np
+import pandas as pd
+
+
+class NegativeSampler:
+    def __init__(self, user_ids, item_ids, pos_user_ids, pos_item_ids, ratio_of_neg_to_pos=1, seed=None):
+        """
+        Args:
+            user_ids: 所有用户的原始ID（如users['user_id']）
+            item_ids: 所有电影的原始ID（如movies['movie_id']，不连续也没关系）
+            pos_user_ids, pos_item_ids: 正样本（如ratings['user_id'], ratings['movie_id']）
+            ratio_of_neg_to_pos: 负样本和正样本的比例
+            seed: None时从np.random的全局状态中取一个种子，这样fedavg_main.py中的setup_seed也能固定负采样结果
+        """
+        self.user_ids = np.asarray(user_ids)
+        self.item_ids = np.asarray(item_ids)
+        self.num_users = len(self.user_ids)
+        self.num_items = len(self.item_ids)
+
+        users = pd.Index(self.user_ids).get_indexer(np.asarray(pos_user_ids)).astype(np.int64)
+        items = pd.Index(self.item_ids).get_indexer(np.asarray(pos_item_ids)).astype(np.int64)
+        # 同一个用户对同一部电影的重复记录只算一次（和原来用set去重一致）
+        pos_keys = np.sort(users * self.num_items + items)
+        self.pos_keys = pos_keys[np.concatenate(([True], pos_keys[1:] != pos_keys[:-1]))] if len(pos_keys) else pos_keys
+        self.indptr = np.searchsorted(self.pos_keys, np.arange(self.num_users + 1, dtype=np.int64) * self.num_items)
+
+        self.num_pos = np.diff(self.indptr)
+        # 负样本的数量不能超过可选的数量
+        self.num_neg = np.minimum(self.num_pos * ratio_of_neg_to_pos, self.num_items - self.num_pos)
+
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def _contains(sorted_keys, keys):
+        """keys中的每个元素是否在排好序的sorted_keys中"""
+        if len(sorted_keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        position = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return sorted_keys[position] == keys
+
+    def _sample_sparse(self, users):
+        """
+        负样本只占候选集合一小部分的用户：批量随机抽(user, item)，去掉正样本和重复的，不够的再抽一轮（rejection sampling）
+        """
+        need = np.zeros(self.num_users, dtype=np.int64)
+        need[users] = self.num_neg[users]
+        chosen = np.zeros(0, dtype=np.int64)  # 已经选中的负样本（排好序）
+        while need.sum() > 0:
+            active = np.nonzero(need)[0]
+            # 多抽一些，大多数用户一轮就够了
+            draws = np.repeat(active, (need[active] * 1.2).astype(np.int64) + 4)
+            keys = draws * self.num_items + self.rng.integers(self.num_items, size=len(draws))
+            keys = keys[~self._contains(self.pos_keys, keys) & ~self._contains(chosen, keys)]
+
+            # 去重时保留第一次抽到的那个，并且保持抽样的顺序：
+            # 同一个用户的候选是按抽样顺序排的（本身就是随机顺序），取前need个就是均匀的无放回采样
+            order = np.argsort(keys, kind='stable')
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[order[1:]] != keys[order[:-1]]
+            keep = np.zeros(len(keys), dtype=bool)
+            keep[order[first]] = True
+            keys = keys[keep]
+
+            key_users = keys // self.num_items
+            rank = np.arange(len(keys)) - np.searchsorted(key_users, key_users, side='left')
+            keys = keys[rank < need[key_users]]
+
+            chosen = np.sort(np.concatenate((chosen, keys)))
+            need -= np.bincount(keys // self.num_items, minlength=self.num_users)
+        return chosen
+
+    def _sample_dense(self, users, chunk_size=1024):
+        """
+        负样本要占候选集合一大半的用户（看过很多电影或者ratio很大）：rejection效率太低，
+        直接给每个电影一个随机数，正样本设为inf，排序后取前num_neg个，一次处理chunk_size个用户
+        """
+        chosen = []
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            scores = self.rng.random((len(chunk), self.num_items))
+            for row, user in enumerate(chunk):
+                positives = self.pos_keys[self.indptr[user]:self.indptr[user + 1]] - user * self.num_items
+                scores[row, positives] = np.inf
+            order = np.argsort(scores, axis=1)
+            take = np.arange(self.num_items) < self.num_neg[chunk][:, None]
+            chosen.append((chunk[:, None] * self.num_items + order)[take])
+        return np.concatenate(chosen) if len(chosen) > 0 else np.zeros(0, dtype=np.int64)
+
+    def sample(self, users=None):
+        """
+        对users（编码后的用户下标，默认全部用户）重新采样一次负样本，每一轮都可以重新调用
+        Returns: user_ids, item_ids 两个数组（原始ID）
+        """
+        users = np.arange(self.num_users) if users is None else np.asarray(users, dtype=np.int64)
+        users = users[self.num_neg[users] > 0]
+        dense = 2 * self.num_neg[users] > self.num_items - self.num_pos[users]
+        keys = np.sort(np.concatenate((self._sample_sparse(users[~dense]), self._sample_dense(users[dense]))))
+        return self.user_ids[keys // self.num_items], self.item_ids[keys % self.num_items]
+
+    def iter_samples(self, users_per_chunk=1024):
+        """
+        流式模式：每次只生成users_per_chunk个用户的负样本，不用一次性把所有负样本都放进ratings
+        """
+        for start in range(0, self.num_users, users_per_chunk):
+            yield self.sample(np.arange(start, min(start + users_per_chunk, self.num_users)))
+
+    def sample_dataframe(self, users=None):
+        """和原来的get_negative_samples_per_user一样，返回负样本构成的ratings表（rating为0）"""
+        user_ids, item_ids = self.sample(users)
+        return pd.DataFrame({'user_id': user_ids, 'movie_id': item_ids,
+                             'rating': np.zeros(len(user_ids), dtype=np.int64),
+                             'timestamp': np.zeros(len(user_ids), dtype=np.int64)})
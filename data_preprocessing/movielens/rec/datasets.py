@@ -6,6 +6,7 @@ import pandas as pd
 from tqdm import tqdm
 import os
 import time, random
+from data_preprocessing.movielens.dat_reader import read_dat, read_ratings
 from pathlib import Path
 
 """这种path的写法似乎有点问题吧，在别的地方运行会出错
@@ -28,7 +29,7 @@ pd.set_option('display.max_rows', 100)
 # *******************************************
 
 unames = ['user_id', 'gender', 'age', 'occupation', 'zip']
-users = pd.read_table(f'{path}/users.dat', sep="::", header=None, names=unames, engine='python')
+users = read_dat(f'{path}/users.dat', unames)
 
 # 把occupation转为具体名称
 users.insert(4, 'occupation_detail', None)
@@ -67,8 +68,7 @@ users = users.join(pd.get_dummies(users['occupation']))
 # *******************************************
 
 mnames = ['movie_id', 'title', 'genres']
-movies = pd.read_table(f'{path}/movies.dat', sep='::', header=None, names=mnames, encoding="ISO-8859-1",
-                       engine='python')
+movies = read_dat(f'{path}/movies.dat', mnames, encoding="ISO-8859-1")
 
 # 从电影title中提取出电影的年份year
 movies['year'] = movies.title.str.extract("\((\d{4})\)", expand=False)
@@ -115,8 +115,7 @@ movies.apply(split_genre, axis=1) # axis=1，每次得到一行数据
 # ************** ratings ********************
 # *******************************************
 
-rnames = ['user_id', 'movie_id', 'rating', 'timestamp']
-ratings = pd.read_table(f'{path}/ratings.dat', sep='::', header=None, names=rnames, engine='python')
+ratings = read_ratings(f'{path}/ratings.dat')
 
 # Note: 不要上来就把三个表格合并，要把三个表格先分别处理好，如onehot，不然后续处理都是100万条数据了
 # 跨越三个表格分析数据并不是一件简单的事情，而将所有表格合并到单个表中会容易很多
@@ -0,0 +1,77 @@
+"""
+mnist和movielens共用的数据集划分
+只对label数组操作，返回每个客户端的样本下标数组，客户端的数据集用下标去原数据集里取（view），不再复制成[(sample, label), ...]
+"""
+import numpy as np
+
+
+def split_by_label(labels):
+    """
+    Returns: {label: 这个label的所有样本下标}
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    classes, starts = np.unique(labels[order], return_index=True)
+    return dict(zip(classes.tolist(), np.split(order, starts[1:])))
+
+
+def dirichlet_partition(num_samples, num_clients, alpha):
+    """
+    把num_samples个样本按狄利克雷分布的比例分给num_clients个客户端，O(n)
+    Returns: owner[i] 是第i个样本（打乱前的顺序）分到的客户端
+    """
+    prop = np.random.dirichlet(np.repeat(alpha, num_clients))
+    # 第k个客户端拿 [ceil(cum_prop[k-1] * n), ceil(cum_prop[k] * n)) 的样本（和原来while循环的边界一致）
+    cuts = np.minimum(np.ceil(np.cumsum(prop) * num_samples), num_samples).astype(np.int64)
+    cuts[-1] = num_samples
+    counts = np.diff(np.concatenate(([0], cuts)))
+    owner = np.empty(num_samples, dtype=np.int64)
+    owner[np.random.permutation(num_samples)] = np.repeat(np.arange(num_clients), counts)
+    return owner
+
+
+def ensure_min_samples(owner, num_clients, min_samples):
+    """
+    alpha很小时有的客户端会分到0个样本，从样本多的客户端那里随机拿一些过来，保证每个客户端至少min_samples个
+    """
+    counts = np.bincount(owner, minlength=num_clients)
+    deficit = np.maximum(min_samples - counts, 0)
+    if deficit.sum() == 0:
+        return owner
+    if min_samples * num_clients > len(owner):
+        raise ValueError(f"{len(owner)} samples are not enough for {num_clients} clients "
+                         f"with at least {min_samples} samples each")
+
+    # 每个客户端随机留下min_samples个样本，剩下的样本都可以分给样本不够的客户端
+    perm = np.random.permutation(len(owner))
+    perm = perm[np.argsort(owner[perm], kind='stable')]
+    sorted_owner = owner[perm]
+    rank = np.arange(len(owner)) - np.searchsorted(sorted_owner, sorted_owner, side='left')
+    spare = perm[rank >= min_samples]
+
+    taken = np.random.choice(spare, size=deficit.sum(), replace=False)
+    owner[taken] = np.repeat(np.arange(num_clients), deficit)
+    return owner
+
+
+def data_split(labels, num_clients, alpha, min_samples=2):
+    """
+    对每个label分别用狄利克雷分布划分，得到non-iid数据集
+    Args:
+        labels: 所有样本的label数组
+        alpha: 越小异质程度越高
+        min_samples: 每个客户端至少有多少个样本，默认2：只有1个样本的客户端训练带BatchNorm的模型（mlp、widedeep）会报错
+
+    Returns: 每个客户端的样本下标数组 [client_1_index, ..., client_n_index]
+    """
+    labels = np.asarray(labels)
+    owner = np.empty(len(labels), dtype=np.int64)
+    for label, index in split_by_label(labels).items():
+        owner[index] = dirichlet_partition(len(index), num_clients, alpha)
+
+    owner = ensure_min_samples(owner, num_clients, min_samples)
+
+    # 按客户端把下标排好，再按每个客户端的样本数切开
+    order = np.argsort(owner, kind='stable')
+    counts = np.bincount(owner, minlength=num_clients)
+    return np.split(order, np.cumsum(counts)[:-1])
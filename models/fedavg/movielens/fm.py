@@ -1,33 +1,55 @@
+import time
 import torch
 import torch.nn as nn
 
 
 # Factorization Machine Model
-# 这里的FM是针对MovieLens的ID进行Embedding后的结果
+# 直接在每个field的embedding上做FM：每个field（user_id, movie_id, gender, age, occupation, genres...）
+# 查表得到一个k维的隐向量v_f和一个一阶权重w_f，
+# logit = b + sum_f w_f + sum_{f<g} <v_f, v_g>
 class FM(nn.Module):
-    def __init__(self, n=10, k=5):
+    def __init__(self, k=10, field_dims=(6040, 3883), multi_hot=(), sparse=False):
         """
-        :param n: 特征向量x的维度（这里n其实没用了）
-        :param k: 每个特征向量x_i包含k个描述因子
+        :param k: 每个特征的隐向量维度
+        :param field_dims: 每个field的取值个数，输入x的第i列就是第i个field
+        :param multi_hot: multi-hot的field（如一部电影的genres），x中这一列是取值的bitmask（第j位为1表示有第j个取值），
+                          这个field的隐向量是所有取值的隐向量之和
+        :param sparse: 单值field的embedding使用稀疏梯度
         """
         super(FM, self).__init__()
-        self.user_id_embed = nn.Embedding(6040, 128)
-        self.movie_id_embed = nn.Embedding(3883, 128)
-
-        self.linear = nn.Linear(128 * 2, 1)  # 线性层
-        self.fm_layer = FactorizationMachineLayer(128 * 2, k)
+        self.field_dims = list(field_dims)
+        self.multi_hot = set(multi_hot)
+        # multi-hot的field不是按行查表的（bitmask和整张表相乘），它的梯度是稠密的
+        self.embeddings = nn.ModuleList([nn.Embedding(dim, k, sparse=sparse and i not in self.multi_hot)
+                                         for i, dim in enumerate(self.field_dims)])
+        self.weights = nn.ModuleList([nn.Embedding(dim, 1, sparse=sparse and i not in self.multi_hot)
+                                      for i, dim in enumerate(self.field_dims)])
+        self.bias = nn.Parameter(torch.zeros(1))
+        for embedding in list(self.embeddings) + list(self.weights):
+            nn.init.uniform_(embedding.weight, -0.1, 0.1)
+        # embedding表 -> 用输入的哪一列查表（见algorithm/fedavg/sparse_rows.py）
+        self.row_inputs = {}
+        for i in range(len(self.field_dims)):
+            if i not in self.multi_hot:
+                self.row_inputs[f'embeddings.{i}.weight'] = i
+                self.row_inputs[f'weights.{i}.weight'] = i
 
         self.sig = nn.Sigmoid()
         self.criterion = nn.BCELoss(reduction="mean")
 
-    def forward(self, x):
-        user_embed = self.user_id_embed(x[:, 0].long())  # 必须是long类型
-        movie_embed = self.movie_id_embed(x[:, 1].long())
-        x = torch.cat((user_embed, movie_embed), axis=-1)
+    def _lookup(self, x, i, table):
+        if i in self.multi_hot:
+            bits = (x[:, i, None] >> torch.arange(self.field_dims[i], device=x.device)) & 1
+            return torch.mm(bits.to(table.weight.dtype), table.weight)
+        return table(x[:, i])
 
-        # x: [batch_size, 128 * 2]
-        logit = self.linear(x) + self.fm_layer(x)
+    def forward(self, x):
+        x = x.long()  # 必须是long类型
+        # embeddings: [batch_size, num_fields, k]
+        embeddings = torch.stack([self._lookup(x, i, table) for i, table in enumerate(self.embeddings)], dim=1)
+        linear = torch.cat([self._lookup(x, i, table) for i, table in enumerate(self.weights)], dim=1)
         # logit: [batch_size, 1]
+        logit = linear.sum(dim=1, keepdim=True) + self.bias + fm_interaction(embeddings)
         output = self.sig(logit)
         return torch.cat((1 - output, output), dim=-1)
 
@@ -37,33 +59,93 @@ class FM(nn.Module):
         return self.criterion(pred[:, 1].squeeze(dim=-1), target.float())
 
 
-class FactorizationMachineLayer(nn.Module):
-    # O(kn^2) -> O(kn) time complexity
-    def __init__(self, n, k):
-        super().__init__()
-        self.V = nn.Parameter(torch.randn(n, k))  # 随机初始化隐向量矩阵V
-        nn.init.uniform_(self.V, -0.1, 0.1)
+class FMInteraction(torch.autograd.Function):
+    """
+    sum_{f<g} <v_f, v_g> = 0.5 * (||sum_f v_f||^2 - sum_f ||v_f||^2)，O(kn^2) -> O(kn)
+    前向只有[batch_size, k]的sum_f v_f一个中间结果，两个平方和用点积算，不生成v^2这样的[batch_size, num_fields, k]临时张量；
+    反向的梯度是 grad * (sum_g v_g - v_f)，一次算出来，不用autograd记录每一步
+    """
+
+    @staticmethod
+    def forward(ctx, embeddings):
+        square_of_sum = embeddings.sum(dim=1)
+        ctx.save_for_backward(embeddings, square_of_sum)
+        flat = embeddings.reshape(embeddings.shape[0], -1)
+        output = torch.linalg.vecdot(square_of_sum, square_of_sum).sub_(torch.linalg.vecdot(flat, flat))
+        return output.mul_(0.5).unsqueeze(1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        embeddings, square_of_sum = ctx.saved_tensors
+        return torch.sub(square_of_sum.unsqueeze(1), embeddings).mul_(grad_output.unsqueeze(2))
+
+
+def fm_interaction(embeddings):
+    """embeddings: [batch_size, num_fields, k] -> [batch_size, 1]"""
+    return FMInteraction.apply(embeddings)
 
-    def forward(self, x):
-        # 这里具体写下公式就懂了
-        temp = torch.mm(x, self.V)  # [b, n] * [n, v]
-        sum_pow_interaction = torch.pow(temp, 2)
-        pow_sum_interaction = torch.mm(torch.pow(x, 2), torch.pow(self.V, 2))
-        # output: [batch_size, 1]
-        output = 0.5 * torch.sum(sum_pow_interaction - pow_sum_interaction, dim=1, keepdim=True)
-        return output
+
+def saved_bytes(model, inputs):
+    """前向时autograd为反向保存下来的张量（不含参数）的字节数，即每个batch的激活内存"""
+    params = {p.data_ptr() for p in model.parameters()}
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        if tensor.data_ptr() not in params:
+            total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(inputs)
+    return total
 
 
 if __name__ == "__main__":
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../")))
+    from benchmarks.reference import DenseFM
+
     seed = 42
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    model = FM(n=10, k=5)
-    # x = torch.randn(4, 2)  # [batch, n]
-    x = torch.tensor([[122, 144], [534, 23], [19, 83], [73, 23]])
-    target = torch.tensor([1, 0, 0, 1])
-    output = model(x)
-    # output 预测一个值并且sigmoid后的结果
-    print(output)  # [[0.5228], [0.3266], [0.8038], [0.4608]]
-    loss = model.cal_loss(output, target)
-    print(f"loss: {loss:.6f}")  # (-log(0.5228)-log(1-0.3266)-log(1-0.8038)-log(0.4608)) / 4
+
+    # 正确性：和逐对求内积的结果、autograd的梯度一致
+    embeddings = torch.randn(64, 6, 10, dtype=torch.float64, requires_grad=True)
+    brute = sum((embeddings[:, f] * embeddings[:, g]).sum(dim=1, keepdim=True)
+                for f in range(6) for g in range(f + 1, 6))
+    print(f"max |fm_interaction - pairwise|: {(fm_interaction(embeddings) - brute).abs().max().item():.3e}")
+    print(f"gradcheck: {torch.autograd.gradcheck(fm_interaction, (embeddings,))}")
+
+    # 每个batch的前向+反向耗时和内存：原来的FM（2个128维embedding拼接后做FM）vs field FM
+    # 2 fields: user_id, movie_id；5 fields: 再加上gender, age, occupation；6 fields: 再加上multi-hot的genres
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    field_dims = [6040, 3883, 2, 7, 21, 18]
+    repeat = 50
+    for batch_size in [64, 1024, 4096]:
+        x = torch.stack([torch.randint(dim, (batch_size,)) for dim in field_dims], dim=1)
+        x[:, 5] = torch.randint(1, 2 ** 18, (batch_size,))
+        target = torch.randint(2, (batch_size,)).float()
+        for name, model in [('dense 2 fields', DenseFM()),
+                            ('field 2 fields', FM(k=10, field_dims=field_dims[:2])),
+                            ('field 5 fields', FM(k=10, field_dims=field_dims[:5])),
+                            ('field 6 fields', FM(k=10, field_dims=field_dims, multi_hot=[5]))]:
+            model.to(device)
+            inputs = x[:, :len(getattr(model, 'field_dims', [0, 0]))].to(device)
+            for step in range(repeat + 5):
+                if step == 5:
+                    if device == 'cuda':
+                        torch.cuda.synchronize()
+                        torch.cuda.reset_peak_memory_stats()
+                    start = time.perf_counter()
+                loss = nn.functional.binary_cross_entropy(model(inputs)[:, 1], target.to(device))
+                model.zero_grad()
+                loss.backward()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            cost = (time.perf_counter() - start) / repeat * 1000
+            memory = f", peak {torch.cuda.max_memory_allocated() / 2 ** 20:.1f} MB" if device == 'cuda' else ''
+            print(f"batch_size={batch_size:5d} {name}: {cost:.3f} ms/batch, "
+                  f"activations {saved_bytes(model, inputs) / 2 ** 10:7.1f} KB{memory}")
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from models.fedavg.movielens.wide import sparse_linear
 
 
 # CTR的LR模型
@@ -9,10 +10,10 @@ import torch.nn.functional as F
 class LR(nn.Module):
     """
     user_id, movie_id进行embedding的MLP网络模型
-    user共6040个，movie共3883个
+    user_num, movie_num: 数据里user、movie的个数，默认是ml-1m的6040个、3883个
     """
 
-    def __init__(self):
+    def __init__(self, user_num=6040, movie_num=3883):
         super(LR, self).__init__()
 
         # self.user_id_embed = nn.Embedding(6040, 128)
@@ -20,33 +21,16 @@ class LR(nn.Module):
 
         # self.dropout = nn.Dropout(0.3)
 
-        self.fc = nn.Linear(9923, 1)  # usr_id 和 movie_id onehot后的长度
+        self.field_dims = [user_num, movie_num]
+        self.fc = nn.Linear(user_num + movie_num, 1)  # usr_id 和 movie_id onehot后的长度
 
         self.sig = nn.Sigmoid()
         # https://zhuanlan.zhihu.com/p/59800597
         self.criterion = nn.BCELoss(reduction="mean")
 
     def forward(self, x):
-        device = x.device.type
-        batch_data = None
-        for id in x.cpu().numpy():
-            us, mv = torch.zeros(6040), torch.zeros(3883)
-            us[int(id[0])], mv[int(id[1])] = 1, 1
-            data = torch.cat((us, mv), axis=-1).unsqueeze(dim=0)
-
-            if batch_data is None:
-                batch_data = data
-            else:
-                batch_data = torch.cat((batch_data, data), axis=0)
-
-        x = batch_data.to(device)
-        # x = x.float()
-        # user_embed = self.user_id_embed(x[:, 0].long())  # 必须是long类型
-        # movie_embed = self.movie_id_embed(x[:, 1].long())
-        # x = torch.cat((user_embed, movie_embed), axis=-1)
-
-        # 可以在这里进行onehot，节省时间
-        logit = self.fc(x)
+        # usr_id 和 movie_id 的onehot只有两个位置为1，直接按索引取fc的权重，不用构造[batch_size, user_num + movie_num]的onehot矩阵
+        logit = sparse_linear(x, self.fc, self.field_dims)
         output = self.sig(logit)
         return torch.cat((1 - output, output), dim=-1)
 
@@ -6,13 +6,16 @@ import torch.nn.functional as F
 class MLP(nn.Module):
     """
     user_id, movie_id进行embedding的MLP网络模型
-    user共6040个，movie共3883个
+    user_num, movie_num: 数据里user、movie的个数，默认是ml-1m的6040个、3883个
     """
+    # embedding表 -> 用输入的哪一列查表，客户端只会更新自己数据里出现过的行（见algorithm/fedavg/sparse_rows.py）
+    row_inputs = {'user_id_embed.weight': 0, 'movie_id_embed.weight': 1}
 
-    def __init__(self):
+    def __init__(self, user_num=6040, movie_num=3883, sparse=False):
+        """sparse: embedding使用稀疏梯度，只有用到的行有梯度"""
         super(MLP, self).__init__()
-        self.user_id_embed = nn.Embedding(6040, 128)
-        self.movie_id_embed = nn.Embedding(3883, 128)
+        self.user_id_embed = nn.Embedding(user_num, 128, sparse=sparse)
+        self.movie_id_embed = nn.Embedding(movie_num, 128, sparse=sparse)
         self.fc = nn.Sequential(
             nn.Linear(128 * 2, 128),
             nn.BatchNorm1d(128),
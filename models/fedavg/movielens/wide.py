@@ -0,0 +1,68 @@
+import time
+import torch
+import torch.nn as nn
+
+
+# LR和WideDeep中wide部分的稀疏实现
+# one-hot后再过nn.Linear，等价于按ID直接取出nn.Linear权重中对应的那一列再求和（相当于维度为1的embedding）
+
+def field_offsets(field_dims, device=None):
+    """
+    每个field在拼接后的one-hot向量中的起始位置，如 [6040, 3883] -> [0, 6040]
+    """
+    offsets = [0]
+    for dim in field_dims[:-1]:
+        offsets.append(offsets[-1] + dim)
+    return torch.tensor(offsets, dtype=torch.long, device=device)
+
+
+def sparse_linear(x, linear, field_dims):
+    """
+    不构造one-hot矩阵，直接按索引计算 linear(onehot(x))
+
+    Args:
+        x: [batch_size, num_fields] 每一列是一个field的ID（如user_id, movie_id）
+        linear: nn.Linear(sum(field_dims), 1)
+        field_dims: 每个field的ID个数
+
+    Returns: logit [batch_size, 1]
+    """
+    index = x[:, :len(field_dims)].long() + field_offsets(field_dims, device=x.device)
+    # weight: [1, sum(field_dims)] -> 取出每个样本各field对应的权重并相加
+    return linear.weight[0][index].sum(dim=1, keepdim=True) + linear.bias
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../")))
+    from benchmarks.reference import dense_linear
+
+    torch.manual_seed(42)
+    field_dims = [6040, 3883]
+    linear = nn.Linear(sum(field_dims), 1)
+
+    # 等价性验证：前向结果和梯度都要和dense写法一致（benchmarks/checks.py里也有，python -m benchmarks.run --check会跑）
+    x = torch.stack((torch.randint(6040, (256,)), torch.randint(3883, (256,))), dim=1)
+    sparse_out = sparse_linear(x, linear, field_dims)
+    sparse_out.sum().backward()
+    sparse_grad = linear.weight.grad.clone()
+    linear.zero_grad()
+    dense_out = dense_linear(x, linear, field_dims)
+    dense_out.sum().backward()
+    print(f"max |sparse - dense| logit: {(sparse_out - dense_out).abs().max().item():.3e}")
+    print(f"max |sparse - dense| grad:  {(sparse_grad - linear.weight.grad).abs().max().item():.3e}")
+    torch.testing.assert_close(sparse_out, dense_out)
+    torch.testing.assert_close(sparse_grad, linear.weight.grad)
+
+    # micro-benchmark
+    with torch.no_grad():
+        for batch_size in [16, 64, 256, 1024, 4096]:
+            x = torch.stack((torch.randint(6040, (batch_size,)), torch.randint(3883, (batch_size,))), dim=1)
+            for name, fn in [('sparse', sparse_linear), ('dense', dense_linear)]:
+                start = time.perf_counter()
+                for _ in range(20):
+                    fn(x, linear, field_dims)
+                cost = (time.perf_counter() - start) / 20 * 1000
+                print(f"batch_size={batch_size:5d} {name:6s}: {cost:.3f} ms/batch")
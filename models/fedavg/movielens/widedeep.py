@@ -1,14 +1,18 @@
 # https://github.com/zhongqiangwu960812/AI-RecommenderSystem/blob/master/WideDeep/Wide%26Deep%20Model.ipynb
 import torch
 import torch.nn as nn
+from models.fedavg.movielens.wide import sparse_linear
 
 
 class WideDeep(nn.Module):
-    def __init__(self):
+    row_inputs = {'user_id_embed.weight': 0, 'movie_id_embed.weight': 1}
+
+    def __init__(self, user_num=6040, movie_num=3883, sparse=False):
+        """sparse: embedding使用稀疏梯度"""
         super(WideDeep, self).__init__()
-        user_num, movie_num = 6040, 3883
-        self.user_id_embed = nn.Embedding(user_num, 128)
-        self.movie_id_embed = nn.Embedding(movie_num, 128)
+        self.field_dims = [user_num, movie_num]
+        self.user_id_embed = nn.Embedding(user_num, 128, sparse=sparse)
+        self.movie_id_embed = nn.Embedding(movie_num, 128, sparse=sparse)
 
         self.wide_linear = nn.Linear(user_num + movie_num, 1)
 
@@ -37,20 +41,7 @@ class WideDeep(nn.Module):
         deep_out = self.deep_dnn(deep_input)
 
         # wide 网络
-        device = x.device.type
-        batch_data = None
-        for input in x.cpu().numpy():
-            us, mv = torch.zeros(6040), torch.zeros(3883)
-            us[int(input[0])], mv[int(input[1])] = 1, 1
-            data = torch.cat((us, mv), axis=-1).unsqueeze(dim=0)
-
-            if batch_data is None:
-                batch_data = data
-            else:
-                batch_data = torch.cat((batch_data, data), axis=0)
-
-        wide_input = batch_data.to(device)
-        wide_out = self.wide_linear(wide_input)
+        wide_out = sparse_linear(x, self.wide_linear, self.field_dims)
 
         # x = self.fc(x)
         prob_pos = torch.sigmoid(0.5 * (wide_out + deep_out))